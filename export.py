@@ -0,0 +1,76 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import argparse
+import logging
+import os
+import sys
+import warnings
+
+warnings.filterwarnings('ignore')
+
+from wan.configs import WAN_CONFIGS
+from wan.modules.export import EXPORT_FORMATS, export_dit, export_vae
+from wan.modules.model import WanModel
+from wan.modules.vae import WanVAE
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Export the DiT and the VAE of Wan as ONNX or torch.export graphs for CPU runtimes"
+    )
+    parser.add_argument(
+        "--task",
+        type=str,
+        default="t2v-1.3B",
+        choices=list(WAN_CONFIGS.keys()),
+        help="The task whose models are exported.")
+    parser.add_argument(
+        "--ckpt_dir",
+        type=str,
+        required=True,
+        help="The path to the checkpoint directory.")
+    parser.add_argument(
+        "--export_dir",
+        type=str,
+        required=True,
+        help="Directory the graphs and their descriptions are written to.")
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="onnx",
+        choices=list(EXPORT_FORMATS),
+        help="onnx for onnxruntime, pt2 for torch.export programs.")
+    parser.add_argument(
+        "--parts",
+        type=str,
+        nargs="+",
+        default=["dit", "vae"],
+        choices=["dit", "vae"],
+        help="Models to export, the DiT of VACE tasks is not exportable.")
+    args = parser.parse_args()
+    assert "dit" not in args.parts or not args.task.startswith("vace"), \
+        "The VACE DiT is not exportable, export its VAE with --parts vae."
+    return args
+
+
+def export(args):
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s: %(message)s",
+        handlers=[logging.StreamHandler(stream=sys.stdout)])
+    cfg = WAN_CONFIGS[args.task]
+
+    if "vae" in args.parts:
+        vae = WanVAE(
+            vae_pth=os.path.join(args.ckpt_dir, cfg.vae_checkpoint),
+            device="cpu")
+        export_vae(vae, args.export_dir, args.format)
+        del vae
+
+    if "dit" in args.parts:
+        model = WanModel.from_pretrained(args.ckpt_dir)
+        model.eval().requires_grad_(False).float()
+        export_dit(model, args.export_dir, args.format)
+
+
+if __name__ == "__main__":
+    export(_parse_args())
@@ -16,7 +16,14 @@ from PIL import Image
 
 import wan
 from wan.configs import MAX_AREA_CONFIGS, SIZE_CONFIGS, SUPPORTED_SIZES, WAN_CONFIGS
+from wan.modules.attention import set_attention_backend
+from wan.modules.device import configure_cpu
+from wan.modules.fused_ops import set_fused_ops_backend
+from wan.modules.export import use_exported
+from wan.modules.head_sparsity import HeadSparsityProfile
+from wan.modules.quant import W8A8Calibration
 from wan.utils.prompt_extend import DashScopePromptExpander, QwenPromptExpander
+from wan.utils.step_cache import ForecastPolicy, IntervalPolicy, ThresholdPolicy
 from wan.utils.utils import cache_image, cache_video, str2bool
 
 
@@ -95,6 +102,107 @@ def _validate_args(args):
         args.
         task], f"Unsupport size {args.size} for task {args.task}, supported sizes are: {', '.join(SUPPORTED_SIZES[args.task])}"
 
+    assert args.local_window is None or (
+        args.ulysses_size == 1 and args.ring_size == 1
+    ), "3D local-window attention is not supported with sequence parallel."
+    assert args.sparse_profile is None or (
+        args.ulysses_size == 1 and args.ring_size == 1
+    ), "Head-wise sparse attention is not supported with sequence parallel."
+    assert args.merge_ratio == 0 or (
+        args.ulysses_size == 1 and args.ring_size == 1
+    ), "Token merging is not supported with sequence parallel."
+    assert args.stream_blocks is None or not args.dit_fsdp, \
+        "Block streaming is not supported with FSDP."
+    assert not args.compile or not (args.dit_fsdp or args.stream_blocks is not None), \
+        "Compilation is not supported with FSDP or block streaming."
+    assert not (args.compile and args.compile_bucket and args.merge_ratio > 0), \
+        "Token merging needs unpadded sequences, disable bucketing with --compile_bucket 0."
+    assert args.quantize is None or not (args.dit_fsdp or args.t5_fsdp), \
+        "Weight quantization is not supported with FSDP."
+    assert args.quant_calibration is None or args.quantize == "w8a8", \
+        "Calibration selects the layers of the w8a8 mode."
+    assert args.quant_calibration_steps > 0 and args.quant_calibration_stride > 0, \
+        "The w8a8 calibration observes at least one step."
+    assert args.quant_calibration is None or args.quant_cache_dir is None, \
+        "The w8a8 calibration does not use the quantized checkpoint cache."
+    assert args.quantize != "w8a8" or args.quant_group_size is None, \
+        "w8a8 uses one scale per output channel."
+    assert args.quant_calibration is None or args.stream_blocks is None, \
+        "The w8a8 calibration replaces layers after block streaming started."
+    assert not args.fuse_projections or not (args.dit_fsdp or args.t5_fsdp), \
+        "Projection fusion is not supported with FSDP."
+    assert not args.fuse_projections or args.quant_calibration is None, \
+        "The w8a8 calibration observes the unfused projections."
+    assert args.exported_dir is None or not (
+        args.dit_fsdp or args.ulysses_size > 1 or args.ring_size > 1 or
+        args.local_window is not None or args.sparse_profile is not None or
+        args.merge_ratio > 0 or args.ffn_chunk_size is not None or
+        args.precision != "fp32" or args.compile or
+        args.stream_blocks is not None), \
+        "Exported models do not support the options of the eager DiT."
+    assert args.device == "cuda" or not (
+        args.t5_fsdp or args.dit_fsdp or args.ulysses_size > 1 or
+        args.ring_size > 1 or args.stream_blocks is not None), \
+        "CPU inference does not support FSDP, sequence parallel or block streaming."
+    assert args.device == "cpu" or (
+        args.cpu_threads is None and args.cpu_interop_threads is None and
+        args.numa_node is None), \
+        "--cpu_threads, --cpu_interop_threads and --numa_node require --device cpu."
+
+
+def _quantization(args):
+    if args.quantize is None:
+        return None
+    calibration = None
+    if args.quant_calibration is not None:
+        calibration = W8A8Calibration(args.quant_calibration,
+                                      args.quant_threshold,
+                                      args.quant_calibration_steps,
+                                      args.quant_calibration_stride)
+    return dict(
+        mode=args.quantize,
+        group_size=args.quant_group_size,
+        cache_dir=args.quant_cache_dir,
+        calibration=calibration)
+
+
+def _stream_budget(args):
+    if args.stream_blocks is None:
+        return None
+    return int(args.stream_blocks * 2**30)
+
+
+def _configure_pipeline(pipe, args):
+    r"""
+    Applies the DiT options of the command line that leave the weights
+    alone to a constructed pipeline. Fusion and block streaming change where
+    the weights live and are passed to the pipeline constructors instead.
+    """
+    if args.exported_dir is not None:
+        use_exported(pipe, args.exported_dir, args.cpu_threads)
+    if args.local_window is not None:
+        pipe.model.set_local_attention(
+            args.local_window, args.local_tile, t_range=args.local_t_range)
+    if args.sparse_profile is not None:
+        pipe.model.set_head_sparsity(
+            HeadSparsityProfile(args.sparse_profile,
+                                args.sparse_calibration_steps,
+                                args.sparse_threshold))
+    if args.merge_ratio > 0:
+        pipe.model.set_token_merging(
+            args.merge_ratio,
+            args.merge_stride,
+            t_range=args.merge_t_range)
+    if args.ffn_chunk_size is not None:
+        pipe.model.set_ffn_chunking(args.ffn_chunk_size)
+    if args.precision != "fp32":
+        pipe.model.set_precision(args.precision)
+    if args.compile:
+        pipe.model.set_compile(
+            bucket=args.compile_bucket or None,
+            cache_dir=args.compile_cache_dir,
+            mode=args.compile_mode)
+
 
 def _parse_args():
     parser = argparse.ArgumentParser(
@@ -243,6 +351,255 @@ def _parse_args():
         type=float,
         default=5.0,
         help="Classifier free guidance scale.")
+    parser.add_argument(
+        "--batch_cfg",
+        action="store_true",
+        default=False,
+        help="Whether to run the conditional and unconditional branches of classifier free guidance as one batched forward."
+    )
+    parser.add_argument(
+        "--cache_context",
+        type=str2bool,
+        default=True,
+        help="Whether to cache the embedded context and cross-attention keys/values across sampling steps."
+    )
+    parser.add_argument(
+        "--cache_policy",
+        type=str,
+        default=None,
+        choices=["threshold", "interval", "forecast"],
+        help="Reuse the residual of the DiT blocks at similar sampling steps instead of recomputing it."
+    )
+    parser.add_argument(
+        "--cache_threshold",
+        type=float,
+        default=0.1,
+        help="Accumulated relative change of the modulated input of the first block that triggers a recompute with the threshold cache policy."
+    )
+    parser.add_argument(
+        "--cache_interval",
+        type=int,
+        default=None,
+        help="Distance between computed steps with the interval and forecast cache policies."
+    )
+    parser.add_argument(
+        "--guide_interval",
+        type=float,
+        nargs=2,
+        default=None,
+        help="Timestep range (low high) in which classifier free guidance is applied, only the conditional branch runs outside of it."
+    )
+    parser.add_argument(
+        "--uncond_interval",
+        type=int,
+        default=1,
+        help="Recompute the unconditional prediction every N guided steps and reuse the last uncond-cond delta in between."
+    )
+    parser.add_argument(
+        "--attention_backend",
+        type=str,
+        default=None,
+        help="Attention backend, e.g. flash3, flash2, xformers, sdpa, sdpa_efficient, sdpa_math or chunked. 'auto' benchmarks the supported backends per shape."
+    )
+    parser.add_argument(
+        "--fused_ops",
+        type=str,
+        default="auto",
+        choices=["auto", "reference", "triton", "inductor"],
+        help="Implementation of the fused adaLN, gated residual and QK-RMSNorm ops. 'auto' uses Triton on CUDA and inductor on CPU."
+    )
+    parser.add_argument(
+        "--attention_cache",
+        type=str,
+        default=None,
+        help="JSON file the attention autotuner persists its choices to, defaults to ~/.cache/wan/attention_backends.json."
+    )
+    parser.add_argument(
+        "--attention_chunk_size",
+        type=int,
+        default=None,
+        help="Queries and keys per block of the memory-bounded chunked attention backend."
+    )
+    parser.add_argument(
+        "--local_window",
+        type=int,
+        nargs=3,
+        default=None,
+        help="(F H W) radius in tokens of the 3D local-window self-attention, full attention if not set."
+    )
+    parser.add_argument(
+        "--local_tile",
+        type=int,
+        nargs=3,
+        default=[4, 8, 8],
+        help="(F H W) tile size of the block-sparse local-window attention.")
+    parser.add_argument(
+        "--local_t_range",
+        type=float,
+        nargs=2,
+        default=None,
+        help="Timestep range (low high) using local-window attention, full attention outside of it."
+    )
+    parser.add_argument(
+        "--sparse_profile",
+        type=str,
+        default=None,
+        help="JSON head sparsity profile of the checkpoint. Runs spatial and temporal heads with sparse attention, the profile is calibrated on the first steps if the file does not exist."
+    )
+    parser.add_argument(
+        "--sparse_calibration_steps",
+        type=int,
+        default=2,
+        help="Sampling steps observed with dense attention to calibrate a new head sparsity profile."
+    )
+    parser.add_argument(
+        "--sparse_threshold",
+        type=float,
+        default=0.9,
+        help="Share of a head's attention mass inside its frame or pixel column for the head to be made sparse."
+    )
+    parser.add_argument(
+        "--merge_ratio",
+        type=float,
+        default=0.,
+        help="Share of the tokens merged away by bipartite matching before the self-attention and FFN of every block."
+    )
+    parser.add_argument(
+        "--merge_stride",
+        type=int,
+        nargs=3,
+        default=[1, 2, 2],
+        help="(F H W) windows of the token merging, tokens are only merged within their window."
+    )
+    parser.add_argument(
+        "--merge_t_range",
+        type=float,
+        nargs=2,
+        default=None,
+        help="Timestep range (low high) merging tokens, all tokens are kept outside of it."
+    )
+    parser.add_argument(
+        "--ffn_chunk_size",
+        type=int,
+        default=None,
+        help="Tokens per chunk of the FFN and its modulation, lowers the peak activation memory."
+    )
+    parser.add_argument(
+        "--stream_blocks",
+        type=float,
+        default=None,
+        help="Stream the DiT blocks from pinned host memory with prefetching, keeping as many resident as fit into this VRAM budget in GiB (0 streams all)."
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16_adaln", "bf16_residual", "bf16"],
+        help="Activation dtypes of the DiT: fp32 keeps the original numerics, bf16_adaln stores the modulated norm outputs in bf16, bf16_residual also the residual stream, bf16 everything including the modulation."
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        default=False,
+        help="Compile the elementwise regions of the DiT blocks and head with torch.compile."
+    )
+    parser.add_argument(
+        "--compile_bucket",
+        type=int,
+        default=4096,
+        help="Round the padded token sequence up to a multiple of this length, so compiled graphs are reused across video sizes. 0 disables bucketing."
+    )
+    parser.add_argument(
+        "--compile_cache_dir",
+        type=str,
+        default=None,
+        help="Directory persisting the compiled artifacts across runs."
+    )
+    parser.add_argument(
+        "--compile_mode",
+        type=str,
+        default=None,
+        help="Mode of torch.compile, e.g. max-autotune."
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["int8", "int4", "fp8", "w8a8"],
+        help="Store the linear weights of the DiT and T5 blocks quantized to this format, w8a8 also quantizes the activations per token."
+    )
+    parser.add_argument(
+        "--quant_group_size",
+        type=int,
+        default=None,
+        help="Input channels sharing one quantization scale, defaults to one scale per output channel."
+    )
+    parser.add_argument(
+        "--quant_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of quantized checkpoints, loaded if present and written otherwise."
+    )
+    parser.add_argument(
+        "--quant_calibration",
+        type=str,
+        default=None,
+        help="JSON file of the linears selected for w8a8, calibrated on the first generation if it does not exist."
+    )
+    parser.add_argument(
+        "--quant_calibration_steps",
+        type=int,
+        default=4,
+        help="Sampling steps the w8a8 calibration observes, the DiT is quantized from the step after the last one."
+    )
+    parser.add_argument(
+        "--quant_calibration_stride",
+        type=int,
+        default=8,
+        help="Sampling steps between two steps observed by the w8a8 calibration."
+    )
+    parser.add_argument(
+        "--quant_threshold",
+        type=float,
+        default=0.02,
+        help="Largest relative output error of a linear selected by the w8a8 calibration."
+    )
+    parser.add_argument(
+        "--fuse_projections",
+        action="store_true",
+        default=False,
+        help="Concatenate the q/k/v and k/v projections of the DiT and T5 attentions into single linears at load time."
+    )
+    parser.add_argument(
+        "--exported_dir",
+        type=str,
+        default=None,
+        help="Directory written by export.py, the DiT and VAE run from its graphs through onnxruntime on CPU."
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda",
+        choices=["cuda", "cpu"],
+        help="Device the pipeline runs on, cpu runs all models on CPU with the bf16 autocast of the task config."
+    )
+    parser.add_argument(
+        "--cpu_threads",
+        type=int,
+        default=None,
+        help="Intra-op threads on CPU, one per physical core of the process affinity by default."
+    )
+    parser.add_argument(
+        "--cpu_interop_threads",
+        type=int,
+        default=None,
+        help="Inter-op threads on CPU, PyTorch's default if not set.")
+    parser.add_argument(
+        "--numa_node",
+        type=int,
+        default=None,
+        help="NUMA node the process and its threads are pinned to on CPU, modulo the number of nodes."
+    )
 
     args = parser.parse_args()
 
@@ -267,13 +624,31 @@ def generate(args):
     rank = int(os.getenv("RANK", 0))
     world_size = int(os.getenv("WORLD_SIZE", 1))
     local_rank = int(os.getenv("LOCAL_RANK", 0))
-    device = local_rank
+    device = local_rank if args.device == "cuda" else "cpu"
     _init_logging(rank)
+    if args.device == "cpu":
+        assert world_size == 1, "CPU inference runs in a single process."
+        configure_cpu(args.cpu_threads, args.cpu_interop_threads,
+                      args.numa_node)
 
     if args.offload_model is None:
-        args.offload_model = False if world_size > 1 else True
+        args.offload_model = False if (world_size > 1 or
+                                       args.device == "cpu") else True
         logging.info(
             f"offload_model is not specified, set to {args.offload_model}.")
+    if args.attention_backend is not None or args.attention_chunk_size is not None:
+        set_attention_backend(args.attention_backend, args.attention_cache,
+                              args.attention_chunk_size)
+    set_fused_ops_backend(args.fused_ops)
+
+    quantization = _quantization(args)
+    cache_policy = None
+    if args.cache_policy == "threshold":
+        cache_policy = ThresholdPolicy(args.cache_threshold)
+    elif args.cache_policy == "interval":
+        cache_policy = IntervalPolicy(args.cache_interval or 2)
+    elif args.cache_policy == "forecast":
+        cache_policy = ForecastPolicy(args.cache_interval or 3)
     if world_size > 1:
         torch.cuda.set_device(local_rank)
         dist.init_process_group(
@@ -366,7 +741,11 @@ def generate(args):
             dit_fsdp=args.dit_fsdp,
             use_usp=(args.ulysses_size > 1 or args.ring_size > 1),
             t5_cpu=args.t5_cpu,
+            quantization=quantization,
+            fuse=args.fuse_projections,
+            stream_blocks=_stream_budget(args),
         )
+        _configure_pipeline(wan_t2v, args)
 
         logging.info(
             f"Generating {'image' if 't2i' in args.task else 'video'} ...")
@@ -379,7 +758,12 @@ def generate(args):
             sampling_steps=args.sample_steps,
             guide_scale=args.sample_guide_scale,
             seed=args.base_seed,
-            offload_model=args.offload_model)
+            offload_model=args.offload_model,
+            batch_cfg=args.batch_cfg,
+            cache_context=args.cache_context,
+            cache_policy=cache_policy,
+            guide_interval=args.guide_interval,
+            uncond_interval=args.uncond_interval)
 
     elif "i2v" in args.task:
         if args.prompt is None:
@@ -423,7 +807,11 @@ def generate(args):
             dit_fsdp=args.dit_fsdp,
             use_usp=(args.ulysses_size > 1 or args.ring_size > 1),
             t5_cpu=args.t5_cpu,
+            quantization=quantization,
+            fuse=args.fuse_projections,
+            stream_blocks=_stream_budget(args),
         )
+        _configure_pipeline(wan_i2v, args)
 
         logging.info("Generating video ...")
         video = wan_i2v.generate(
@@ -436,7 +824,12 @@ def generate(args):
             sampling_steps=args.sample_steps,
             guide_scale=args.sample_guide_scale,
             seed=args.base_seed,
-            offload_model=args.offload_model)
+            offload_model=args.offload_model,
+            batch_cfg=args.batch_cfg,
+            cache_context=args.cache_context,
+            cache_policy=cache_policy,
+            guide_interval=args.guide_interval,
+            uncond_interval=args.uncond_interval)
     elif "flf2v" in args.task:
         if args.prompt is None:
             args.prompt = EXAMPLE_PROMPT[args.task]["prompt"]
@@ -481,7 +874,11 @@ def generate(args):
             dit_fsdp=args.dit_fsdp,
             use_usp=(args.ulysses_size > 1 or args.ring_size > 1),
             t5_cpu=args.t5_cpu,
+            quantization=quantization,
+            fuse=args.fuse_projections,
+            stream_blocks=_stream_budget(args),
         )
+        _configure_pipeline(wan_flf2v, args)
 
         logging.info("Generating video ...")
         video = wan_flf2v.generate(
@@ -495,7 +892,12 @@ def generate(args):
             sampling_steps=args.sample_steps,
             guide_scale=args.sample_guide_scale,
             seed=args.base_seed,
-            offload_model=args.offload_model)
+            offload_model=args.offload_model,
+            batch_cfg=args.batch_cfg,
+            cache_context=args.cache_context,
+            cache_policy=cache_policy,
+            guide_interval=args.guide_interval,
+            uncond_interval=args.uncond_interval)
     elif "vace" in args.task:
         if args.prompt is None:
             args.prompt = EXAMPLE_PROMPT[args.task]["prompt"]
@@ -529,7 +931,11 @@ def generate(args):
             dit_fsdp=args.dit_fsdp,
             use_usp=(args.ulysses_size > 1 or args.ring_size > 1),
             t5_cpu=args.t5_cpu,
+            quantization=quantization,
+            fuse=args.fuse_projections,
+            stream_blocks=_stream_budget(args),
         )
+        _configure_pipeline(wan_vace, args)
 
         src_video, src_mask, src_ref_images = wan_vace.prepare_source(
             [args.src_video], [args.src_mask], [
@@ -550,9 +956,16 @@ def generate(args):
             sampling_steps=args.sample_steps,
             guide_scale=args.sample_guide_scale,
             seed=args.base_seed,
-            offload_model=args.offload_model)
+            offload_model=args.offload_model,
+            batch_cfg=args.batch_cfg,
+            cache_context=args.cache_context,
+            cache_policy=cache_policy,
+            guide_interval=args.guide_interval,
+            uncond_interval=args.uncond_interval)
     else:
         raise ValueError(f"Unkown task type: {args.task}")
+    if quantization is not None and quantization['calibration'] is not None:
+        quantization['calibration'].close()
 
     if rank == 0:
         if args.save_file is None:
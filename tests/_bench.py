@@ -0,0 +1,26 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Helpers shared by the benchmark scripts. Importing this module puts the
+repository root on sys.path, so the scripts run against the `wan` package of
+the tree.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wan.modules.device import synchronize
+
+
+def benchmark(fn, repeats, device):
+    r"""
+    Runs fn once to warm up and returns its output together with the mean
+    latency in seconds of `repeats` further runs.
+    """
+    out = fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    synchronize(device)
+    return out, (time.perf_counter() - start) / repeats
@@ -0,0 +1,91 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Compares the latency and output error of 3D local-window attention against
+full attention on a single (F, H, W) token grid.
+
+    python tests/benchmark_attention.py --grid 21 30 52 --window 3 8 8
+"""
+import argparse
+
+import torch
+
+from _bench import benchmark
+from wan.modules.attention import attention, local_attention_3d
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark 3D local-window attention against full attention"
+    )
+    parser.add_argument(
+        "--grid",
+        type=int,
+        nargs=3,
+        default=[21, 30, 52],
+        help="(F, H, W) token grid, the default is 81 frames at 480*832.")
+    parser.add_argument(
+        "--window",
+        type=int,
+        nargs=3,
+        default=[3, 8, 8],
+        help="(F, H, W) radius of the local window in tokens.")
+    parser.add_argument(
+        "--tile",
+        type=int,
+        nargs=3,
+        default=[4, 8, 8],
+        help="(F, H, W) tile size of the block-sparse kernel.")
+    parser.add_argument(
+        "--num_heads", type=int, default=12, help="Attention heads.")
+    parser.add_argument(
+        "--head_dim", type=int, default=128, help="Channels per head.")
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="bfloat16",
+        choices=["float32", "float16", "bfloat16"],
+        help="Data type of q, k and v.")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="Device to run on.")
+    parser.add_argument(
+        "--repeats", type=int, default=5, help="Timed runs per mode.")
+    return parser.parse_args()
+
+
+def _smooth_inputs(grid, num_heads, head_dim, dtype, device):
+    # neighboring tokens of real latents are correlated, so are these
+    x = torch.randn(1, num_heads * head_dim, *grid, device=device)
+    x = torch.nn.functional.avg_pool3d(x, 3, stride=1, padding=1)
+    x = x.flatten(2).transpose(1, 2).unflatten(2, (num_heads, head_dim))
+    return (x / x.std()).to(dtype)
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    q, k, v = (
+        _smooth_inputs(args.grid, args.num_heads, args.head_dim, dtype,
+                       device) for _ in range(3))
+    grid_sizes = torch.tensor([args.grid], dtype=torch.long)
+
+    full, t_full = benchmark(lambda: attention(q, k, v), args.repeats, device)
+    local, t_local = benchmark(
+        lambda: local_attention_3d(q, k, v, grid_sizes, args.window, args.
+                                   tile), args.repeats, device)
+
+    diff = (local.float() - full.float()).abs()
+    print(f"tokens:          {q.size(1)}")
+    print(f"full attention:  {t_full * 1e3:.2f} ms")
+    print(f"local attention: {t_local * 1e3:.2f} ms "
+          f"({t_full / t_local:.2f}x)")
+    print(f"max abs error:   {diff.max().item():.4e}")
+    print(f"relative error:  "
+          f"{(diff.mean() / full.float().abs().mean()).item():.4e}")
+
+
+if __name__ == "__main__":
+    main(_parse_args())
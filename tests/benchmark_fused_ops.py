@@ -0,0 +1,84 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Compares the latency and output error of the fused adaLN, gated residual and
+QK-RMSNorm ops against their eager PyTorch references on one block's tensors.
+The traffic column counts the bytes a single pass over inputs and outputs
+moves, so its ratio to the latency is the effective bandwidth.
+
+    python tests/benchmark_fused_ops.py --tokens 32760 --dim 1536
+    python tests/benchmark_fused_ops.py --device cpu --backend inductor
+"""
+import argparse
+
+import torch
+
+from _bench import benchmark
+from wan.modules.fused_ops import (
+    FUSED_OPS_BACKENDS,
+    gated_residual,
+    layernorm_modulate,
+    qk_rms_norm,
+    set_fused_ops_backend,
+)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the fused DiT ops against their references")
+    parser.add_argument(
+        "--tokens", type=int, default=32760, help="Tokens per sample.")
+    parser.add_argument(
+        "--dim", type=int, default=1536, help="Hidden dimension.")
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="auto",
+        choices=[u for u in FUSED_OPS_BACKENDS if u != "reference"],
+        help="Backend compared with the reference.")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="Device to run on.")
+    parser.add_argument(
+        "--repeats", type=int, default=20, help="Timed runs per op.")
+    return parser.parse_args()
+
+
+def _nbytes(*tensors):
+    return sum(u.numel() * u.element_size() for u in tensors)
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(args.device)
+    x = torch.randn(1, args.tokens, args.dim, device=device)
+    y = torch.randn_like(x, dtype=torch.bfloat16)
+    e = torch.randn(1, 3, args.dim, device=device).chunk(3, dim=1)
+    q, k = (torch.randn_like(y) for _ in range(2))
+    w = torch.rand(args.dim, device=device)
+
+    ops = [
+        ('layernorm_modulate', lambda: layernorm_modulate(x, e[0], e[1]),
+         _nbytes(x) * 2),
+        ('gated_residual', lambda: gated_residual(x, y, e[2]),
+         _nbytes(x, y, x)),
+        ('qk_rms_norm', lambda: qk_rms_norm(q, k, w, w), _nbytes(q, k) * 3),
+    ]
+    print(f"{'op':<20}{'traffic':>12}{'reference':>12}{args.backend:>12}"
+          f"{'speedup':>9}{'max abs err':>13}")
+    for name, fn, traffic in ops:
+        set_fused_ops_backend('reference')
+        ref, t_ref = benchmark(fn, args.repeats, device)
+        set_fused_ops_backend(args.backend)
+        out, t = benchmark(fn, args.repeats, device)
+        if isinstance(out, torch.Tensor):
+            out, ref = (out,), (ref,)
+        error = max((o.float() - r.float()).abs().max().item()
+                    for o, r in zip(out, ref))
+        print(f"{name:<20}{traffic / 2**20:>8.1f} MiB{t_ref * 1e3:>9.3f} ms"
+              f"{t * 1e3:>9.3f} ms{t_ref / t:>8.2f}x{error:>13.2e}")
+
+
+if __name__ == "__main__":
+    main(_parse_args())
@@ -0,0 +1,115 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Compares the output and latency of a randomly initialized WanModel and T5
+encoder before and after fusing their q/k/v and k/v projections, and checks
+that unfusing restores the original state dict.
+
+    python tests/benchmark_fusion.py --num_layers 4 --latent 16 5 60 104
+"""
+import argparse
+
+import torch
+
+from _bench import benchmark
+from wan.modules.fusion import fuse_projections, unfuse_projections
+from wan.modules.model import WanModel
+from wan.modules.t5 import T5Encoder
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the fused q/k/v and k/v projections")
+    parser.add_argument(
+        "--model_type",
+        type=str,
+        default="t2v",
+        choices=["t2v", "i2v"],
+        help="Type of the DiT, i2v adds the image cross-attention.")
+    parser.add_argument(
+        "--dim", type=int, default=1536, help="Hidden dimension.")
+    parser.add_argument(
+        "--ffn_dim", type=int, default=8960, help="FFN hidden dimension.")
+    parser.add_argument(
+        "--num_heads", type=int, default=12, help="Attention heads.")
+    parser.add_argument(
+        "--num_layers", type=int, default=4, help="Attention blocks.")
+    parser.add_argument(
+        "--latent",
+        type=int,
+        nargs=4,
+        default=[16, 5, 60, 104],
+        help="(C, F, H, W) of the input latent.")
+    parser.add_argument(
+        "--text_len", type=int, default=512, help="T5 tokens.")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="Device to run on.")
+    parser.add_argument(
+        "--repeats", type=int, default=3, help="Timed runs per variant.")
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    in_dim = 36 if args.model_type == 'i2v' else 16
+    dit = WanModel(
+        model_type=args.model_type,
+        in_dim=in_dim,
+        dim=args.dim,
+        ffn_dim=args.ffn_dim,
+        num_heads=args.num_heads,
+        num_layers=args.num_layers).eval().to(device)
+    t5 = T5Encoder(
+        vocab=32128,
+        dim=1024,
+        dim_attn=1024,
+        dim_ffn=2816,
+        num_heads=16,
+        num_layers=args.num_layers,
+        num_buckets=32,
+        shared_pos=False).eval().to(device)
+
+    x = [torch.randn(*args.latent, device=device)]
+    context = [torch.randn(64, dit.text_dim, device=device)]
+    t = torch.tensor([500.], device=device)
+    seq_len = args.latent[1] * args.latent[2] * args.latent[3] // 4
+    kwargs = dict(t=t, context=context, seq_len=seq_len)
+    if args.model_type == 'i2v':
+        kwargs.update(
+            clip_fea=torch.randn(1, 257, 1280, device=device),
+            y=[
+                torch.randn(
+                    in_dim - args.latent[0], *args.latent[1:], device=device)
+            ])
+    ids = torch.randint(0, 32128, (1, args.text_len), device=device)
+    mask = torch.ones_like(ids)
+
+    def run_dit():
+        with torch.autocast(device.type, dtype=torch.bfloat16):
+            return dit(x, **kwargs)[0]
+
+    def run_t5():
+        return t5(ids, mask)
+
+    print(f"{'model':<8}{'unfused':>12}{'fused':>12}{'speedup':>9}"
+          f"{'max abs err':>13}")
+    for name, model, fn in [('dit', dit, run_dit), ('t5', t5, run_t5)]:
+        state = {k: v.clone() for k, v in model.state_dict().items()}
+        ref, t_ref = benchmark(fn, args.repeats, device)
+        fuse_projections(model)
+        out, t_fused = benchmark(fn, args.repeats, device)
+        unfuse_projections(model)
+        restored = model.state_dict()
+        assert state.keys() == restored.keys() and all(
+            torch.equal(state[k], restored[k]) for k in state)
+        error = (out.float() - ref.float()).abs().max().item()
+        print(f"{name:<8}{t_ref * 1e3:>9.1f} ms{t_fused * 1e3:>9.1f} ms"
+              f"{t_ref / t_fused:>8.2f}x{error:>13.2e}")
+
+
+if __name__ == "__main__":
+    main(_parse_args())
@@ -0,0 +1,89 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Compares the output error, latency and peak memory of the DiT precision
+policies against the original numerics ('fp32') on a randomly initialized
+WanModel with the 1.3B block shapes.
+
+    python tests/benchmark_precision.py --num_layers 4 --latent 16 5 60 104
+"""
+import argparse
+
+import torch
+
+from _bench import benchmark
+from wan.modules.model import WanModel
+from wan.modules.precision import PrecisionPolicy
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the DiT precision policies")
+    parser.add_argument(
+        "--policies",
+        type=str,
+        nargs="+",
+        default=list(PrecisionPolicy.PRESETS),
+        choices=list(PrecisionPolicy.PRESETS),
+        help="Policies compared with 'fp32'.")
+    parser.add_argument(
+        "--dim", type=int, default=1536, help="Hidden dimension.")
+    parser.add_argument(
+        "--ffn_dim", type=int, default=8960, help="FFN hidden dimension.")
+    parser.add_argument(
+        "--num_heads", type=int, default=12, help="Attention heads.")
+    parser.add_argument(
+        "--num_layers", type=int, default=4, help="Attention blocks.")
+    parser.add_argument(
+        "--latent",
+        type=int,
+        nargs=4,
+        default=[16, 5, 60, 104],
+        help="(C, F, H, W) of the input latent.")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="Device to run on.")
+    parser.add_argument(
+        "--repeats", type=int, default=3, help="Timed runs per policy.")
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = WanModel(
+        dim=args.dim,
+        ffn_dim=args.ffn_dim,
+        num_heads=args.num_heads,
+        num_layers=args.num_layers).eval().to(device)
+    x = [torch.randn(*args.latent, device=device)]
+    context = [torch.randn(64, model.text_dim, device=device)]
+    t = torch.tensor([500.], device=device)
+    seq_len = args.latent[1] * args.latent[2] * args.latent[3] // 4
+
+    def run():
+        with torch.autocast(device.type, dtype=torch.bfloat16):
+            return model(x, t=t, context=context, seq_len=seq_len)[0]
+
+    print(f"{'policy':<15}{'latency':>12}{'peak memory':>15}{'rel err':>11}"
+          f"{'max abs err':>13}")
+    reference = None
+    for name in ['fp32'] + [u for u in args.policies if u != 'fp32']:
+        model.set_precision(name)
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        out, latency = benchmark(run, args.repeats, device)
+        peak = torch.cuda.max_memory_allocated(
+            device) / 2**20 if device.type == 'cuda' else float('nan')
+        if reference is None:
+            reference = out
+        diff = (out - reference).abs()
+        print(f"{name:<15}{latency * 1e3:>9.1f} ms{peak:>11.0f} MiB"
+              f"{(diff.norm() / reference.norm()).item():>11.2e}"
+              f"{diff.max().item():>13.2e}")
+
+
+if __name__ == "__main__":
+    main(_parse_args())
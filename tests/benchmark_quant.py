@@ -0,0 +1,108 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Compares the weight memory, output error and latency of the quantized linears
+against the unquantized baseline on a stack of linears shaped like the 14B DiT.
+The w8a8 mode, which also quantizes the activations, is meant for CPU hosts:
+
+    python tests/benchmark_quant.py --modes int8 int4 fp8 --group_size 128
+    python tests/benchmark_quant.py --modes w8a8 --device cpu --tokens 256
+"""
+import argparse
+import copy
+
+import torch
+import torch.nn as nn
+
+from _bench import benchmark
+from wan.modules.quant import QUANT_MODES, QuantLinear
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark quantized linears against the baseline")
+    parser.add_argument(
+        "--modes",
+        type=str,
+        nargs="+",
+        default=list(QUANT_MODES),
+        choices=list(QUANT_MODES),
+        help="Quantization modes to compare.")
+    parser.add_argument(
+        "--group_size",
+        type=int,
+        default=None,
+        help="Input channels sharing one scale of the weight-only modes, defaults to per output channel."
+    )
+    parser.add_argument(
+        "--dim", type=int, default=5120, help="Hidden dimension.")
+    parser.add_argument(
+        "--ffn_dim", type=int, default=13824, help="FFN hidden dimension.")
+    parser.add_argument(
+        "--tokens", type=int, default=1024, help="Input tokens.")
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="bfloat16",
+        choices=["float32", "float16", "bfloat16"],
+        help="Data type of the baseline weights and activations.")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="Device to run on.")
+    parser.add_argument(
+        "--repeats", type=int, default=5, help="Timed runs per mode.")
+    return parser.parse_args()
+
+
+def _nbytes(module):
+    return sum(
+        t.numel() * t.element_size()
+        for t in list(module.parameters()) + list(module.buffers()))
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+
+    # q, k, v, o and the two FFN linears of one attention block
+    baseline = nn.Sequential(*[
+        nn.Linear(i, o) for i, o in [(args.dim, args.dim)] * 4 +
+        [(args.dim, args.ffn_dim), (args.ffn_dim, args.dim)]
+    ]).to(device, dtype)
+    x = torch.randn(args.tokens, args.dim, device=device, dtype=dtype)
+
+    def forward(layers):
+        # q, k, v, o and fc1 see x, fc2 sees the activated fc1 output
+        outs = [layer(x) for layer in layers[:-1]]
+        outs.append(layers[-1](nn.functional.gelu(outs[-1])))
+        return outs
+
+    ref, t_ref = benchmark(lambda: forward(baseline), args.repeats, device)
+    print(f"{'mode':<9}{'weights':>12}{'latency':>12}{'tokens/s':>10}"
+          f"{'weight err':>13}{'output err':>13}")
+    print(f"{args.dtype:<9}{_nbytes(baseline) / 2**20:>9.1f} MiB"
+          f"{t_ref * 1e3:>9.2f} ms{args.tokens / t_ref:>10.0f}"
+          f"{0:>13.2e}{0:>13.2e}")
+    for mode in args.modes:
+        layers = nn.Sequential(*[
+            QuantLinear.from_linear(linear, mode,
+                                    None if mode == 'w8a8' else args.group_size)
+            for linear in copy.deepcopy(baseline)
+        ])
+        out, t = benchmark(lambda: forward(layers), args.repeats, device)
+        weight_error = max(
+            float((q.dequantize(torch.float32) - l.weight.float()).norm() /
+                  l.weight.float().norm())
+            for q, l in zip(layers, baseline))
+        output_error = max(
+            float((o.float() - r.float()).norm() / r.float().norm())
+            for o, r in zip(out, ref))
+        print(f"{mode:<9}{_nbytes(layers) / 2**20:>9.1f} MiB"
+              f"{t * 1e3:>9.2f} ms{args.tokens / t:>10.0f}"
+              f"{weight_error:>13.2e}{output_error:>13.2e}")
+
+
+if __name__ == "__main__":
+    main(_parse_args())
@@ -0,0 +1,136 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Exports a tiny randomly initialized DiT and a random-weight VAE, runs the
+graphs through the runners used by the pipelines and compares them with the
+eager PyTorch models. Exits with an error if the relative error of any output
+exceeds the tolerance.
+
+    python tests/export_parity.py --format onnx
+    python tests/export_parity.py --format pt2 --model_type i2v
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wan.modules.export import (
+    EXPORT_FORMATS,
+    WanExportedModel,
+    WanExportedVAE,
+    export_dit,
+    export_vae,
+)
+from wan.modules.fused_ops import set_fused_ops_backend
+from wan.modules.model import WanModel
+from wan.modules.vae import WanVAE, WanVAE_
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare exported DiT and VAE graphs with eager PyTorch")
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="onnx",
+        choices=list(EXPORT_FORMATS),
+        help="Format of the exported graphs.")
+    parser.add_argument(
+        "--model_type",
+        type=str,
+        default="t2v",
+        choices=["t2v", "i2v", "flf2v"],
+        help="Type of the DiT.")
+    parser.add_argument(
+        "--latent",
+        type=int,
+        nargs=4,
+        default=[16, 3, 6, 8],
+        help="(C, F, H, W) of the latent, the video is 4 * (F - 1) + 1 frames of 8H x 8W.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-3,
+        help="Largest relative L2 error of an output.")
+    parser.add_argument(
+        "--export_dir",
+        type=str,
+        default=None,
+        help="Directory of the graphs, a temporary one by default.")
+    return parser.parse_args()
+
+
+def _error(out, ref):
+    return ((out.float() - ref.float()).norm() /
+            ref.float().norm().clamp_min(1e-12)).item()
+
+
+def _tiny_dit(model_type):
+    return WanModel(
+        model_type=model_type,
+        in_dim=16 if model_type == 't2v' else 36,
+        dim=64,
+        ffn_dim=128,
+        freq_dim=64,
+        text_dim=32,
+        num_heads=4,
+        num_layers=2).eval()
+
+
+def _random_vae(export_dir):
+    path = os.path.join(export_dir, 'random_vae.pth')
+    torch.save(
+        WanVAE_(
+            dim=96,
+            z_dim=16,
+            dim_mult=[1, 2, 4, 4],
+            num_res_blocks=2,
+            attn_scales=[],
+            temperal_downsample=[False, True, True]).state_dict(), path)
+    return WanVAE(vae_pth=path, device='cpu')
+
+
+@torch.no_grad()
+def main(args):
+    torch.manual_seed(0)
+    set_fused_ops_backend('reference')
+    export_dir = args.export_dir or tempfile.mkdtemp()
+    c, f, h, w = args.latent
+
+    # DiT
+    model = _tiny_dit(args.model_type)
+    export_dit(model, export_dir, args.format)
+    x = [torch.randn(c, f, h, w)]
+    kwargs = dict(
+        t=torch.tensor([500.]),
+        context=[torch.randn(77, model.text_dim)],
+        seq_len=f * h * w // 4)
+    if args.model_type != 't2v':
+        kwargs.update(
+            clip_fea=torch.randn(2 if args.model_type == 'flf2v' else 1, 257,
+                                 1280),
+            y=[torch.randn(model.in_dim - c, f, h, w)])
+    ref = model(x, **kwargs)[0]
+    out = WanExportedModel(export_dir)(x, **kwargs)[0]
+    errors = dict(dit=_error(out, ref))
+
+    # VAE
+    vae = _random_vae(export_dir)
+    export_vae(vae, export_dir, args.format)
+    exported = WanExportedVAE(export_dir)
+    video = [torch.rand(3, 4 * (f - 1) + 1, 8 * h, 8 * w) * 2 - 1]
+    z = vae.encode(video)
+    errors['vae_encode'] = _error(exported.encode(video)[0], z[0])
+    errors['vae_decode'] = _error(exported.decode(z)[0], vae.decode(z)[0])
+
+    print(f"{'output':<12}{'rel err':>11}")
+    for name, error in errors.items():
+        print(f"{name:<12}{error:>11.2e}")
+    assert max(errors.values()) <= args.tolerance, \
+        f'Exported graphs differ from eager PyTorch in {export_dir}.'
+
+
+if __name__ == "__main__":
+    main(_parse_args())
@@ -11,14 +11,22 @@ from functools import partial
 
 import numpy as np
 import torch
-import torch.cuda.amp as amp
 import torch.distributed as dist
 import torchvision.transforms.functional as TF
 from tqdm import tqdm
 
 from .distributed.fsdp import shard_model
 from .modules.clip import CLIPModel
-from .modules.model import WanModel
+from .modules.device import autocast, empty_cache, get_device, synchronize
+from .modules.fusion import fuse_projections
+from .modules.model import (
+    WanContextCache,
+    WanInferenceSession,
+    WanModel,
+    precompute_time_embeddings,
+)
+from .modules.quant import quantize_pipeline
+from .modules.streaming import BlockStreamer
 from .modules.t5 import T5EncoderModel
 from .modules.vae import WanVAE
 from .utils.fm_solvers import (
@@ -27,6 +35,8 @@ from .utils.fm_solvers import (
     retrieve_timesteps,
 )
 from .utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .utils.guidance import GuidanceSchedule, cfg_batch_fits, cfg_forward
+from .utils.step_cache import StepCache
 
 
 class WanI2V:
@@ -42,6 +52,9 @@ class WanI2V:
         use_usp=False,
         t5_cpu=False,
         init_on_cpu=True,
+        quantization=None,
+        fuse=False,
+        stream_blocks=None,
     ):
         r"""
         Initializes the image-to-video generation model components.
@@ -51,8 +64,8 @@ class WanI2V:
                 Object containing model parameters initialized from config.py
             checkpoint_dir (`str`):
                 Path to directory containing model checkpoints
-            device_id (`int`,  *optional*, defaults to 0):
-                Id of target GPU device
+            device_id (`int` or `str`,  *optional*, defaults to 0):
+                Id of target GPU device, or 'cpu' to run the pipeline on CPU
             rank (`int`,  *optional*, defaults to 0):
                 Process rank for distributed training
             t5_fsdp (`bool`, *optional*, defaults to False):
@@ -65,8 +78,15 @@ class WanI2V:
                 Whether to place T5 model on CPU. Only works without t5_fsdp.
             init_on_cpu (`bool`, *optional*, defaults to True):
                 Enable initializing Transformer Model on CPU. Only works without FSDP or USP.
+            quantization (`dict`, *optional*):
+                Arguments of `quantize_pipeline` to quantize the DiT and T5 weights
+            fuse (`bool`, *optional*, defaults to False):
+                Fuse the q/k/v and k/v projections of the DiT and T5 with `fuse_projections`
+            stream_blocks (`int`, *optional*):
+                VRAM budget in bytes of the DiT blocks, the others are streamed from pinned
+                host memory by `BlockStreamer`. 0 streams every block
         """
-        self.device = torch.device(f"cuda:{device_id}")
+        self.device = get_device(device_id)
         self.config = config
         self.rank = rank
         self.use_usp = use_usp
@@ -101,6 +121,12 @@ class WanI2V:
         logging.info(f"Creating WanModel from {checkpoint_dir}")
         self.model = WanModel.from_pretrained(checkpoint_dir)
         self.model.eval().requires_grad_(False)
+        if quantization is not None:
+            quantize_pipeline(
+                self, checkpoint_dir=checkpoint_dir, **quantization)
+        if fuse:
+            fuse_projections(self.model)
+            fuse_projections(self.text_encoder.model)
 
         if t5_fsdp or dit_fsdp or use_usp:
             init_on_cpu = False
@@ -125,6 +151,9 @@ class WanI2V:
         if dit_fsdp:
             self.model = shard_fn(self.model)
         else:
+            if stream_blocks is not None:
+                # the blocks leave for pinned memory before the rest is moved
+                BlockStreamer(self.model, self.device, stream_blocks or None)
             if not init_on_cpu:
                 self.model.to(self.device)
 
@@ -141,7 +170,12 @@ class WanI2V:
                  guide_scale=5.0,
                  n_prompt="",
                  seed=-1,
-                 offload_model=True):
+                 offload_model=True,
+                 batch_cfg=False,
+                 cache_context=True,
+                 cache_policy=None,
+                 guide_interval=None,
+                 uncond_interval=1):
         r"""
         Generates video frames from input image and text prompt using diffusion process.
 
@@ -169,6 +203,21 @@ class WanI2V:
                 Random seed for noise generation. If -1, use random seed
             offload_model (`bool`, *optional*, defaults to True):
                 If True, offloads models to CPU during generation to save VRAM
+            batch_cfg (`bool`, *optional*, defaults to False):
+                If True, runs the conditional and unconditional branches as one batch-2 forward,
+                falling back to sequential forwards when the batch does not fit into memory
+            cache_context (`bool`, *optional*, defaults to True):
+                If True, embeds the context and projects the cross-attention keys/values once
+                per generation instead of at every step
+            cache_policy (CachePolicy, *optional*, defaults to None):
+                If given, reuses the residual of the DiT blocks at the steps this policy skips,
+                e.g. `ThresholdPolicy`, `IntervalPolicy` or `ForecastPolicy`
+            guide_interval (tuple[`float`], *optional*, defaults to None):
+                Timestep range (low, high) in which classifier-free guidance is applied, outside
+                of it only the conditional branch runs
+            uncond_interval (`int`, *optional*, defaults to 1):
+                Recomputes the unconditional prediction every N guided steps and reuses the
+                last uncond-cond delta in between
 
         Returns:
             torch.Tensor:
@@ -255,7 +304,7 @@ class WanI2V:
         no_sync = getattr(self.model, 'no_sync', noop_no_sync)
 
         # evaluation mode
-        with amp.autocast(dtype=self.param_dtype), torch.no_grad(), no_sync():
+        with autocast(self.device, self.param_dtype), torch.no_grad(), no_sync():
 
             if sample_solver == 'unipc':
                 sample_scheduler = FlowUniPCMultistepScheduler(
@@ -296,25 +345,45 @@ class WanI2V:
             }
 
             if offload_model:
-                torch.cuda.empty_cache()
+                empty_cache(self.device)
 
             self.model.to(self.device)
-            for _, t in enumerate(tqdm(timesteps)):
+            if batch_cfg and not cfg_batch_fits(self.model, max_seq_len,
+                                                self.device):
+                logging.info(
+                    'Not enough memory for batched CFG, use sequential forwards.'
+                )
+                batch_cfg = False
+            context_cache = WanContextCache() if cache_context else None
+            session = WanInferenceSession()
+            time_embeddings = precompute_time_embeddings(
+                self.model, timesteps)
+            host_timesteps = timesteps.tolist()
+            step_cache = None if cache_policy is None else StepCache(
+                cache_policy, len(timesteps))
+            guidance = GuidanceSchedule(guide_interval, uncond_interval)
+
+            for i, t in enumerate(tqdm(timesteps)):
                 latent_model_input = [latent.to(self.device)]
                 timestep = [t]
 
                 timestep = torch.stack(timestep).to(self.device)
 
-                noise_pred_cond = self.model(
-                    latent_model_input, t=timestep, **arg_c)[0].to(
-                        torch.device('cpu') if offload_model else self.device)
-                if offload_model:
-                    torch.cuda.empty_cache()
-                noise_pred_uncond = self.model(
-                    latent_model_input, t=timestep, **arg_null)[0].to(
-                        torch.device('cpu') if offload_model else self.device)
-                if offload_model:
-                    torch.cuda.empty_cache()
+                noise_pred_cond, noise_pred_uncond, batch_cfg = cfg_forward(
+                    self.model,
+                    latent_model_input,
+                    timestep,
+                    arg_c,
+                    arg_null,
+                    batched=batch_cfg,
+                    guidance=guidance,
+                    offload=offload_model,
+                    context_cache=context_cache,
+                    time_embedding=time_embeddings[i],
+                    step_cache=step_cache,
+                    step=i,
+                    t_host=host_timesteps[i],
+                    session=session)
                 noise_pred = noise_pred_uncond + guide_scale * (
                     noise_pred_cond - noise_pred_uncond)
 
@@ -332,9 +401,25 @@ class WanI2V:
                 x0 = [latent.to(self.device)]
                 del latent_model_input, timestep
 
+            if context_cache is not None:
+                logging.info(
+                    f"Context cache held {context_cache.nbytes / 2**20:.1f} MiB."
+                )
+                context_cache.clear()
+            if step_cache is not None:
+                logging.info(
+                    f"Step cache skipped the blocks in {step_cache.skipped} of "
+                    f"{step_cache.skipped + step_cache.computed} forwards.")
+                step_cache.clear()
+            session.clear()
+            if guidance.saved:
+                logging.info(
+                    f"Guidance schedule saved {guidance.saved} of {guidance.steps} "
+                    f"unconditional forwards.")
+
             if offload_model:
                 self.model.cpu()
-                torch.cuda.empty_cache()
+                empty_cache(self.device)
 
             if self.rank == 0:
                 videos = self.vae.decode(x0)
@@ -343,7 +428,7 @@ class WanI2V:
         del sample_scheduler
         if offload_model:
             gc.collect()
-            torch.cuda.synchronize()
+            synchronize(self.device)
         if dist.is_initialized():
             dist.barrier()
 
@@ -1,5 +1,18 @@
-from .attention import flash_attention
+from .attention import attention, flash_attention, set_attention_backend
+from .device import configure_cpu, get_device
+from .export import export_dit, export_vae, use_exported
+from .fused_ops import set_fused_ops_backend
+from .fusion import fuse_projections, unfuse_projections
+from .head_sparsity import HeadSparsityProfile
 from .model import WanModel
+from .precision import PrecisionPolicy
+from .quant import (
+    QuantLinear,
+    W8A8Calibration,
+    quantize_model,
+    quantize_pipeline,
+)
+from .streaming import BlockStreamer
 from .t5 import T5Decoder, T5Encoder, T5EncoderModel, T5Model
 from .tokenizers import HuggingfaceTokenizer
 from .vace_model import VaceWanModel
@@ -15,4 +28,21 @@ __all__ = [
     'T5EncoderModel',
     'HuggingfaceTokenizer',
     'flash_attention',
+    'attention',
+    'set_attention_backend',
+    'set_fused_ops_backend',
+    'get_device',
+    'configure_cpu',
+    'fuse_projections',
+    'unfuse_projections',
+    'export_dit',
+    'export_vae',
+    'use_exported',
+    'HeadSparsityProfile',
+    'BlockStreamer',
+    'PrecisionPolicy',
+    'QuantLinear',
+    'quantize_model',
+    'quantize_pipeline',
+    'W8A8Calibration',
 ]
@@ -1,5 +1,14 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import json
+import logging
+import math
+import os
+import time
+from contextlib import nullcontext
+
 import torch
+import torch.nn.functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
 
 try:
     import flash_attn_interface
@@ -13,11 +22,24 @@ try:
 except ModuleNotFoundError:
     FLASH_ATTN_2_AVAILABLE = False
 
+try:
+    import xformers.ops
+    XFORMERS_AVAILABLE = True
+except ModuleNotFoundError:
+    XFORMERS_AVAILABLE = False
+
 import warnings
 
 __all__ = [
     'flash_attention',
     'attention',
+    'register_attention_backend',
+    'set_attention_backend',
+    'available_attention_backends',
+    'AttentionAutotuner',
+    'local_attention_3d',
+    'headwise_sparse_attention',
+    'AttentionMetadata',
 ]
 
 
@@ -35,6 +57,10 @@ def flash_attention(
     deterministic=False,
     dtype=torch.bfloat16,
     version=None,
+    cu_seqlens_q=None,
+    cu_seqlens_k=None,
+    max_seqlen_q=None,
+    max_seqlen_k=None,
 ):
     """
     q:              [B, Lq, Nq, C1].
@@ -42,6 +68,10 @@ def flash_attention(
     v:              [B, Lk, Nk, C2]. Nq must be divisible by Nk.
     q_lens:         [B].
     k_lens:         [B].
+    cu_seqlens_q:   [N + 1]. If given, q holds N packed sequences and is flattened over [B, Lq].
+    cu_seqlens_k:   [N + 1]. If given, k/v hold N packed sequences and are flattened over [B, Lk].
+    max_seqlen_q:   int. Longest packed query sequence, required with cu_seqlens_q.
+    max_seqlen_k:   int. Longest packed key sequence, required with cu_seqlens_k.
     dropout_p:      float. Dropout probability.
     softmax_scale:  float. The scaling of QK^T before applying softmax.
     causal:         bool. Whether to apply causal attention mask.
@@ -55,12 +85,16 @@ def flash_attention(
 
     # params
     b, lq, lk, out_dtype = q.size(0), q.size(1), k.size(1), q.dtype
+    out_shape = (b, lq) if cu_seqlens_q is None else (1, b * lq)
 
     def half(x):
         return x if x.dtype in half_dtypes else x.to(dtype)
 
     # preprocess query
-    if q_lens is None:
+    if cu_seqlens_q is not None:
+        assert max_seqlen_q is not None
+        q = half(q.flatten(0, 1))
+    elif q_lens is None:
         q = half(q.flatten(0, 1))
         q_lens = torch.tensor(
             [lq] * b, dtype=torch.int32).to(
@@ -69,7 +103,11 @@ def flash_attention(
         q = half(torch.cat([u[:v] for u, v in zip(q, q_lens)]))
 
     # preprocess key, value
-    if k_lens is None:
+    if cu_seqlens_k is not None:
+        assert max_seqlen_k is not None
+        k = half(k.flatten(0, 1))
+        v = half(v.flatten(0, 1))
+    elif k_lens is None:
         k = half(k.flatten(0, 1))
         v = half(v.flatten(0, 1))
         k_lens = torch.tensor(
@@ -85,6 +123,15 @@ def flash_attention(
     if q_scale is not None:
         q = q * q_scale
 
+    if cu_seqlens_q is None:
+        cu_seqlens_q = torch.cat([q_lens.new_zeros([1]), q_lens]).cumsum(
+            0, dtype=torch.int32).to(q.device, non_blocking=True)
+        max_seqlen_q = lq
+    if cu_seqlens_k is None:
+        cu_seqlens_k = torch.cat([k_lens.new_zeros([1]), k_lens]).cumsum(
+            0, dtype=torch.int32).to(q.device, non_blocking=True)
+        max_seqlen_k = lk
+
     if version is not None and version == 3 and not FLASH_ATTN_3_AVAILABLE:
         warnings.warn(
             'Flash attention 3 is not available, use flash attention 2 instead.'
@@ -97,39 +144,588 @@ def flash_attention(
             q=q,
             k=k,
             v=v,
-            cu_seqlens_q=torch.cat([q_lens.new_zeros([1]), q_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
-            cu_seqlens_k=torch.cat([k_lens.new_zeros([1]), k_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
+            cu_seqlens_q=cu_seqlens_q,
+            cu_seqlens_k=cu_seqlens_k,
             seqused_q=None,
             seqused_k=None,
-            max_seqlen_q=lq,
-            max_seqlen_k=lk,
+            max_seqlen_q=max_seqlen_q,
+            max_seqlen_k=max_seqlen_k,
             softmax_scale=softmax_scale,
             causal=causal,
-            deterministic=deterministic)[0].unflatten(0, (b, lq))
+            deterministic=deterministic)[0].unflatten(0, out_shape)
     else:
         assert FLASH_ATTN_2_AVAILABLE
         x = flash_attn.flash_attn_varlen_func(
             q=q,
             k=k,
             v=v,
-            cu_seqlens_q=torch.cat([q_lens.new_zeros([1]), q_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
-            cu_seqlens_k=torch.cat([k_lens.new_zeros([1]), k_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
-            max_seqlen_q=lq,
-            max_seqlen_k=lk,
+            cu_seqlens_q=cu_seqlens_q,
+            cu_seqlens_k=cu_seqlens_k,
+            max_seqlen_q=max_seqlen_q,
+            max_seqlen_k=max_seqlen_k,
             dropout_p=dropout_p,
             softmax_scale=softmax_scale,
             causal=causal,
             window_size=window_size,
-            deterministic=deterministic).unflatten(0, (b, lq))
+            deterministic=deterministic).unflatten(0, out_shape)
 
     # output
     return x.type(out_dtype)
 
 
+# Score budget of one query/key block of the chunked kernel, unless the block
+# size is set with `set_attention_backend`.
+CHUNKED_ATTENTION_BYTES = 256 * 2**20
+
+_ATTENTION_BACKENDS = {}
+_config = dict(backend=None, autotuner=None, chunk_size=None)
+
+
+class AttentionMetadata:
+    r"""
+    Sequence layout of one DiT forward. It is computed once and shared by all
+    attention calls of the blocks, so they need no host round-trips to build
+    lengths or gather the valid tokens.
+
+    Args:
+        seq_lens (Tensor):
+            Shape [B], number of tokens of each sample
+        grid_sizes (Tensor):
+            Shape [B, 3], the (F, H, W) token grid of each sample
+        device (torch.device):
+            Device of the attention inputs
+        padded_len (`int`, *optional*):
+            Length L of inputs of shape [B, L, ...] padding every sample, None if
+            the samples are packed into [1, sum(seq_lens), ...]
+    """
+
+    def __init__(self, seq_lens, grid_sizes, device, padded_len=None):
+        self.seq_lens = seq_lens.tolist()
+        self.grid_sizes = grid_sizes.tolist()
+        self.padded_len = padded_len
+        self.max_seqlen = max(self.seq_lens)
+        self.cu_seqlens_host = [0]
+        for l in self.seq_lens:
+            self.cu_seqlens_host.append(self.cu_seqlens_host[-1] + l)
+        self.cu_seqlens = torch.tensor(
+            self.cu_seqlens_host, dtype=torch.int32).to(
+                device, non_blocking=True)
+
+        # flat indices of the valid tokens of padded inputs, None if all are valid
+        self.index = None
+        if padded_len is not None and any(
+                l != padded_len for l in self.seq_lens):
+            self.index = torch.cat([
+                torch.arange(l) + i * padded_len
+                for i, l in enumerate(self.seq_lens)
+            ]).to(device, non_blocking=True)
+        self.device = device
+        self.uniform = {}
+        self.packed = {}
+
+    def pack(self, x):
+        r"""
+        Valid tokens of x of shape [B, L, ...] as [1, sum(seq_lens), ...].
+        """
+        if self.padded_len is None:
+            return x
+        x = x.flatten(0, 1)
+        if self.index is not None:
+            x = x.index_select(0, self.index)
+        return x.unsqueeze(0)
+
+    def unpack(self, x):
+        r"""
+        Inverse of `pack`, padded rows are zero.
+        """
+        if self.padded_len is None:
+            return x
+        x = x[0]
+        if self.index is not None:
+            x = x.new_zeros((len(self.seq_lens) * self.padded_len,) +
+                            x.shape[1:]).index_copy_(0, self.index, x)
+        return x.unflatten(0, (len(self.seq_lens), self.padded_len))
+
+    def uniform_cu_seqlens(self, b, l):
+        r"""
+        Cumulative lengths of b sequences of length l on the device.
+        """
+        if (b, l) not in self.uniform:
+            self.uniform[b, l] = torch.arange(
+                0, (b + 1) * l, l, dtype=torch.int32, device=self.device)
+        return self.uniform[b, l]
+
+    def packed_cu_seqlens(self, lens):
+        r"""
+        Cumulative lengths of packed sequences with the host lengths lens, on
+        the device. Kept per lens, so `host` returns them without a sync.
+        """
+        lens = tuple(lens)
+        if lens not in self.packed:
+            host = [0]
+            for l in lens:
+                host.append(host[-1] + l)
+            self.packed[lens] = (torch.tensor(host, dtype=torch.int32).to(
+                self.device, non_blocking=True), host)
+        return self.packed[lens][0]
+
+    def attention_kwargs(self, k=None):
+        r"""
+        Length arguments of `attention` for packed queries attending to
+        themselves, or to the per-sample keys k of shape [B, Lk, N, C].
+        """
+        kwargs = dict(
+            cu_seqlens_q=self.cu_seqlens,
+            max_seqlen_q=self.max_seqlen,
+            metadata=self)
+        if k is None:
+            kwargs.update(
+                cu_seqlens_k=self.cu_seqlens, max_seqlen_k=self.max_seqlen)
+        else:
+            kwargs.update(
+                cu_seqlens_k=self.uniform_cu_seqlens(*k.shape[:2]),
+                max_seqlen_k=k.size(1))
+        return kwargs
+
+    def host(self, cu_seqlens):
+        r"""
+        Host copy of cu_seqlens, without a device sync if it belongs to this
+        metadata.
+        """
+        if cu_seqlens is self.cu_seqlens:
+            return self.cu_seqlens_host
+        for (b, l), u in self.uniform.items():
+            if cu_seqlens is u:
+                return list(range(0, (b + 1) * l, l))
+        for u, host in self.packed.values():
+            if cu_seqlens is u:
+                return host
+        return cu_seqlens.tolist()
+
+
+def _segments(x, lens=None, cu_seqlens=None, metadata=None):
+    r"""
+    Splits x of shape [B, L, N, C] into per-sequence slices of shape [L_i, N, C].
+    """
+    if cu_seqlens is not None:
+        cu = cu_seqlens.tolist() if metadata is None else metadata.host(
+            cu_seqlens)
+        x = x.flatten(0, 1)
+        return [x[cu[i]:cu[i + 1]] for i in range(len(cu) - 1)]
+    if lens is None:
+        return list(x)
+    return [u[:l] for u, l in zip(x, lens.tolist())]
+
+
+def _merge(out, q, q_lens=None, cu_seqlens_q=None):
+    r"""
+    Inverse of `_segments` for the output, padded query rows are zero.
+    """
+    if cu_seqlens_q is not None:
+        return torch.cat(out).unsqueeze(0)
+    if q_lens is None:
+        return torch.stack(out)
+    return torch.stack(
+        [F.pad(u, (0, 0, 0, 0, 0, q.size(1) - u.size(0))) for u in out])
+
+
+def _local_mask(q_start,
+                q_end,
+                lq,
+                lk,
+                causal,
+                window_size,
+                device,
+                k_start=0,
+                k_end=None):
+    r"""
+    Boolean mask [q_end - q_start, k_end - k_start] of the keys each query
+    attends to, aligned to the bottom right like flash attention. None if
+    unrestricted.
+    """
+    left, right = window_size
+    if causal:
+        right = 0
+    if left < 0 and right < 0:
+        return None
+    k_end = lk if k_end is None else k_end
+    i = torch.arange(q_start, q_end, device=device).unsqueeze(1) + (lk - lq)
+    j = torch.arange(k_start, k_end, device=device).unsqueeze(0)
+    mask = torch.ones(q_end - q_start, k_end - k_start, dtype=torch.bool,
+                      device=device)
+    if left >= 0:
+        mask &= j >= i - left
+    if right >= 0:
+        mask &= j <= i + right
+    return mask
+
+
+def _varlen(kernel):
+    r"""
+    Turns a dense kernel on [B, L, N, C] inputs into a backend that runs it
+    once per sequence of a padded or packed varlen batch.
+    """
+
+    def fn(q,
+           k,
+           v,
+           q_lens=None,
+           k_lens=None,
+           cu_seqlens_q=None,
+           cu_seqlens_k=None,
+           attn_bias=None,
+           dropout_p=0.,
+           softmax_scale=None,
+           causal=False,
+           window_size=(-1, -1),
+           metadata=None,
+           **kwargs):
+        out_dtype = q.dtype
+        q, k = q.to(v.dtype), k.to(v.dtype)
+        args = dict(
+            dropout_p=dropout_p,
+            softmax_scale=softmax_scale,
+            causal=causal,
+            window_size=window_size)
+        if (q_lens is None and k_lens is None and cu_seqlens_q is None and
+                cu_seqlens_k is None):
+            return kernel(q, k, v, attn_bias, **args).type(out_dtype)
+
+        assert attn_bias is None or cu_seqlens_q is None
+        out = []
+        for i, (qi, ki, vi) in enumerate(
+                zip(
+                    _segments(q, q_lens, cu_seqlens_q, metadata),
+                    _segments(k, k_lens, cu_seqlens_k, metadata),
+                    _segments(v, k_lens, cu_seqlens_k, metadata))):
+            bias = None
+            if attn_bias is not None:
+                bias = attn_bias[i if attn_bias.size(0) > 1 else 0, :, :qi.size(
+                    0), :ki.size(0)].unsqueeze(0)
+            out.append(
+                kernel(
+                    qi.unsqueeze(0), ki.unsqueeze(0), vi.unsqueeze(0), bias,
+                    **args)[0])
+        return _merge(out, q, q_lens, cu_seqlens_q).type(out_dtype)
+
+    return fn
+
+
+def _sdpa(backends=None):
+
+    def kernel(q, k, v, attn_bias, dropout_p, softmax_scale, causal,
+               window_size):
+        mask = _local_mask(0, q.size(1), q.size(1), k.size(1), causal,
+                           (-1, -1), q.device)
+        attn_mask = mask
+        if attn_bias is not None:
+            attn_mask = attn_bias.to(q.dtype)
+            if mask is not None:
+                attn_mask = attn_mask.masked_fill(~mask, float('-inf'))
+        with sdpa_kernel(backends) if backends else nullcontext():
+            x = F.scaled_dot_product_attention(
+                q.transpose(1, 2),
+                k.transpose(1, 2),
+                v.transpose(1, 2),
+                attn_mask=attn_mask,
+                dropout_p=dropout_p,
+                scale=softmax_scale)
+        return x.transpose(1, 2)
+
+    return kernel
+
+
+def _chunked_attention(q, k, v, attn_bias, dropout_p, softmax_scale, causal,
+                       window_size):
+    r"""
+    Exact attention in pure PyTorch. Queries and keys are processed in blocks
+    with an online softmax, so only the fp32 scores of one block are alive and
+    key blocks outside the local window are never computed.
+    """
+    b, lq, n, c = q.shape
+    lk = k.size(1)
+    scale = c**-0.5 if softmax_scale is None else softmax_scale
+    chunk = _config['chunk_size'] or max(
+        16, math.isqrt(CHUNKED_ATTENTION_BYTES // (4 * b * n)))
+    left, right = window_size
+    if causal:
+        right = 0
+
+    q = q.transpose(1, 2)
+    k = k.transpose(1, 2)
+    v = v.transpose(1, 2)
+    x = v.new_empty(b, n, lq, v.size(-1))
+    for q_start in range(0, lq, chunk):
+        q_end = min(q_start + chunk, lq)
+        qc = q[:, :, q_start:q_end].float() * scale
+
+        # keys inside the window of any query of the block
+        k_lo = 0 if left < 0 else max(0, q_start + lk - lq - left)
+        k_hi = lk if right < 0 else min(lk, q_end + lk - lq + right)
+
+        m = qc.new_full((b, n, q_end - q_start, 1), float('-inf'))
+        l = qc.new_zeros(b, n, q_end - q_start, 1)
+        acc = qc.new_zeros(b, n, q_end - q_start, v.size(-1))
+        for k_start in range(k_lo, k_hi, chunk):
+            k_end = min(k_start + chunk, k_hi)
+            attn = torch.matmul(
+                qc, k[:, :, k_start:k_end].float().transpose(-1, -2))
+            if attn_bias is not None:
+                attn = attn + attn_bias[..., q_start:q_end,
+                                        k_start:k_end].float()
+            mask = _local_mask(q_start, q_end, lq, lk, causal, window_size,
+                               q.device, k_start, k_end)
+            if mask is not None:
+                attn = attn.masked_fill(~mask, float('-inf'))
+
+            # online softmax, rows without a visible key yet keep m = -inf
+            m_new = torch.maximum(m, attn.amax(dim=-1, keepdim=True))
+            m_safe = m_new.masked_fill(m_new == float('-inf'), 0)
+            p = torch.exp(attn - m_safe)
+            correction = torch.exp(m - m_safe)
+            l = l * correction + p.sum(dim=-1, keepdim=True)
+            p = F.dropout(p, dropout_p)
+            acc = acc * correction + torch.matmul(
+                p, v[:, :, k_start:k_end].float())
+            m = m_new
+        # rows without any visible key are zero, as in flash attention
+        l = l.clamp_min(torch.finfo(l.dtype).tiny)
+        x[:, :, q_start:q_end] = (acc / l).type_as(x)
+    return x.transpose(1, 2)
+
+
+def _flash(version):
+
+    def fn(q, k, v, attn_bias=None, metadata=None, **kwargs):
+        return flash_attention(q, k, v, version=version, **kwargs)
+
+    return fn
+
+
+def _xformers_attention(q,
+                        k,
+                        v,
+                        q_lens=None,
+                        k_lens=None,
+                        cu_seqlens_q=None,
+                        cu_seqlens_k=None,
+                        dropout_p=0.,
+                        softmax_scale=None,
+                        dtype=torch.bfloat16,
+                        metadata=None,
+                        **kwargs):
+    out_dtype = q.dtype
+    q, k, v = (
+        u if u.dtype in (torch.float16, torch.bfloat16) else u.to(dtype)
+        for u in (q, k, v))
+    q, k = q.to(v.dtype), k.to(v.dtype)
+    if (q_lens is None and k_lens is None and cu_seqlens_q is None and
+            cu_seqlens_k is None):
+        x = xformers.ops.memory_efficient_attention(
+            q, k, v, p=dropout_p, scale=softmax_scale)
+        return x.type(out_dtype)
+
+    qs = _segments(q, q_lens, cu_seqlens_q, metadata)
+    ks = _segments(k, k_lens, cu_seqlens_k, metadata)
+    vs = _segments(v, k_lens, cu_seqlens_k, metadata)
+    attn_bias = xformers.ops.fmha.attn_bias.BlockDiagonalMask.from_seqlens(
+        [u.size(0) for u in qs], [u.size(0) for u in ks])
+    x = xformers.ops.memory_efficient_attention(
+        torch.cat(qs).unsqueeze(0),
+        torch.cat(ks).unsqueeze(0),
+        torch.cat(vs).unsqueeze(0),
+        attn_bias=attn_bias,
+        p=dropout_p,
+        scale=softmax_scale)[0]
+    x = list(x.split([u.size(0) for u in qs]))
+    return _merge(x, q, q_lens, cu_seqlens_q).type(out_dtype)
+
+
+def register_attention_backend(name, fn, supports=None):
+    r"""
+    Registers an attention backend. Without a configured backend, `attention`
+    uses the first registered one that supports its inputs.
+
+    Args:
+        name (`str`):
+            Backend name
+        fn (`callable`):
+            Called as fn(q, k, v, **kwargs) with the keyword arguments of
+            `attention`, returns the output in the layout of `flash_attention`
+        supports (`callable`, *optional*):
+            Called with the same arguments, returns False for inputs fn can not handle
+    """
+    _ATTENTION_BACKENDS[name] = (fn, supports or (lambda *args, **kwargs: True))
+
+
+def available_attention_backends():
+    return list(_ATTENTION_BACKENDS)
+
+
+def _flash_supports(q, k, v, attn_bias=None, **kwargs):
+    return q.device.type == 'cuda' and q.size(-1) <= 256 and attn_bias is None
+
+
+if FLASH_ATTN_3_AVAILABLE:
+    # Note: dropout_p, window_size are not supported in FA3 now.
+    register_attention_backend(
+        'flash3', _flash(3), lambda q, k, v, dropout_p=0., window_size=(
+            -1, -1), **kwargs: _flash_supports(q, k, v, **kwargs) and
+        dropout_p == 0 and tuple(window_size) == (-1, -1))
+if FLASH_ATTN_2_AVAILABLE:
+    register_attention_backend('flash2', _flash(2), _flash_supports)
+if XFORMERS_AVAILABLE:
+    register_attention_backend(
+        'xformers', _xformers_attention,
+        lambda q, k, v, causal=False, window_size=(-1, -1), **kwargs:
+        _flash_supports(q, k, v, **kwargs) and not causal and tuple(
+            window_size) == (-1, -1))
+
+
+def _sdpa_supports(q, k, v, window_size=(-1, -1), **kwargs):
+    # a local window would materialize an Lq x Lk mask
+    return tuple(window_size) == (-1, -1)
+
+
+def _scores_fit(q, k):
+    # the fp32 scores of all heads fit the budget of one chunked block
+    b, lq, n = q.shape[:3]
+    return 4 * b * n * lq * k.size(1) <= CHUNKED_ATTENTION_BYTES
+
+
+def _sdpa_cpu_supports(q, k, v, attn_bias=None, causal=False, **kwargs):
+    # CPU SDPA runs masked calls on the math path, which materializes the
+    # scores, so long masked sequences on CPU use the chunked backend
+    return _sdpa_supports(q, k, v, **kwargs) and (
+        q.device.type != 'cpu' or
+        (attn_bias is None and not causal) or _scores_fit(q, k))
+
+
+register_attention_backend('sdpa', _varlen(_sdpa()), _sdpa_cpu_supports)
+register_attention_backend(
+    'sdpa_efficient', _varlen(_sdpa([SDPBackend.EFFICIENT_ATTENTION])),
+    lambda q, k, v, **kwargs: q.device.type == 'cuda' and _sdpa_supports(
+        q, k, v, **kwargs))
+register_attention_backend(
+    'sdpa_math', _varlen(_sdpa([SDPBackend.MATH])),
+    lambda q, k, v, **kwargs: _sdpa_supports(q, k, v, **kwargs) and
+    (q.device.type != 'cpu' or _scores_fit(q, k)))
+register_attention_backend('chunked', _varlen(_chunked_attention))
+
+
+class AttentionAutotuner:
+    r"""
+    Benchmarks the backends that support an attention shape and remembers the
+    fastest one per (Lq, Lk, heads, dtype, device).
+
+    Args:
+        cache_file (`str`, *optional*):
+            JSON file with the choices of earlier runs, new choices are added to it.
+            Defaults to ~/.cache/wan/attention_backends.json
+        repeats (`int`, *optional*, defaults to 3):
+            Timed runs per backend after one warmup run
+    """
+
+    def __init__(self, cache_file=None, repeats=3):
+        self.cache_file = cache_file or os.path.expanduser(
+            '~/.cache/wan/attention_backends.json')
+        self.repeats = repeats
+        self.choices = {}
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                self.choices = json.load(f)
+
+    @staticmethod
+    def key(q,
+            k,
+            max_seqlen_q=None,
+            max_seqlen_k=None,
+            attn_bias=None,
+            causal=False,
+            window_size=(-1, -1),
+            **kwargs):
+        lq = q.size(1) if max_seqlen_q is None else max_seqlen_q
+        lk = k.size(1) if max_seqlen_k is None else max_seqlen_k
+        flags = [
+            name for name, on in (('bias', attn_bias is not None), (
+                'causal', causal), ('window', tuple(window_size) != (-1, -1)))
+            if on
+        ]
+        return ','.join([
+            q.device.type,
+            str(q.dtype).split('.')[-1], f'{q.size(2)}x{q.size(3)}', str(lq),
+            str(lk)
+        ] + flags)
+
+    def select(self, key, candidates, run, device):
+        r"""
+        Returns the fastest of the candidate backends for key, running them with
+        run(name) when there is no cached choice.
+        """
+        if self.choices.get(key) in candidates:
+            return self.choices[key]
+
+        def sync():
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+
+        timings, errors = {}, {}
+        for name in candidates:
+            try:
+                run(name)
+                sync()
+                start = time.perf_counter()
+                for _ in range(self.repeats):
+                    run(name)
+                sync()
+                timings[name] = (time.perf_counter() - start) / self.repeats
+            except (RuntimeError, NotImplementedError) as e:
+                logging.debug(f'Attention backend {name} failed on {key}: {e}')
+                errors[name] = e
+        if not timings:
+            raise RuntimeError(
+                f'All attention backends failed on {key}: ' +
+                '; '.join(f'{n}: {e}' for n, e in errors.items()))
+        name = min(timings, key=timings.get)
+        logging.info(f'Attention autotuner chose {name} for {key} (' +
+                     ', '.join(f'{n}: {t * 1e3:.2f} ms'
+                               for n, t in timings.items()) + ').')
+        self.choices[key] = name
+        self.save()
+        return name
+
+    def save(self):
+        os.makedirs(
+            os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+        tmp = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.choices, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.cache_file)
+
+
+def set_attention_backend(name=None, cache_file=None, chunk_size=None):
+    r"""
+    Selects the backend `attention` runs on.
+
+    Args:
+        name (`str`, *optional*):
+            A registered backend, 'auto' to benchmark the supported backends per
+            shape, or None for the first registered backend supporting the inputs
+        cache_file (`str`, *optional*):
+            JSON file the autotuner persists its choices to
+        chunk_size (`int`, *optional*):
+            Queries and keys per block of the chunked backend, by default derived
+            from `CHUNKED_ATTENTION_BYTES`
+    """
+    _config.update(chunk_size=chunk_size)
+    if name == 'auto':
+        _config.update(backend=None, autotuner=AttentionAutotuner(cache_file))
+    else:
+        assert name is None or name in _ATTENTION_BACKENDS, \
+            f'Unsupported attention backend: {name}'
+        _config.update(backend=name, autotuner=None)
+
+
 def attention(
     q,
     k,
@@ -144,36 +740,230 @@ def attention(
     deterministic=False,
     dtype=torch.bfloat16,
     fa_version=None,
+    cu_seqlens_q=None,
+    cu_seqlens_k=None,
+    max_seqlen_q=None,
+    max_seqlen_k=None,
+    attn_bias=None,
+    backend=None,
+    metadata=None,
 ):
-    if FLASH_ATTN_2_AVAILABLE or FLASH_ATTN_3_AVAILABLE:
-        return flash_attention(
-            q=q,
-            k=k,
-            v=v,
-            q_lens=q_lens,
-            k_lens=k_lens,
-            dropout_p=dropout_p,
-            softmax_scale=softmax_scale,
-            q_scale=q_scale,
-            causal=causal,
-            window_size=window_size,
-            deterministic=deterministic,
-            dtype=dtype,
-            version=fa_version,
+    """
+    Dispatches to an attention backend, see `flash_attention` for the arguments.
+
+    attn_bias:      [B or 1, N or 1, Lq, Lk]. Additive bias, not supported by flash attention.
+    fa_version:     int. 2 excludes flash attention 3.
+    backend:        str. Backend to use instead of the configured one, if it supports the inputs.
+    metadata:       AttentionMetadata. Host copies of the cu_seqlens it owns, avoids device syncs.
+    """
+    if q_scale is not None:
+        q = q * q_scale
+    kwargs = dict(
+        q_lens=q_lens,
+        k_lens=k_lens,
+        cu_seqlens_q=cu_seqlens_q,
+        cu_seqlens_k=cu_seqlens_k,
+        max_seqlen_q=max_seqlen_q,
+        max_seqlen_k=max_seqlen_k,
+        attn_bias=attn_bias,
+        dropout_p=dropout_p,
+        softmax_scale=softmax_scale,
+        causal=causal,
+        window_size=window_size,
+        deterministic=deterministic,
+        dtype=dtype,
+        metadata=metadata)
+    candidates = [
+        name for name, (_, supports) in _ATTENTION_BACKENDS.items()
+        if not (name == 'flash3' and fa_version == 2) and
+        supports(q, k, v, **kwargs)
+    ]
+
+    name = backend or _config['backend']
+    if name is not None and name not in candidates:
+        warnings.warn(
+            f'Attention backend {name} does not support these inputs, use {candidates[0]} instead.'
         )
-    else:
-        if q_lens is not None or k_lens is not None:
-            warnings.warn(
-                'Padding mask is disabled when using scaled_dot_product_attention. It can have a significant impact on performance.'
-            )
-        attn_mask = None
+        name = None
+    if name is None:
+        name = candidates[0]
+        if _config['autotuner'] is not None and len(candidates) > 1:
+            name = _config['autotuner'].select(
+                AttentionAutotuner.key(q, k, **kwargs), candidates,
+                lambda name: _ATTENTION_BACKENDS[name][0](q, k, v, **kwargs),
+                q.device)
+    return _ATTENTION_BACKENDS[name][0](q, k, v, **kwargs)
+
+
+def _tile_attention(q, k, v, grid_size, window_size, tile_size):
+    r"""
+    Sliding tile attention of one sequence of shape [L, N, C] on its (F, H, W)
+    token grid. Each query tile attends to the block of 2 * ceil(window / tile)
+    + 1 tiles around it along every axis, shifted inwards at the borders so
+    every tile sees the same number of keys.
+    """
+    l, n, c = q.shape
+    tile = [max(1, min(t, g)) for t, g in zip(tile_size, grid_size)]
+    num = [-(-g // t) for g, t in zip(grid_size, tile)]
+    span = [
+        min(m, 2 * -(-w // t) + 1) for m, w, t in zip(num, window_size, tile)
+    ]
+
+    def to_tiles(x):
+        # [F, H, W, ...] -> [nF * nH * nW, T, ...] with the grid padded to whole tiles
+        pad = []
+        for g, t, m in zip(grid_size[::-1], tile[::-1], num[::-1]):
+            pad += [0, m * t - g]
+        x = F.pad(x.movedim((0, 1, 2), (-3, -2, -1)),
+                  pad).movedim((-3, -2, -1), (0, 1, 2))
+        x = x.view(num[0], tile[0], num[1], tile[1], num[2], tile[2],
+                   *x.shape[3:])
+        return x.permute(0, 2, 4, 1, 3, 5, *range(6, x.dim())).flatten(
+            3, 5).flatten(0, 2)
+
+    # flat indices of the neighbor tiles of every tile, [nF * nH * nW, K]
+    index = [(torch.arange(m, device=q.device) - s // 2).clamp(0, m - s)
+             .unsqueeze(1) + torch.arange(s, device=q.device)
+             for m, s in zip(num, span)]
+    index = (index[0].view(-1, 1, 1, span[0], 1, 1) * num[1] +
+             index[1].view(1, -1, 1, 1, span[1], 1)) * num[2] + index[2].view(
+                 1, 1, -1, 1, 1, span[2])
+    index = index.flatten(3, 5).flatten(0, 2)
+
+    valid = to_tiles(q.new_ones(grid_size, dtype=torch.uint8)).bool()
+    q = to_tiles(q.view(*grid_size, n, c))
+    k = to_tiles(k.view(*grid_size, n, c))
+    v = to_tiles(v.view(*grid_size, n, v.size(-1)))
+
+    # query tiles per pass within the budget of the gathered keys and scores
+    keys = index.size(1) * q.size(1)
+    chunk = max(
+        1, CHUNKED_ATTENTION_BYTES //
+        (keys * n * max(2 * (c + v.size(-1)), 4 * q.size(1))))
+    x = v.new_empty(q.shape[:3] + (v.size(-1),))
+    for start in range(0, index.size(0), chunk):
+        i = index[start:start + chunk]
+        mask = None
+        if not valid.all():
+            mask = valid[i].flatten(1, 2).view(i.size(0), 1, 1, keys)
+        x[start:start + chunk] = F.scaled_dot_product_attention(
+            q[start:start + chunk].transpose(1, 2),
+            k[i].flatten(1, 2).transpose(1, 2),
+            v[i].flatten(1, 2).transpose(1, 2),
+            attn_mask=mask).transpose(1, 2)
 
-        q = q.transpose(1, 2).to(dtype)
-        k = k.transpose(1, 2).to(dtype)
-        v = v.transpose(1, 2).to(dtype)
+    # [nF * nH * nW, T, N, C] -> [L, N, C]
+    x = x.view(*num, *tile, n, -1).permute(0, 3, 1, 4, 2, 5, 6, 7)
+    x = x.reshape(num[0] * tile[0], num[1] * tile[1], num[2] * tile[2], n, -1)
+    return x[:grid_size[0], :grid_size[1], :grid_size[2]].flatten(0, 2)
 
-        out = torch.nn.functional.scaled_dot_product_attention(
-            q, k, v, attn_mask=attn_mask, is_causal=causal, dropout_p=dropout_p)
 
-        out = out.transpose(1, 2).contiguous()
-        return out
+def local_attention_3d(q,
+                       k,
+                       v,
+                       grid_sizes,
+                       window_size,
+                       tile_size=(4, 8, 8),
+                       seq_lens=None,
+                       cu_seqlens=None,
+                       metadata=None):
+    r"""
+    Block-sparse spatio-temporal neighborhood attention. The cost grows
+    linearly with the number of tokens instead of quadratically.
+
+    Args:
+        q, k, v (Tensor):
+            Shape [B, L, N, C], or [1, sum(L), N, C] with cu_seqlens
+        grid_sizes (Tensor):
+            Shape [B, 3], the (F, H, W) token grid of each sequence
+        window_size (Tuple[`int`]):
+            (F, H, W) radius of the neighborhood in tokens, rounded up to whole tiles
+            and shifted inwards at the borders of the grid
+        tile_size (Tuple[`int`], *optional*, defaults to (4, 8, 8)):
+            (F, H, W) size of the tiles the grid is split into
+        seq_lens (Tensor, *optional*):
+            Shape [B], valid tokens of each padded sequence, padded query rows are zero
+        cu_seqlens (Tensor, *optional*):
+            Shape [B + 1], cumulative lengths of packed sequences
+        metadata (AttentionMetadata, *optional*):
+            Layout of the forward, provides host copies of cu_seqlens
+    """
+    out_dtype = q.dtype
+    q, k = q.to(v.dtype), k.to(v.dtype)
+    if seq_lens is None and cu_seqlens is None:
+        seq_lens = grid_sizes.prod(dim=1)
+    out = []
+    for qi, ki, vi, grid in zip(
+            _segments(q, seq_lens, cu_seqlens, metadata),
+            _segments(k, seq_lens, cu_seqlens, metadata),
+            _segments(v, seq_lens, cu_seqlens, metadata), grid_sizes.tolist()):
+        assert qi.size(0) == math.prod(grid)
+        out.append(_tile_attention(qi, ki, vi, grid, window_size, tile_size))
+    return _merge(out, q, seq_lens, cu_seqlens).type(out_dtype)
+
+
+def headwise_sparse_attention(q,
+                              k,
+                              v,
+                              grid_sizes,
+                              head_types,
+                              seq_lens=None,
+                              cu_seqlens=None,
+                              metadata=None):
+    r"""
+    Attention with a fixed sparsity pattern per head. 'spatial' heads only
+    attend within their frame, 'temporal' heads only to the same (H, W)
+    position in the other frames and 'dense' heads to the whole sequence.
+
+    Args:
+        q, k, v (Tensor):
+            Shape [B, L, N, C], or [1, sum(L), N, C] with cu_seqlens
+        grid_sizes (Tensor):
+            Shape [B, 3], the (F, H, W) token grid of each sequence
+        head_types (List[`str`]):
+            'dense', 'spatial' or 'temporal' for each of the N heads
+        seq_lens (Tensor, *optional*):
+            Shape [B], valid tokens of each padded sequence, padded query rows are zero
+        cu_seqlens (Tensor, *optional*):
+            Shape [B + 1], cumulative lengths of packed sequences
+        metadata (AttentionMetadata, *optional*):
+            Layout of the forward, provides host copies of cu_seqlens
+    """
+    assert len(head_types) == q.size(2)
+    out_dtype = q.dtype
+    q, k = q.to(v.dtype), k.to(v.dtype)
+    if seq_lens is None and cu_seqlens is None:
+        seq_lens = grid_sizes.prod(dim=1)
+    groups = {}
+    for i, kind in enumerate(head_types):
+        groups.setdefault(kind, []).append(i)
+    groups = {
+        kind: torch.tensor(heads, device=q.device)
+        for kind, heads in groups.items()
+    }
+
+    out = []
+    for qi, ki, vi, (f, h, w) in zip(
+            _segments(q, seq_lens, cu_seqlens, metadata),
+            _segments(k, seq_lens, cu_seqlens, metadata),
+            _segments(v, seq_lens, cu_seqlens, metadata), grid_sizes.tolist()):
+        assert qi.size(0) == f * h * w
+        x = vi.new_empty(vi.shape)
+        for kind, heads in groups.items():
+            qs, ks, vs = (u.index_select(1, heads) for u in (qi, ki, vi))
+            if kind == 'dense':
+                y = attention(qs[None], ks[None], vs[None])[0]
+            elif kind == 'spatial':
+                # one sequence per frame
+                y = attention(*(u.unflatten(0, (f, h * w))
+                                for u in (qs, ks, vs))).flatten(0, 1)
+            elif kind == 'temporal':
+                # one sequence per (H, W) position
+                y = attention(*(u.unflatten(0, (f, h * w)).transpose(0, 1)
+                                for u in (qs, ks, vs)))
+                y = y.transpose(0, 1).flatten(0, 1)
+            else:
+                raise ValueError(f'Unsupported head type: {kind}')
+            x.index_copy_(1, heads, y.type_as(x))
+        out.append(x)
+    return _merge(out, q, seq_lens, cu_seqlens).type(out_dtype)
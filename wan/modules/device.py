@@ -0,0 +1,156 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+import os
+
+import torch
+
+__all__ = [
+    'get_device',
+    'empty_cache',
+    'synchronize',
+    'autocast',
+    'numa_nodes',
+    'configure_cpu',
+]
+
+NUMA_ROOT = '/sys/devices/system/node'
+
+
+def get_device(device):
+    r"""
+    Device of a pipeline. An int is the index of a CUDA device, as the
+    `device_id` the pipelines have always taken, anything else is passed to
+    `torch.device`, e.g. 'cpu'.
+    """
+    if isinstance(device, int):
+        return torch.device(f'cuda:{device}')
+    return torch.device(device)
+
+
+def empty_cache(device):
+    r"""
+    Returns the cached blocks of the CUDA allocator, a no-op on CPU.
+    """
+    if torch.device(device).type == 'cuda':
+        torch.cuda.empty_cache()
+
+
+def synchronize(device):
+    r"""
+    Waits for the queued kernels of device, a no-op on CPU where they run
+    synchronously.
+    """
+    device = torch.device(device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def autocast(device, dtype, enabled=True):
+    r"""
+    `torch.autocast` for the type of device. CPU autocast only has reduced
+    precision dtypes, so a float32 region on CPU disables autocast instead,
+    which runs the float32 weights as they are, the same as CUDA autocast to
+    float32 does.
+
+    Args:
+        device (`torch.device` or `str`):
+            Device the region runs on
+        dtype (`torch.dtype`):
+            Autocast dtype of the region
+        enabled (`bool`, *optional*, defaults to True):
+            Whether autocast is enabled
+    """
+    device = torch.device(device)
+    if device.type == 'cpu' and dtype not in (torch.bfloat16, torch.float16):
+        enabled = False
+    return torch.autocast(device.type, dtype=dtype, enabled=enabled)
+
+
+def _cpulist(text):
+    r"""
+    Set of CPUs of a sysfs list such as '0-3,8-11'.
+    """
+    cpus = set()
+    for part in text.strip().split(','):
+        if part:
+            lo, _, hi = part.partition('-')
+            cpus.update(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+
+def _physical_cores(cpus):
+    r"""
+    One logical CPU per physical core among cpus.
+    """
+    cores = set()
+    for cpu in cpus:
+        try:
+            with open(f'/sys/devices/system/cpu/cpu{cpu}/topology/'
+                      'thread_siblings_list') as f:
+                siblings = _cpulist(f.read()) & cpus
+        except OSError:
+            siblings = set()
+        cores.add(min(siblings or {cpu}))
+    return cores
+
+
+def numa_nodes():
+    r"""
+    CPUs of every NUMA node of the host, ordered by node id. Hosts that do not
+    expose their topology are a single node of all CPUs of the process.
+    """
+    nodes = []
+    if os.path.isdir(NUMA_ROOT):
+        names = [
+            u for u in os.listdir(NUMA_ROOT)
+            if u.startswith('node') and u[4:].isdigit()
+        ]
+        for name in sorted(names, key=lambda u: int(u[4:])):
+            with open(os.path.join(NUMA_ROOT, name, 'cpulist')) as f:
+                cpus = _cpulist(f.read())
+            # memory-only nodes have no CPUs
+            if cpus:
+                nodes.append(cpus)
+    return nodes or [set(os.sched_getaffinity(0))]
+
+
+def configure_cpu(threads=None, interop_threads=None, numa_node=None):
+    r"""
+    Tunes the process for CPU inference. Pinning it to the CPUs of one NUMA
+    node keeps its threads from migrating between sockets and, with the
+    default first-touch policy, allocates the weights and activations in the
+    memory local to them. The intra-op threads default to one per physical
+    core, since hyperthreads of a core share its matmul units.
+
+    Must be called before the first parallel op, the thread pools keep the
+    affinity they were created with.
+
+    Args:
+        threads (`int`, *optional*):
+            Intra-op threads, by default the physical cores the process runs on
+        interop_threads (`int`, *optional*):
+            Inter-op threads, PyTorch's default if None
+        numa_node (`int`, *optional*):
+            Node to pin the process to, modulo the number of nodes so that the
+            local rank can be passed. None keeps the current affinity
+
+    Returns:
+        `dict`: The applied threads, interop_threads and cpus
+    """
+    cpus = set(os.sched_getaffinity(0))
+    if numa_node is not None:
+        nodes = numa_nodes()
+        cpus = nodes[numa_node % len(nodes)]
+        os.sched_setaffinity(0, cpus)
+    threads = threads or len(_physical_cores(cpus))
+    torch.set_num_threads(threads)
+    if interop_threads is not None:
+        torch.set_num_interop_threads(interop_threads)
+    config = dict(
+        threads=threads,
+        interop_threads=torch.get_num_interop_threads(),
+        cpus=sorted(cpus))
+    logging.info(
+        f"CPU inference on {len(cpus)} CPUs with {config['threads']} intra-op "
+        f"and {config['interop_threads']} inter-op threads.")
+    return config
@@ -0,0 +1,607 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import json
+import logging
+import os
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.export import Dim
+
+from . import fused_ops
+from .fused_ops import qk_rms_norm, set_fused_ops_backend
+from .model import (
+    T5_CONTEXT_TOKEN_NUMBER,
+    WanI2VCrossAttention,
+    WanModel,
+    sinusoidal_embedding_1d,
+)
+from .vace_model import VaceWanModel
+from .vae import count_conv3d
+
+try:
+    import onnxruntime as ort
+    ORT_AVAILABLE = True
+except ModuleNotFoundError:
+    ORT_AVAILABLE = False
+
+__all__ = [
+    'export_dit',
+    'export_vae',
+    'WanExportedModel',
+    'WanExportedVAE',
+    'use_exported',
+]
+
+EXPORT_FORMATS = ('onnx', 'pt2')
+
+# frames of a video per encoder chunk after the first one, see `WanVAE_.encode`
+_ENCODER_CHUNK = 4
+
+
+def _rope(x, cos, sin):
+    x0, x1 = x.float().unflatten(-1, (-1, 2)).unbind(-1)
+    out = torch.stack([x0 * cos - x1 * sin, x0 * sin + x1 * cos], dim=-1)
+    return out.flatten(3).type_as(x)
+
+
+def _attention(q, k, v):
+    r"""
+    Dense attention of q, k, v of shape [B, L, num_heads, C / num_heads].
+    """
+    return F.scaled_dot_product_attention(
+        q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)).transpose(1, 2)
+
+
+class _DiTStep(nn.Module):
+    r"""
+    One denoising forward of a WanModel on same-shaped samples, written with
+    static control flow and plain tensor inputs so that it can be exported.
+    Without padding, varlen attention and host-side metadata the token count
+    F * H * W / prod(patch_size) is a symbolic dimension of the graph.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        assert isinstance(model, WanModel) and not isinstance(
+            model, VaceWanModel), 'Only t2v, i2v and flf2v models are exported.'
+        self.model = model
+        c = model.dim // model.num_heads // 2
+        self.splits = [c - 2 * (c // 3), c // 3, c // 3]
+
+        # real tables instead of the complex ones of `WanRotaryEmbedding`
+        freqs = model.rope.freqs
+        self.register_buffer('cos', freqs.real.float(), persistent=False)
+        self.register_buffer('sin', freqs.imag.float(), persistent=False)
+
+    def rope(self, f, h, w):
+        tables = []
+        for u in (self.cos, self.sin):
+            uf, uh, uw = u.split(self.splits, dim=1)
+            tables.append(
+                torch.cat([
+                    uf[:f].view(f, 1, 1, -1).expand(f, h, w, -1),
+                    uh[:h].view(1, h, 1, -1).expand(f, h, w, -1),
+                    uw[:w].view(1, 1, w, -1).expand(f, h, w, -1)
+                ],
+                          dim=-1).reshape(1, f * h * w, 1, -1))
+        return tables
+
+    def self_attn(self, attn, x, freqs):
+        b, s, n, d = *x.shape[:2], attn.num_heads, attn.head_dim
+        q, k, v = attn.project_qkv(x)
+        if attn.qk_norm:
+            q, k = qk_rms_norm(q, k, attn.norm_q.weight, attn.norm_k.weight,
+                               attn.eps)
+        q, k, v = (u.view(b, s, n, d) for u in (q, k, v))
+        x = _attention(_rope(q, *freqs), _rope(k, *freqs), v)
+        return attn.o(x.flatten(2))
+
+    def cross_attn(self, attn, x, context):
+        b, n, d = x.size(0), attn.num_heads, attn.head_dim
+        if isinstance(attn, WanI2VCrossAttention):
+            context_img = context[:, :-T5_CONTEXT_TOKEN_NUMBER]
+            context = context[:, -T5_CONTEXT_TOKEN_NUMBER:]
+        q = attn.norm_q(attn.q(x)).view(b, -1, n, d)
+        k, v = attn.project_kv(context)
+        x = _attention(q,
+                       attn.norm_k(k).view(b, -1, n, d), v.view(b, -1, n, d))
+        if isinstance(attn, WanI2VCrossAttention):
+            k_img, v_img = attn.project_kv_img(context_img)
+            x = x + _attention(q,
+                               attn.norm_k_img(k_img).view(b, -1, n, d),
+                               v_img.view(b, -1, n, d))
+        return attn.o(x.flatten(2))
+
+    def block(self, block, x, e0, freqs, context):
+        e = (block.modulation.to(block.precision.modulation) + e0).chunk(
+            6, dim=1)
+        y = self.self_attn(block.self_attn,
+                           block.self_attn_input(x, e[0], e[1]), freqs)
+        x = block.residual(x, y, e[2])
+        x = x + self.cross_attn(block.cross_attn, block.norm3(x), context)
+        return block.ffn_residual(x, *e[3:])
+
+    def forward(self, x, t, context, clip_fea=None, y=None):
+        r"""
+        Args:
+            x (Tensor): Latents of shape [B, C_in, F, H, W]
+            t (Tensor): Timesteps of shape [B]
+            context (Tensor): Text embeddings padded to [B, text_len, C]
+            clip_fea (Tensor, *optional*): CLIP features of i2v and flf2v models
+            y (Tensor, *optional*): Conditional video of i2v and flf2v models, [B, C_y, F, H, W]
+
+        Returns:
+            Tensor: Prediction of shape [B, C_out, F, H, W]
+        """
+        model = self.model
+        if y is not None:
+            x = torch.cat([x, y], dim=1)
+
+        # embeddings
+        x = model.patch_embedding(x)
+        b, f, h, w = x.size(0), *x.shape[2:]
+        x = x.flatten(2).transpose(1, 2)
+        freqs = self.rope(f, h, w)
+
+        # time embeddings
+        e = model.time_embedding(
+            sinusoidal_embedding_1d(model.freq_dim, t).float())
+        e0 = model.time_projection(e).unflatten(1, (6, model.dim))
+        e, e0 = e.to(model.precision.modulation), e0.to(
+            model.precision.modulation)
+
+        # context
+        context = model.text_embedding(context)
+        if clip_fea is not None:
+            context_clip = model.img_emb(clip_fea).expand(b, -1, -1)
+            context = torch.cat([context_clip, context], dim=1)
+
+        for block in model.blocks:
+            x = self.block(block, x, e0, freqs, context)
+
+        # head
+        head = model.head
+        shift, scale = (head.modulation.to(head.precision.modulation) +
+                        e.unsqueeze(1)).chunk(2, dim=1)
+        x = head.project(x, shift, scale)
+
+        # unpatchify
+        c = model.out_dim
+        pf, ph, pw = model.patch_size
+        x = x.view(b, f, h, w, pf, ph, pw, c).permute(0, 7, 1, 4, 2, 5, 3, 6)
+        return x.reshape(b, c, f * pf, h * ph, w * pw)
+
+
+class _VAEChunk(nn.Module):
+    r"""
+    One causal chunk of the `Encoder3d` or `Decoder3d` of a WanVAE, with the
+    feature cache of the causal convolutions as explicit state.
+
+    The state is the cache of a chunk in steady state, zeros before the first
+    one. The first chunk of a video runs without temporal up- or downsampling
+    and is exported separately, it reads the zero state only for its shapes.
+
+    Args:
+        vae (WanVAE):
+            VAE whose encoder or decoder is run
+        part (`str`):
+            'encoder' or 'decoder'
+        slots (List[`int`]):
+            Indices of the feature cache entries the state holds
+        frames (List[`int`]):
+            Frames of each state tensor
+        first (`bool`):
+            Whether this is the first chunk of a video
+    """
+
+    def __init__(self, vae, part, slots, frames, first):
+        super().__init__()
+        assert part in ('encoder', 'decoder')
+        self.part = part
+        self.net = getattr(vae.model, part)
+        self.conv = vae.model.conv1 if part == 'encoder' else vae.model.conv2
+        self.num_slots = count_conv3d(self.net)
+        self.slots = slots
+        self.frames = frames
+        self.first = first
+        self.register_buffer('mean', vae.scale[0].view(1, -1, 1, 1, 1).float())
+        self.register_buffer('inv_std',
+                             vae.scale[1].view(1, -1, 1, 1, 1).float())
+
+    def forward(self, x, state):
+        feat_cache = [None] * self.num_slots
+        if not self.first:
+            for slot, u in zip(self.slots, state):
+                feat_cache[slot] = u
+
+        if self.part == 'encoder':
+            out = self.net(x, feat_cache=feat_cache, feat_idx=[0])
+            mu = self.conv(out).chunk(2, dim=1)[0]
+            out = (mu - self.mean) * self.inv_std
+        else:
+            x = self.conv(x / self.inv_std + self.mean)
+            out = self.net(x, feat_cache=feat_cache, feat_idx=[0])
+
+        next_state = []
+        for i, (slot, frames) in enumerate(zip(self.slots, self.frames)):
+            u = feat_cache[slot]
+            if isinstance(u, str):
+                # an upsampling that had no frame to cache yet
+                u = state[i].clone()
+            elif u.size(2) < frames:
+                u = torch.cat([state[i][:, :, :frames - u.size(2)], u], dim=2)
+            next_state.append(u)
+        return (out, *next_state)
+
+
+@contextmanager
+def _reference_ops():
+    # the Triton kernels and inductor graphs of the fused ops do not export
+    backend = fused_ops._config['backend']
+    set_fused_ops_backend('reference')
+    try:
+        yield
+    finally:
+        set_fused_ops_backend(backend)
+
+
+@torch.no_grad()
+def _export(module, args, dynamic_shapes, path, input_names, output_names):
+    module.eval()
+    with _reference_ops():
+        if path.endswith('.onnx'):
+            torch.onnx.export(
+                module,
+                args,
+                path,
+                input_names=input_names,
+                output_names=output_names,
+                dynamic_shapes=dynamic_shapes,
+                dynamo=True,
+                external_data=True)
+        else:
+            program = torch.export.export(
+                module, args, dynamic_shapes=dynamic_shapes)
+            torch.export.save(program, path)
+    logging.info(f'Exported {path}.')
+
+
+def _spatial(h, w, ratio=1):
+    return {3: h if ratio == 1 else ratio * h, 4: w if ratio == 1 else ratio * w}
+
+
+def export_dit(model, export_dir, format='onnx'):
+    r"""
+    Exports the per-step forward of a DiT with dynamic batch size, frames,
+    height and width, and writes `dit.json` describing its inputs. The graph
+    runs dense SDPA attention, so it needs no CUDA kernels.
+
+    Args:
+        model (WanModel):
+            t2v, i2v or flf2v model, with float32 weights for CPU runtimes
+        export_dir (`str`):
+            Output directory
+        format (`str`, *optional*, defaults to 'onnx'):
+            'onnx' or 'pt2' for a `torch.export` program
+
+    Returns:
+        `str`: Path of the artifact
+    """
+    assert format in EXPORT_FORMATS, f'Unsupported export format: {format}'
+    os.makedirs(export_dir, exist_ok=True)
+    step = _DiTStep(model)
+    device = model.patch_embedding.weight.device
+    dtype = model.patch_embedding.weight.dtype
+    pf, ph, pw = model.patch_size
+    y_dim = model.in_dim - model.out_dim
+    clip_batch = 2 if model.model_type == 'flf2v' else 1
+
+    # examples with two samples and two patches per dimension
+    args = [
+        torch.randn(2, model.out_dim, 2 * pf, 2 * ph, 2 * pw, dtype=dtype),
+        torch.full((2,), 500., dtype=torch.float32),
+        torch.randn(2, model.text_len, model.text_dim, dtype=dtype)
+    ]
+    names = ['x', 't', 'context']
+    if y_dim > 0:
+        args += [
+            torch.randn(clip_batch, 257, 1280, dtype=dtype),
+            torch.randn(2, y_dim, *args[0].shape[2:], dtype=dtype)
+        ]
+        names += ['clip_fea', 'y']
+    args = tuple(u.to(device) for u in args)
+
+    batch = Dim('batch', min=1, max=64)
+    frames = Dim('frames', min=1, max=1024)
+    height, width = Dim('height', min=1, max=1024), Dim('width', min=1, max=1024)
+    video = {
+        0: batch,
+        2: frames if pf == 1 else pf * frames,
+        3: height if ph == 1 else ph * height,
+        4: width if pw == 1 else pw * width
+    }
+    shapes = dict(x=video, t={0: batch}, context={0: batch})
+    if y_dim > 0:
+        shapes.update(clip_fea=None, y=video)
+
+    path = os.path.join(export_dir, f'dit.{format}')
+    _export(step, args, shapes, path, names, ['noise'])
+    with open(os.path.join(export_dir, 'dit.json'), 'w') as f:
+        json.dump(
+            dict(
+                file=os.path.basename(path),
+                model_type=model.model_type,
+                inputs=names,
+                text_len=model.text_len,
+                clip_batch=clip_batch), f)
+    return path
+
+
+@torch.no_grad()
+def _cache_spec(vae, part, chunks):
+    r"""
+    Runs chunks of a video or latent through the eager encoder or decoder and
+    returns the used feature cache slots with their steady-state tensors.
+    """
+    net = getattr(vae.model, part)
+    feat_cache = [None] * count_conv3d(net)
+    for x in chunks:
+        if part == 'encoder':
+            net(x, feat_cache=feat_cache, feat_idx=[0])
+        else:
+            net(vae.model.conv2(x), feat_cache=feat_cache, feat_idx=[0])
+    slots = [i for i, u in enumerate(feat_cache) if u is not None]
+    assert all(isinstance(feat_cache[i], torch.Tensor) for i in slots)
+    return slots, [feat_cache[i] for i in slots]
+
+
+def export_vae(vae, export_dir, format='onnx'):
+    r"""
+    Exports the first and the following causal chunks of the VAE encoder and
+    decoder, with dynamic height and width and the feature cache as explicit
+    state inputs and outputs, and writes `vae.json` describing the state.
+
+    A video is encoded as its first frame followed by chunks of 4 frames and
+    decoded one latent frame at a time, like `WanVAE`. The latent scaling is
+    part of the graphs.
+
+    Args:
+        vae (WanVAE):
+            VAE with float32 weights
+        export_dir (`str`):
+            Output directory
+        format (`str`, *optional*, defaults to 'onnx'):
+            'onnx' or 'pt2' for `torch.export` programs
+
+    Returns:
+        List[`str`]: Paths of the artifacts
+    """
+    assert format in EXPORT_FORMATS, f'Unsupported export format: {format}'
+    os.makedirs(export_dir, exist_ok=True)
+    device = vae.mean.device
+    z_dim = vae.model.z_dim
+    h = w = 4
+    scale = 2**(len(vae.model.dim_mult) - 1)
+    video = torch.randn(
+        1, 3, 1 + _ENCODER_CHUNK, h * scale, w * scale, device=device)
+    latent = torch.randn(1, z_dim, 2, h, w, device=device)
+    inputs = dict(
+        encoder=(video[:, :, :1], video[:, :, 1:]),
+        decoder=(latent[:, :, :1], latent[:, :, 1:]))
+
+    height, width = Dim('height', min=2, max=512), Dim('width', min=2, max=512)
+    meta = dict(z_dim=z_dim, scale=scale, chunk=_ENCODER_CHUNK)
+    paths = []
+    for part, chunks in inputs.items():
+        slots, tensors = _cache_spec(vae, part, chunks)
+        frames = [u.size(2) for u in tensors]
+        ratios = [u.size(3) // h for u in tensors]
+        assert all(u.size(3) == r * h and u.size(4) == r * w
+                   for u, r in zip(tensors, ratios))
+        state = [
+            [u.size(1), n, r] for u, n, r in zip(tensors, frames, ratios)
+        ]
+        names = ['x'] + [f'state_{i}' for i in range(len(slots))]
+        output_names = ['out'] + [f'next_state_{i}' for i in range(len(slots))]
+        shapes = dict(
+            x=_spatial(height, width, scale if part == 'encoder' else 1),
+            state=[_spatial(height, width, r) for r in ratios])
+        meta[part] = dict(inputs=names, state=state)
+        for first, x, example in ((True, chunks[0],
+                                   [torch.zeros_like(u) for u in tensors]),
+                                  (False, chunks[1], tensors)):
+            name = f"vae_{part}_{'first' if first else 'step'}"
+            path = os.path.join(export_dir, f'{name}.{format}')
+            _export(
+                _VAEChunk(vae, part, slots, frames, first), (x, example),
+                shapes, path, names, output_names)
+            meta[part]['first' if first else 'step'] = os.path.basename(path)
+            paths.append(path)
+    with open(os.path.join(export_dir, 'vae.json'), 'w') as f:
+        json.dump(meta, f)
+    return paths
+
+
+class _Runtime:
+    r"""
+    Runs an exported graph, ONNX through onnxruntime on CPU and `torch.export`
+    programs in PyTorch.
+
+    Args:
+        path (`str`):
+            Path of a .onnx or .pt2 artifact
+        input_names (List[`str`]):
+            Names of the flattened inputs of the graph
+        threads (`int`, *optional*):
+            Intra-op threads of the onnxruntime session
+    """
+
+    def __init__(self, path, input_names, threads=None):
+        self.input_names = input_names
+        self.module = self.session = None
+        if path.endswith('.onnx'):
+            assert ORT_AVAILABLE, 'onnxruntime is required to run ONNX graphs.'
+            options = ort.SessionOptions()
+            if threads is not None:
+                options.intra_op_num_threads = threads
+            self.session = ort.InferenceSession(
+                path, options, providers=['CPUExecutionProvider'])
+            # inputs the graph does not read are dropped by the exporter
+            self.feeds = {u.name for u in self.session.get_inputs()}
+        else:
+            self.module = torch.export.load(path).module()
+
+    @torch.no_grad()
+    def __call__(self, *args):
+        if self.module is not None:
+            out = self.module(*args)
+            return list(out) if isinstance(out, (list, tuple)) else [out]
+        flat = [
+            v for u in args for v in (u if isinstance(u, (list, tuple)) else [u])
+        ]
+        feeds = {
+            name: u.detach().cpu().contiguous().numpy()
+            for name, u in zip(self.input_names, flat)
+            if name in self.feeds
+        }
+        return [torch.from_numpy(u) for u in self.session.run(None, feeds)]
+
+
+class WanExportedModel(nn.Module):
+    r"""
+    Stand-in for the WanModel of a pipeline that runs the graph written by
+    `export_dit`. It takes the arguments of `WanModel.forward`; the caches and
+    the session only apply to the eager model and are ignored.
+
+    Args:
+        export_dir (`str`):
+            Directory of `dit.json` and the artifact
+        threads (`int`, *optional*):
+            Intra-op threads of the onnxruntime session
+    """
+
+    def __init__(self, export_dir, threads=None):
+        super().__init__()
+        with open(os.path.join(export_dir, 'dit.json')) as f:
+            self.meta = json.load(f)
+        self.model_type = self.meta['model_type']
+        self.runtime = _Runtime(
+            os.path.join(export_dir, self.meta['file']), self.meta['inputs'],
+            threads)
+
+    def forward(self,
+                x,
+                t,
+                context,
+                seq_len=None,
+                clip_fea=None,
+                y=None,
+                **kwargs):
+        assert len({u.shape for u in x}) == 1, \
+            'Exported models take samples of one shape.'
+        device = x[0].device
+        text_len = self.meta['text_len']
+        args = [
+            torch.stack(x).float().cpu(),
+            t.float().cpu().expand(len(x)),
+            torch.stack([
+                torch.cat([u, u.new_zeros(text_len - u.size(0), u.size(1))])
+                for u in context
+            ]).float().cpu()
+        ]
+        if 'y' in self.meta['inputs']:
+            assert clip_fea.size(0) == self.meta['clip_batch'], \
+                'Exported models share the CLIP features across samples.'
+            args += [clip_fea.float().cpu(), torch.stack(y).float().cpu()]
+        out = self.runtime(*args)[0].to(device)
+        return list(out.unbind(0))
+
+
+class WanExportedVAE:
+    r"""
+    Stand-in for the WanVAE of a pipeline that runs the graphs written by
+    `export_vae`, carrying the causal feature cache from chunk to chunk.
+
+    Args:
+        export_dir (`str`):
+            Directory of `vae.json` and the artifacts
+        threads (`int`, *optional*):
+            Intra-op threads of the onnxruntime sessions
+    """
+
+    def __init__(self, export_dir, threads=None):
+        with open(os.path.join(export_dir, 'vae.json')) as f:
+            self.meta = json.load(f)
+        # pipelines read the latent channels from `vae.model.z_dim`
+        self.model = SimpleNamespace(z_dim=self.meta['z_dim'])
+        self.runtimes = {
+            part: [
+                _Runtime(
+                    os.path.join(export_dir, self.meta[part][u]),
+                    self.meta[part]['inputs'], threads)
+                for u in ('first', 'step')
+            ] for part in ('encoder', 'decoder')
+        }
+
+    def _run(self, part, chunks, h, w):
+        state = [
+            torch.zeros(1, c, n, r * h, r * w)
+            for c, n, r in self.meta[part]['state']
+        ]
+        out = []
+        for i, x in enumerate(chunks):
+            outputs = self.runtimes[part][i > 0](x, state)
+            out.append(outputs[0])
+            state = outputs[1:]
+        return torch.cat(out, dim=2)
+
+    def encode(self, videos):
+        r"""
+        videos: A list of videos each with shape [C, T, H, W], T = 4n + 1.
+        """
+        scale, chunk = self.meta['scale'], self.meta['chunk']
+        out = []
+        for u in videos:
+            assert (u.size(1) - 1) % chunk == 0
+            x = u.unsqueeze(0).float().cpu()
+            chunks = [x[:, :, :1]] + list(x[:, :, 1:].split(chunk, dim=2))
+            z = self._run('encoder', chunks,
+                          x.size(3) // scale,
+                          x.size(4) // scale)
+            out.append(z.squeeze(0).to(u.device))
+        return out
+
+    def decode(self, zs):
+        out = []
+        for u in zs:
+            z = u.unsqueeze(0).float().cpu()
+            x = self._run('decoder', list(z.split(1, dim=2)), z.size(3),
+                          z.size(4))
+            out.append(x.clamp_(-1, 1).squeeze(0).to(u.device))
+        return out
+
+
+def use_exported(pipeline, export_dir, threads=None):
+    r"""
+    Replaces the DiT and the VAE of a pipeline by the exported graphs found in
+    export_dir. VACE models keep their eager DiT.
+
+    Args:
+        pipeline (WanT2V, WanI2V, WanFLF2V or WanVace):
+            Pipeline to run on the exported graphs
+        export_dir (`str`):
+            Directory written by `export_dit` and `export_vae`
+        threads (`int`, *optional*):
+            Intra-op threads of the onnxruntime sessions
+    """
+    if os.path.exists(os.path.join(
+            export_dir, 'dit.json')) and not isinstance(pipeline.model,
+                                                        VaceWanModel):
+        pipeline.model = WanExportedModel(export_dir, threads)
+        logging.info(f'Running the DiT from {export_dir}.')
+    if os.path.exists(os.path.join(export_dir, 'vae.json')):
+        pipeline.vae = WanExportedVAE(export_dir, threads)
+        logging.info(f'Running the VAE from {export_dir}.')
@@ -0,0 +1,252 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import torch
+import torch.nn.functional as F
+
+try:
+    import triton
+    import triton.language as tl
+    TRITON_AVAILABLE = True
+except ModuleNotFoundError:
+    TRITON_AVAILABLE = False
+
+__all__ = [
+    'layernorm_modulate',
+    'gated_residual',
+    'qk_rms_norm',
+    'set_fused_ops_backend',
+]
+
+FUSED_OPS_BACKENDS = ('auto', 'reference', 'triton', 'inductor')
+
+_config = dict(backend='auto')
+_compiled = {}
+
+
+def _layernorm_modulate(x, shift, scale, eps, dtype):
+    y = F.layer_norm(x.float(), x.shape[-1:], eps=eps).type_as(x).float()
+    return (y * (1 + scale) + shift).to(dtype)
+
+
+def _gated_residual(x, y, gate, dtype):
+    return (x.float() + y.float() * gate).to(dtype)
+
+
+def _qk_rms_norm(q, k, weight_q, weight_k, eps):
+
+    def norm(x, weight):
+        u = x.float()
+        u = u * torch.rsqrt(u.pow(2).mean(dim=-1, keepdim=True) + eps)
+        return u.type_as(x) * weight
+
+    return norm(q, weight_q), norm(k, weight_k)
+
+
+if TRITON_AVAILABLE:
+
+    @triton.jit
+    def _layernorm_modulate_kernel(X, SHIFT, SCALE, OUT, L, C, x_sb, x_sl,
+                                   shift_sb, shift_sl, scale_sb, scale_sl,
+                                   eps, BLOCK: tl.constexpr):
+        row = tl.program_id(0)
+        b, l = row // L, row % L
+        cols = tl.arange(0, BLOCK)
+        mask = cols < C
+
+        x = tl.load(
+            X + b * x_sb + l * x_sl + cols, mask=mask, other=0.).to(tl.float32)
+        mean = tl.sum(x, axis=0) / C
+        xc = tl.where(mask, x - mean, 0.)
+        y = xc * tl.rsqrt(tl.sum(xc * xc, axis=0) / C + eps)
+        y = y.to(X.dtype.element_ty).to(tl.float32)
+
+        shift = tl.load(
+            SHIFT + b * shift_sb + l * shift_sl + cols, mask=mask, other=0.)
+        scale = tl.load(
+            SCALE + b * scale_sb + l * scale_sl + cols, mask=mask, other=0.)
+        y = y * (1 + scale.to(tl.float32)) + shift.to(tl.float32)
+        tl.store(OUT + row * C + cols, y, mask=mask)
+
+    @triton.jit
+    def _gated_residual_kernel(X, Y, GATE, OUT, L, C, x_sb, x_sl, y_sb, y_sl,
+                               gate_sb, gate_sl, BLOCK: tl.constexpr):
+        row = tl.program_id(0)
+        b, l = row // L, row % L
+        cols = tl.program_id(1) * BLOCK + tl.arange(0, BLOCK)
+        mask = cols < C
+
+        x = tl.load(X + b * x_sb + l * x_sl + cols, mask=mask)
+        y = tl.load(Y + b * y_sb + l * y_sl + cols, mask=mask)
+        gate = tl.load(GATE + b * gate_sb + l * gate_sl + cols, mask=mask)
+        out = x.to(tl.float32) + y.to(tl.float32) * gate.to(tl.float32)
+        tl.store(OUT + row * C + cols, out, mask=mask)
+
+    @triton.jit
+    def _qk_rms_norm_kernel(Q, K, WQ, WK, OQ, OK, C, q_stride, k_stride, eps,
+                            BLOCK: tl.constexpr):
+        row = tl.program_id(0)
+        cols = tl.arange(0, BLOCK)
+        mask = cols < C
+
+        q = tl.load(
+            Q + row * q_stride + cols, mask=mask, other=0.).to(tl.float32)
+        k = tl.load(
+            K + row * k_stride + cols, mask=mask, other=0.).to(tl.float32)
+        q = q * tl.rsqrt(tl.sum(q * q, axis=0) / C + eps)
+        k = k * tl.rsqrt(tl.sum(k * k, axis=0) / C + eps)
+        wq = tl.load(WQ + cols, mask=mask).to(tl.float32)
+        wk = tl.load(WK + cols, mask=mask).to(tl.float32)
+        q = q.to(Q.dtype.element_ty).to(tl.float32) * wq
+        k = k.to(K.dtype.element_ty).to(tl.float32) * wk
+        tl.store(OQ + row * C + cols, q, mask=mask)
+        tl.store(OK + row * C + cols, k, mask=mask)
+
+
+def _rows(x, *mods):
+    r"""
+    x [B, L, C] and the mods broadcast to its shape, all with unit stride in C.
+    """
+    assert x.dim() == 3
+    tensors = [x] + [u.expand_as(x) for u in mods]
+    return [u if u.stride(-1) == 1 else u.contiguous() for u in tensors]
+
+
+def _triton_layernorm_modulate(x, shift, scale, eps, dtype):
+    x, shift, scale = _rows(x, shift, scale)
+    b, l, c = x.shape
+    out = torch.empty(b, l, c, device=x.device, dtype=dtype)
+    _layernorm_modulate_kernel[(b * l,)](
+        x, shift, scale, out, l, c, *x.stride()[:2], *shift.stride()[:2],
+        *scale.stride()[:2], eps, BLOCK=triton.next_power_of_2(c))
+    return out
+
+
+def _triton_gated_residual(x, y, gate, dtype):
+    x, y, gate = _rows(x, y, gate)
+    b, l, c = x.shape
+    out = torch.empty(b, l, c, device=x.device, dtype=dtype)
+    block = min(triton.next_power_of_2(c), 1024)
+    _gated_residual_kernel[(b * l, triton.cdiv(c, block))](
+        x, y, gate, out, l, c, *x.stride()[:2], *y.stride()[:2],
+        *gate.stride()[:2], BLOCK=block)
+    return out
+
+
+def _triton_qk_rms_norm(q, k, weight_q, weight_k, eps):
+    # rows of the chunks of a fused qkv projection are strided, not copied
+    shape, c = q.shape, q.size(-1)
+    q, k = (u.reshape(-1, c) for u in (q, k))
+    q, k = (u if u.stride(-1) == 1 else u.contiguous() for u in (q, k))
+    oq = torch.empty(
+        shape,
+        device=q.device,
+        dtype=torch.promote_types(q.dtype, weight_q.dtype))
+    ok = torch.empty(
+        shape,
+        device=k.device,
+        dtype=torch.promote_types(k.dtype, weight_k.dtype))
+    _qk_rms_norm_kernel[(q.size(0),)](
+        q, k, weight_q, weight_k, oq, ok, c, q.stride(0), k.stride(0), eps,
+        BLOCK=triton.next_power_of_2(c))
+    return oq, ok
+
+
+_IMPLEMENTATIONS = {
+    'layernorm_modulate': (_layernorm_modulate, _triton_layernorm_modulate),
+    'gated_residual': (_gated_residual, _triton_gated_residual),
+    'qk_rms_norm': (_qk_rms_norm, _triton_qk_rms_norm),
+}
+
+
+def _dispatch(op, x):
+    r"""
+    Implementation of op for tensors like x under the selected backend.
+    """
+    reference, triton_fn = _IMPLEMENTATIONS[op]
+    backend = _config['backend']
+    if backend == 'reference' or torch.compiler.is_compiling():
+        # an enclosing torch.compile fuses the reference itself
+        return reference
+    if backend == 'auto':
+        if x.device.type == 'cuda':
+            backend = 'triton' if TRITON_AVAILABLE else 'reference'
+        else:
+            backend = 'inductor' if x.device.type == 'cpu' else 'reference'
+    if backend == 'reference':
+        return reference
+    if backend == 'triton':
+        assert TRITON_AVAILABLE and x.device.type == 'cuda'
+        return triton_fn
+    if op not in _compiled:
+        _compiled[op] = torch.compile(reference, dynamic=True)
+    return _compiled[op]
+
+
+def layernorm_modulate(x, shift, scale, eps=1e-6, dtype=torch.float32):
+    r"""
+    adaLN of the DiT blocks, `WanLayerNorm(x).float() * (1 + scale) + shift`,
+    in a single pass over x.
+
+    Args:
+        x (Tensor):
+            Shape [B, L, C]
+        shift, scale (Tensor):
+            Broadcastable to [B, L, C], e.g. [B, 1, C] or per-token [1, L, C]
+        eps (`float`, *optional*, defaults to 1e-6):
+            Epsilon of the non-affine layer norm
+        dtype (torch.dtype, *optional*, defaults to torch.float32):
+            Dtype of the output, the computation is in float32
+
+    Returns:
+        Tensor: Shape [B, L, C]
+    """
+    return _dispatch('layernorm_modulate', x)(x, shift, scale, eps, dtype)
+
+
+def gated_residual(x, y, gate, dtype=torch.float32):
+    r"""
+    Gated residual add of the DiT blocks, `x + y * gate` computed in float32.
+
+    Args:
+        x, y (Tensor):
+            Shape [B, L, C]
+        gate (Tensor):
+            Broadcastable to [B, L, C]
+        dtype (torch.dtype, *optional*, defaults to torch.float32):
+            Dtype of the output
+
+    Returns:
+        Tensor: Shape [B, L, C]
+    """
+    return _dispatch('gated_residual', x)(x, y, gate, dtype)
+
+
+def qk_rms_norm(q, k, weight_q, weight_k, eps=1e-6):
+    r"""
+    `WanRMSNorm` of the queries and keys of a self-attention in one pass.
+
+    Args:
+        q, k (Tensor):
+            Shape [B, L, C]
+        weight_q, weight_k (Tensor):
+            Shape [C], the weights of `norm_q` and `norm_k`
+        eps (`float`, *optional*, defaults to 1e-6):
+            Epsilon of both norms
+
+    Returns:
+        Tuple[Tensor, Tensor]: The normalized q and k
+    """
+    return _dispatch('qk_rms_norm', q)(q, k, weight_q, weight_k, eps)
+
+
+def set_fused_ops_backend(name='auto'):
+    r"""
+    Selects the implementation of the fused ops.
+
+    Args:
+        name (`str`, *optional*, defaults to 'auto'):
+            'triton' for the Triton kernels on CUDA, 'inductor' for the reference
+            compiled by `torch.compile` (vectorized C++ on CPU), 'reference' for
+            eager PyTorch, or 'auto' for Triton on CUDA and inductor on CPU
+    """
+    assert name in FUSED_OPS_BACKENDS, f'Unsupported fused ops backend: {name}'
+    _config.update(backend=name)
@@ -0,0 +1,161 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+
+import torch
+import torch.nn as nn
+
+from .model import WanI2VCrossAttention, WanSelfAttention, WanT2VCrossAttention
+from .quant import QuantLinear
+from .t5 import T5SelfAttention
+
+__all__ = ['fuse_projections', 'unfuse_projections']
+
+
+def _groups(model):
+    r"""
+    (module, fused attribute, attributes) of every group of linears reading the
+    same input: q/k/v of the DiT and T5 self-attentions, k/v of the DiT
+    cross-attentions and k_img/v_img of the I2V cross-attentions.
+    """
+    for m in model.modules():
+        if isinstance(m, (WanT2VCrossAttention, WanI2VCrossAttention)):
+            yield m, 'kv', ('k', 'v')
+            if isinstance(m, WanI2VCrossAttention):
+                yield m, 'kv_img', ('k_img', 'v_img')
+        elif isinstance(m, WanSelfAttention):
+            yield m, 'qkv', ('q', 'k', 'v')
+        elif isinstance(m, T5SelfAttention):
+            yield m.attn, 'qkv', ('q', 'k', 'v')
+
+
+def _concat(layers):
+    r"""
+    One linear computing the concatenated outputs of layers, or None if they
+    do not share a storage format.
+    """
+    first = layers[0]
+    has_bias = first.bias is not None
+    if any(u.bias is not None for u in layers) != has_bias or any(
+            u.in_features != first.in_features for u in layers):
+        return None
+    out_features = sum(u.out_features for u in layers)
+    if all(type(u) is nn.Linear for u in layers):
+        layer = nn.Linear(
+            first.in_features,
+            out_features,
+            has_bias,
+            device=first.weight.device,
+            dtype=first.weight.dtype)
+        layer.weight.data = torch.cat([u.weight.data for u in layers])
+        if has_bias:
+            layer.bias.data = torch.cat([u.bias.data for u in layers])
+        return layer.requires_grad_(first.weight.requires_grad)
+    if all(
+            isinstance(u, QuantLinear) and u.mode == first.mode and
+            u.group_size == first.group_size and u.dtype == first.dtype
+            for u in layers):
+        layer = QuantLinear(
+            first.in_features,
+            out_features,
+            has_bias,
+            first.mode,
+            first.group_size,
+            dtype=first.dtype).to(first.qweight.device)
+        layer.qweight = torch.cat([u.qweight for u in layers])
+        layer.scale = torch.cat([u.scale for u in layers])
+        if has_bias:
+            layer.bias.data = torch.cat([u.bias.data for u in layers])
+        return layer
+    return None
+
+
+def _split(fused, sizes):
+    r"""
+    Inverse of `_concat`, the linears of out_features sizes.
+    """
+    layers, start = [], 0
+    for size in sizes:
+        rows = slice(start, start + size)
+        start += size
+        if isinstance(fused, QuantLinear):
+            layer = QuantLinear(
+                fused.in_features,
+                size,
+                fused.bias is not None,
+                fused.mode,
+                fused.group_size,
+                dtype=fused.dtype).to(fused.qweight.device)
+            layer.qweight = fused.qweight[rows].clone()
+            layer.scale = fused.scale[rows].clone()
+        else:
+            layer = nn.Linear(
+                fused.in_features,
+                size,
+                fused.bias is not None,
+                device=fused.weight.device,
+                dtype=fused.weight.dtype)
+            layer.weight.data = fused.weight.data[rows].clone()
+            layer.requires_grad_(fused.weight.requires_grad)
+        if fused.bias is not None:
+            layer.bias.data = fused.bias.data[rows].clone()
+        layers.append(layer)
+    return layers
+
+
+def fuse_projections(model):
+    r"""
+    Replaces the linears reading the same input by one concatenated linear per
+    group, so the q/k/v and k/v projections run as a single GEMM over the
+    input. The outputs are the same up to the GEMM's accumulation order.
+
+    Quantized layers are fused as long as a group shares one mode and group
+    size. Fusion has to happen before the model is sharded, streamed or
+    compiled, and `unfuse_projections` restores the original layout, e.g. to
+    save a checkpoint.
+
+    Args:
+        model (nn.Module):
+            WanModel, VaceWanModel or T5Encoder
+
+    Returns:
+        `int`: Number of fused groups
+    """
+    count = 0
+    for module, fused_attr, attrs in list(_groups(model)):
+        if getattr(module, fused_attr) is not None:
+            continue
+        fused = _concat([getattr(module, u) for u in attrs])
+        if fused is None:
+            continue
+        setattr(module, fused_attr, fused)
+        for attr in attrs:
+            delattr(module, attr)
+        count += 1
+    logging.info(
+        f"Fused {count} projection groups of {type(model).__name__}.")
+    return count
+
+
+def unfuse_projections(model):
+    r"""
+    Splits the linears created by `fuse_projections` back into the original
+    q/k/v and k/v layers.
+
+    Args:
+        model (nn.Module):
+            WanModel, VaceWanModel or T5Encoder
+
+    Returns:
+        `int`: Number of split groups
+    """
+    count = 0
+    for module, fused_attr, attrs in list(_groups(model)):
+        fused = getattr(module, fused_attr)
+        if fused is None:
+            continue
+        sizes = [fused.out_features // len(attrs)] * len(attrs)
+        for attr, layer in zip(attrs, _split(fused, sizes)):
+            setattr(module, attr, layer)
+        setattr(module, fused_attr, None)
+        count += 1
+    return count
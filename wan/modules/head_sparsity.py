@@ -0,0 +1,163 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import json
+import logging
+import os
+
+import torch
+import torch.distributed as dist
+
+from .attention import CHUNKED_ATTENTION_BYTES, _segments
+from .model import WanAttentionBlock
+
+__all__ = ['HeadSparsityProfile']
+
+
+class HeadSparsityProfile:
+    r"""
+    Classifies the self-attention heads of a model as 'spatial', 'temporal'
+    or 'dense' and stores the classification per checkpoint.
+
+    Without an existing profile file, the first `calibration_steps` sampling
+    steps run dense attention while the attention mass each head puts on its
+    own frame and on its own (H, W) position is estimated from a sample of
+    queries. The heads are then classified, the file is written and the
+    remaining steps run sparse.
+
+    Args:
+        path (`str`):
+            JSON profile of the checkpoint, loaded if it exists
+        calibration_steps (`int`, *optional*, defaults to 2):
+            Sampling steps observed before classifying the heads
+        threshold (`float`, *optional*, defaults to 0.9):
+            Share of the attention mass inside the frame, or at the same
+            position in the other frames, for a head to be made sparse
+        num_queries (`int`, *optional*, defaults to 256):
+            Queries per sequence the attention maps are estimated from
+    """
+
+    def __init__(self,
+                 path,
+                 calibration_steps=2,
+                 threshold=0.9,
+                 num_queries=256):
+        self.path = path
+        self.calibration_steps = calibration_steps
+        self.threshold = threshold
+        self.num_queries = num_queries
+        self.heads = None
+        self.names = {}
+        self.stats = {}
+        self.steps = 0
+        self.last_t = None
+        if os.path.exists(path):
+            with open(path) as f:
+                self.heads = json.load(f)['heads']
+            logging.info(f'Loaded head sparsity profile {path}.')
+
+    @staticmethod
+    def _self_attentions(model):
+        for name, m in model.named_modules():
+            if isinstance(m, WanAttentionBlock):
+                name = name.replace('_fsdp_wrapped_module.', '')
+                yield f'{name}.self_attn', m.self_attn
+
+    def apply(self, model):
+        r"""
+        Sets the head types of the self-attention modules of model, or makes
+        them report to this profile if it is not calibrated yet.
+        """
+        for name, m in self._self_attentions(model):
+            if self.heads is None:
+                self.names[m] = name
+                m.head_profile = self
+            else:
+                m.head_types = self.heads.get(name)
+                m.head_profile = None
+
+    def step(self, model, t):
+        r"""
+        Called at every forward with timesteps t, a tensor or the largest
+        timestep as a float, finishes the calibration once `calibration_steps`
+        different timesteps were observed.
+        """
+        if self.heads is not None:
+            return
+        t = t if isinstance(t, (int, float)) else float(t.max())
+        if t != self.last_t:
+            self.steps += 1
+            self.last_t = t
+        if self.steps > self.calibration_steps:
+            self.heads = self.classify()
+            self.save()
+            self.apply(model)
+            self.stats.clear()
+
+    @torch.no_grad()
+    def observe(self, module, q, k, grid_sizes, seq_lens=None,
+                cu_seqlens=None):
+        r"""
+        Accumulates the frame and position attention mass per head of module.
+
+        Args:
+            q, k (Tensor):
+                Roped queries and keys of shape [B, L, N, C], or [1, sum(L), N, C]
+                with cu_seqlens
+            grid_sizes (Tensor):
+                Shape [B, 3], the (F, H, W) token grid of each sequence
+        """
+        n, c = q.shape[2:]
+        stats = self.stats.setdefault(
+            self.names[module], q.new_zeros(3, n, dtype=torch.float32))
+        for qi, ki, (f, h, w) in zip(
+                _segments(q, seq_lens, cu_seqlens),
+                _segments(k, seq_lens, cu_seqlens), grid_sizes.tolist()):
+            l = f * h * w
+            pos = torch.arange(l, device=q.device)
+            index = torch.linspace(
+                0, l - 1, min(self.num_queries, l), device=q.device).long()
+            qs = qi[index].float().transpose(0, 1) * c**-0.5
+            ks = ki[:l].float().transpose(0, 1)
+            chunk = max(1, CHUNKED_ATTENTION_BYTES // (4 * n * l))
+            for start in range(0, index.numel(), chunk):
+                i = index[start:start + chunk]
+                p = torch.softmax(
+                    torch.matmul(qs[:, start:start + chunk], ks.transpose(1, 2)),
+                    dim=-1)
+                frame = (i // (h * w)).unsqueeze(1) == pos // (h * w)
+                column = (i % (h * w)).unsqueeze(1) == pos % (h * w)
+                stats[0] += (p * frame).sum(dim=(1, 2))
+                stats[1] += (p * column).sum(dim=(1, 2))
+            stats[2] += index.numel()
+
+    def classify(self):
+        r"""
+        Head types of every observed module from the accumulated statistics.
+        """
+        heads = {}
+        for name, stats in self.stats.items():
+            spatial, temporal = (stats[:2] / stats[2]).tolist()
+            heads[name] = [
+                'spatial' if s >= self.threshold else
+                'temporal' if t >= self.threshold else 'dense'
+                for s, t in zip(spatial, temporal)
+            ]
+        counts = [kind for types in heads.values() for kind in types]
+        logging.info('Head sparsity profile: ' + ', '.join(
+            f'{counts.count(kind)} {kind}'
+            for kind in ('spatial', 'temporal', 'dense')) + ' heads.')
+        return heads
+
+    def save(self):
+        if dist.is_initialized() and dist.get_rank() != 0:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(
+                dict(
+                    calibration_steps=self.calibration_steps,
+                    threshold=self.threshold,
+                    heads=self.heads),
+                f,
+                indent=2)
+        os.replace(tmp, self.path)
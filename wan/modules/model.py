@@ -1,5 +1,8 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import functools
 import math
+import os
+from collections import OrderedDict
 
 import torch
 import torch.cuda.amp as amp
@@ -7,9 +10,17 @@ import torch.nn as nn
 from diffusers.configuration_utils import ConfigMixin, register_to_config
 from diffusers.models.modeling_utils import ModelMixin
 
-from .attention import flash_attention
+from .attention import (
+    AttentionMetadata,
+    attention,
+    headwise_sparse_attention,
+    local_attention_3d,
+)
+from .device import autocast
+from .fused_ops import gated_residual, layernorm_modulate, qk_rms_norm
+from .precision import PrecisionPolicy
 
-__all__ = ['WanModel']
+__all__ = ['WanModel', 'WanInferenceSession', 'precompute_time_embeddings']
 
 T5_CONTEXT_TOKEN_NUMBER = 512
 FIRST_LAST_FRAME_CONTEXT_TOKEN_NUMBER = 257 * 2
@@ -39,35 +50,214 @@ def rope_params(max_seq_len, dim, theta=10000):
     return freqs
 
 
-@amp.autocast(enabled=False)
-def rope_apply(x, grid_sizes, freqs):
-    n, c = x.size(2), x.size(3) // 2
-
-    # split freqs
-    freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
+class WanRotaryEmbedding:
+    r"""
+    3D (F, H, W) rotary position embedding with cached cos/sin tables.
 
-    # loop over samples
-    output = []
-    for i, (f, h, w) in enumerate(grid_sizes.tolist()):
-        seq_len = f * h * w
+    Tables are built once per (grid size, sequence length, sequence parallel
+    rank, device) and kept in a small LRU, so the per-step cost of RoPE is a
+    single batched elementwise rotation.
+    """
 
-        # precompute multipliers
-        x_i = torch.view_as_complex(x[i, :seq_len].to(torch.float64).reshape(
-            seq_len, n, -1, 2))
-        freqs_i = torch.cat([
+    def __init__(self, head_dim, max_seq_len=1024, theta=10000, cache_size=32):
+        assert head_dim % 2 == 0
+        d = head_dim
+        self.head_dim = head_dim
+        self.cache_size = cache_size
+        self.freqs = torch.cat([
+            rope_params(max_seq_len, d - 4 * (d // 6), theta),
+            rope_params(max_seq_len, 2 * (d // 6), theta),
+            rope_params(max_seq_len, 2 * (d // 6), theta)
+        ],
+                               dim=1)
+        self._cache = OrderedDict()
+
+    @amp.autocast(enabled=False)
+    def _build(self, grid_size, seq_len, sp_rank, sp_size, device, dtype):
+        f, h, w = grid_size
+        c = self.head_dim // 2
+        freqs = self.freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
+        freqs = torch.cat([
             freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
             freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
             freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
         ],
-                            dim=-1).reshape(seq_len, 1, -1)
+                          dim=-1).reshape(f * h * w, 1, -1)
+
+        # padded positions get the identity rotation
+        freqs = torch.cat([
+            freqs, freqs.new_ones(seq_len - freqs.size(0), *freqs.shape[1:])
+        ])
+        s = seq_len // sp_size
+        freqs = freqs[sp_rank * s:(sp_rank + 1) * s]
+        return (freqs.real.to(device, dtype), freqs.imag.to(device, dtype))
+
+    def get(self,
+            grid_size,
+            seq_len,
+            device,
+            sp_rank=0,
+            sp_size=1,
+            dtype=torch.float32):
+        r"""
+        Returns the (cos, sin) tables of one sample, each of shape
+        [seq_len / sp_size, 1, C / num_heads / 2].
+        """
+        key = (tuple(grid_size), seq_len, sp_rank, sp_size, torch.device(device),
+               dtype)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        assert math.prod(grid_size) <= seq_len and seq_len % sp_size == 0
+        value = self._build(grid_size, seq_len, sp_rank, sp_size, device,
+                            dtype)
+        self._cache[key] = value
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return value
+
+    def __call__(self,
+                 grid_sizes,
+                 seq_len,
+                 device,
+                 sp_rank=0,
+                 sp_size=1,
+                 dtype=torch.float32):
+        r"""
+        Args:
+            grid_sizes(Tensor): Shape [B, 3], the second dimension contains (F, H, W)
+            seq_len(`int`): Padded sequence length over all ranks
+
+        Returns:
+            Tuple[Tensor, Tensor]: (cos, sin) tables, each of shape
+                [B or 1, seq_len / sp_size, 1, C / num_heads / 2]
+        """
+        grid_sizes = [tuple(u) for u in grid_sizes.tolist()]
+        tables = [
+            self.get(u, seq_len, device, sp_rank, sp_size, dtype)
+            for u in dict.fromkeys(grid_sizes)
+        ]
+        if len(tables) == 1:
+            return tuple(u.unsqueeze(0) for u in tables[0])
+        tables = dict(zip(dict.fromkeys(grid_sizes), tables))
+        return tuple(
+            torch.stack([tables[u][i] for u in grid_sizes]) for i in range(2))
+
+    def packed(self, grid_sizes, device, dtype=torch.float32):
+        r"""
+        Returns the (cos, sin) tables of samples packed without padding, each
+        of shape [1, sum(F * H * W), 1, C / num_heads / 2].
+        """
+        tables = [
+            self.get(u, math.prod(u), device, dtype=dtype)
+            for u in grid_sizes.tolist()
+        ]
+        return tuple(
+            torch.cat([u[i] for u in tables]).unsqueeze(0) for i in range(2))
+
 
-        # apply rotary embedding
-        x_i = torch.view_as_real(x_i * freqs_i).flatten(2)
-        x_i = torch.cat([x_i, x[i, seq_len:]])
+@amp.autocast(enabled=False)
+def rope_apply(x, freqs):
+    r"""
+    Args:
+        x(Tensor): Shape [B, L, num_heads, C / num_heads]
+        freqs(Tuple[Tensor, Tensor]): (cos, sin) tables from `WanRotaryEmbedding`,
+            each of shape [B or 1, L, 1, C / num_heads / 2]
+    """
+    cos, sin = freqs
+    x0, x1 = x.to(cos.dtype).unflatten(-1, (-1, 2)).unbind(-1)
+    out = torch.stack([x0 * cos - x1 * sin, x0 * sin + x1 * cos], dim=-1)
+    return out.flatten(3).type_as(x)
 
-        # append to collection
-        output.append(x_i)
-    return torch.stack(output).float()
+
+class WanContextCache:
+    r"""
+    Per-generation cache of the embedded text/image context and of the
+    cross-attention keys and values of every block.
+
+    The context is the same at every denoising step, so it is projected on the
+    first step and reused afterwards. Entries are keyed by the identity of the
+    context tensors given to the model, which the cache keeps alive until
+    `clear` is called at the end of the generation.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def lookup(self, context, clip_fea=None):
+        key = tuple(id(u) for u in context) + (id(clip_fea),)
+        if key not in self.entries:
+            self.entries[key] = dict(
+                inputs=(list(context), clip_fea), context=None, kv={})
+        return self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+    @property
+    def nbytes(self):
+        r"""
+        Memory held by the cached projections in bytes.
+        """
+        tensors = []
+        for entry in self.entries.values():
+            if entry['context'] is not None:
+                tensors.append(entry['context'])
+            for kv in entry['kv'].values():
+                tensors.extend(u for u in kv if isinstance(u, torch.Tensor))
+        return sum(u.numel() * u.element_size() for u in tensors)
+
+
+class WanInferenceSession:
+    r"""
+    Per-generation buffers of the DiT forward, allocated on the first of the
+    sampling steps and reused by the others.
+
+    The patch embedding writes into a preallocated padded token buffer and
+    `unpatchify` into preallocated float32 latents. Buffers are keyed by name,
+    shape (including the batch) and dtype, and the attention metadata by the
+    token layout. The output latents alternate between two sets of buffers,
+    so the latents returned by a forward stay valid until the forward after
+    the next one, e.g. cond and uncond predictions of one step.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.metadata = {}
+        self.turn = 0
+
+    def buffer(self, name, shape, dtype, device):
+        key = (name, tuple(shape), dtype, torch.device(device))
+        if key not in self.buffers:
+            self.buffers[key] = torch.empty(shape, dtype=dtype, device=device)
+        return self.buffers[key]
+
+    def attention_metadata(self, seq_lens, grid_sizes, device, padded_len=None):
+        key = (tuple(seq_lens.tolist()), tuple(grid_sizes.flatten().tolist()),
+               padded_len)
+        if key not in self.metadata:
+            self.metadata[key] = AttentionMetadata(
+                seq_lens, grid_sizes, device, padded_len=padded_len)
+        return self.metadata[key]
+
+    def clear(self):
+        self.buffers.clear()
+        self.metadata.clear()
+
+    @property
+    def nbytes(self):
+        r"""
+        Memory held by the buffers in bytes.
+        """
+        return sum(u.numel() * u.element_size() for u in self.buffers.values())
+
+
+def _autocast_dtype(device):
+    if device.type == 'cuda' and torch.is_autocast_enabled():
+        return torch.get_autocast_gpu_dtype()
+    if device.type == 'cpu' and torch.is_autocast_cpu_enabled():
+        return torch.get_autocast_cpu_dtype()
+    return None
 
 
 class WanRMSNorm(nn.Module):
@@ -116,6 +306,10 @@ class WanSelfAttention(nn.Module):
         self.num_heads = num_heads
         self.head_dim = dim // num_heads
         self.window_size = window_size
+        self.tile_size = (4, 8, 8)
+        self.local_t_range = None
+        self.head_types = None
+        self.head_profile = None
         self.qk_norm = qk_norm
         self.eps = eps
 
@@ -127,31 +321,108 @@ class WanSelfAttention(nn.Module):
         self.norm_q = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
         self.norm_k = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
 
-    def forward(self, x, seq_lens, grid_sizes, freqs):
+        # concatenated projections replacing q/k/v or k/v, see `fuse_projections`
+        self.qkv = None
+        self.kv = None
+
+    def project_qkv(self, x):
+        if self.qkv is not None:
+            return self.qkv(x).chunk(3, dim=-1)
+        return self.q(x), self.k(x), self.v(x)
+
+    def project_kv(self, context):
+        if self.kv is not None:
+            return self.kv(context).chunk(2, dim=-1)
+        return self.k(context), self.v(context)
+
+    def forward(self,
+                x,
+                seq_lens,
+                grid_sizes,
+                freqs,
+                cu_seqlens=None,
+                local_attn=None,
+                metadata=None):
         r"""
         Args:
             x(Tensor): Shape [B, L, num_heads, C / num_heads]
             seq_lens(Tensor): Shape [B]
             grid_sizes(Tensor): Shape [B, 3], the second dimension contains (F, H, W)
-            freqs(Tensor): Rope freqs, shape [1024, C / num_heads / 2]
+            freqs(Tuple[Tensor, Tensor]): Rope (cos, sin) tables, each of shape [B or 1, L, 1, C / num_heads / 2]
+            cu_seqlens(Tensor, *optional*): Shape [B + 1], cumulative sequence lengths when the
+                samples are packed into x of shape [1, sum(seq_lens), C]
+            local_attn(set, *optional*): Modules using their 3D `window_size` at this step, all if None
+            metadata(AttentionMetadata, *optional*): Layout of seq_lens, runs attention on the packed
+                valid tokens
         """
         b, s, n, d = *x.shape[:2], self.num_heads, self.head_dim
 
         # query, key, value function
         def qkv_fn(x):
-            q = self.norm_q(self.q(x)).view(b, s, n, d)
-            k = self.norm_k(self.k(x)).view(b, s, n, d)
-            v = self.v(x).view(b, s, n, d)
-            return q, k, v
+            q, k, v = self.project_qkv(x)
+            if self.qk_norm:
+                q, k = qk_rms_norm(q, k, self.norm_q.weight,
+                                   self.norm_k.weight, self.eps)
+            return q.view(b, s, n, d), k.view(b, s, n, d), v.view(b, s, n, d)
 
         q, k, v = qkv_fn(x)
 
-        x = flash_attention(
-            q=rope_apply(q, grid_sizes, freqs),
-            k=rope_apply(k, grid_sizes, freqs),
-            v=v,
-            k_lens=seq_lens,
-            window_size=self.window_size)
+        q, k = rope_apply(q, freqs), rope_apply(k, freqs)
+        if self.head_profile is not None:
+            self.head_profile.observe(
+                self,
+                q,
+                k,
+                grid_sizes,
+                seq_lens=seq_lens if cu_seqlens is None else None,
+                cu_seqlens=cu_seqlens)
+
+        if metadata is not None:
+            q, k, v = (metadata.pack(u) for u in (q, k, v))
+            seq_lens, cu_seqlens = None, metadata.cu_seqlens
+            lens = metadata.attention_kwargs()
+        elif cu_seqlens is None:
+            lens = dict(k_lens=seq_lens)
+        else:
+            max_seqlen = int(seq_lens.max())
+            lens = dict(
+                cu_seqlens_q=cu_seqlens,
+                cu_seqlens_k=cu_seqlens,
+                max_seqlen_q=max_seqlen,
+                max_seqlen_k=max_seqlen)
+
+        if len(self.window_size) == 3 and (local_attn is None or
+                                           self in local_attn):
+            x = local_attention_3d(
+                q,
+                k,
+                v,
+                grid_sizes,
+                self.window_size,
+                self.tile_size,
+                seq_lens=seq_lens if cu_seqlens is None else None,
+                cu_seqlens=cu_seqlens,
+                metadata=metadata)
+        elif self.head_types is not None:
+            x = headwise_sparse_attention(
+                q,
+                k,
+                v,
+                grid_sizes,
+                self.head_types,
+                seq_lens=seq_lens if cu_seqlens is None else None,
+                cu_seqlens=cu_seqlens,
+                metadata=metadata)
+        else:
+            x = attention(
+                q=q,
+                k=k,
+                v=v,
+                window_size=self.window_size
+                if len(self.window_size) == 2 else (-1, -1),
+                **lens)
+        if metadata is not None:
+            x = metadata.unpack(x)
 
         # output
         x = x.flatten(2)
@@ -159,24 +430,70 @@ class WanSelfAttention(nn.Module):
         return x
 
 
+def packed_cross_attn_lens(cu_seqlens, max_seqlen, k, k_lens=None,
+                           metadata=None):
+    r"""
+    Arguments of `attention` for packed queries attending to the padded
+    per-sample keys k of shape [B, L2, num_heads, C / num_heads].
+    """
+    if metadata is not None:
+        assert k_lens is None, 'context_lens is not supported with metadata.'
+        return metadata.attention_kwargs(k)
+    if cu_seqlens is None:
+        return dict(k_lens=k_lens)
+    assert k_lens is None, 'context_lens is not supported with packed queries.'
+    b, lk = k.shape[:2]
+    return dict(
+        cu_seqlens_q=cu_seqlens,
+        cu_seqlens_k=torch.arange(
+            0, (b + 1) * lk, lk, dtype=torch.int32, device=k.device),
+        max_seqlen_q=max_seqlen,
+        max_seqlen_k=lk)
+
+
 class WanT2VCrossAttention(WanSelfAttention):
 
-    def forward(self, x, context, context_lens):
+    def forward(self,
+                x,
+                context,
+                context_lens,
+                cu_seqlens=None,
+                max_seqlen=None,
+                kv_cache=None,
+                metadata=None):
         r"""
         Args:
             x(Tensor): Shape [B, L1, C]
             context(Tensor): Shape [B, L2, C]
             context_lens(Tensor): Shape [B]
+            cu_seqlens(Tensor, *optional*): Shape [B + 1], cumulative query lengths when the
+                samples are packed into x of shape [1, sum(L1), C]
+            max_seqlen(`int`, *optional*): Longest packed query length
+            kv_cache(dict, *optional*): Projected keys and values of `context` per module
+            metadata(AttentionMetadata, *optional*): Layout of x, runs attention on the packed
+                valid tokens
         """
-        b, n, d = x.size(0), self.num_heads, self.head_dim
+        b, n, d = context.size(0), self.num_heads, self.head_dim
 
         # compute query, key, value
-        q = self.norm_q(self.q(x)).view(b, -1, n, d)
-        k = self.norm_k(self.k(context)).view(b, -1, n, d)
-        v = self.v(context).view(b, -1, n, d)
+        q = self.norm_q(self.q(x)).view(x.size(0), -1, n, d)
+        if kv_cache is not None and self in kv_cache:
+            k, v = kv_cache[self]
+        else:
+            k, v = self.project_kv(context)
+            k = self.norm_k(k).view(b, -1, n, d)
+            v = v.view(b, -1, n, d)
+            if kv_cache is not None:
+                kv_cache[self] = (k, v)
 
         # compute attention
-        x = flash_attention(q, k, v, k_lens=context_lens)
+        if metadata is not None:
+            q = metadata.pack(q)
+        x = attention(
+            q, k, v, **packed_cross_attn_lens(cu_seqlens, max_seqlen, k,
+                                              context_lens, metadata))
+        if metadata is not None:
+            x = metadata.unpack(x)
 
         # output
         x = x.flatten(2)
@@ -198,36 +515,113 @@ class WanI2VCrossAttention(WanSelfAttention):
         self.v_img = nn.Linear(dim, dim)
         # self.alpha = nn.Parameter(torch.zeros((1, )))
         self.norm_k_img = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
-
-    def forward(self, x, context, context_lens):
+        self.kv_img = None
+
+    def project_kv_img(self, context_img):
+        if self.kv_img is not None:
+            return self.kv_img(context_img).chunk(2, dim=-1)
+        return self.k_img(context_img), self.v_img(context_img)
+
+    def forward(self,
+                x,
+                context,
+                context_lens,
+                cu_seqlens=None,
+                max_seqlen=None,
+                kv_cache=None,
+                metadata=None):
         r"""
         Args:
             x(Tensor): Shape [B, L1, C]
             context(Tensor): Shape [B, L2, C]
             context_lens(Tensor): Shape [B]
+            cu_seqlens(Tensor, *optional*): Shape [B + 1], cumulative query lengths when the
+                samples are packed into x of shape [1, sum(L1), C]
+            max_seqlen(`int`, *optional*): Longest packed query length
+            kv_cache(dict, *optional*): Projected keys and values of `context` per module
+            metadata(AttentionMetadata, *optional*): Layout of x, runs attention on the packed
+                valid tokens
         """
         image_context_length = context.shape[1] - T5_CONTEXT_TOKEN_NUMBER
         context_img = context[:, :image_context_length]
         context = context[:, image_context_length:]
-        b, n, d = x.size(0), self.num_heads, self.head_dim
+        b, n, d = context.size(0), self.num_heads, self.head_dim
 
         # compute query, key, value
-        q = self.norm_q(self.q(x)).view(b, -1, n, d)
-        k = self.norm_k(self.k(context)).view(b, -1, n, d)
-        v = self.v(context).view(b, -1, n, d)
-        k_img = self.norm_k_img(self.k_img(context_img)).view(b, -1, n, d)
-        v_img = self.v_img(context_img).view(b, -1, n, d)
-        img_x = flash_attention(q, k_img, v_img, k_lens=None)
-        # compute attention
-        x = flash_attention(q, k, v, k_lens=context_lens)
+        q = self.norm_q(self.q(x)).view(x.size(0), -1, n, d)
+        if kv_cache is not None and self in kv_cache:
+            k, v, lens_k = kv_cache[self]
+        else:
+            k, v, lens_k = self.fused_kv(context, context_img, context_lens)
+            if kv_cache is not None:
+                kv_cache[self] = (k, v, lens_k)
+
+        # image and text attention in one varlen call, the queries are
+        # repeated for the second key set and the two outputs summed
+        if metadata is not None:
+            q = metadata.pack(q)
+            max_seqlen = metadata.max_seqlen
+            cu_seqlens_q = metadata.packed_cu_seqlens(metadata.seq_lens * 2)
+            cu_seqlens_k = metadata.packed_cu_seqlens(lens_k)
+        else:
+            if cu_seqlens is None:
+                cu_seqlens = torch.arange(
+                    0, (q.size(0) + 1) * q.size(1),
+                    q.size(1),
+                    dtype=torch.int32,
+                    device=q.device)
+                max_seqlen = q.size(1)
+            cu_seqlens_q = torch.cat(
+                [cu_seqlens, cu_seqlens[1:] + q.size(0) * q.size(1)])
+            cu_seqlens_k = torch.tensor(
+                [0] + lens_k, dtype=torch.int32).cumsum(
+                    0, dtype=torch.int32).to(
+                        q.device, non_blocking=True)
+        shape, q = q.shape, q.flatten(0, 1)
+        x = attention(
+            torch.cat([q, q]).unsqueeze(0),
+            k.unsqueeze(0),
+            v.unsqueeze(0),
+            cu_seqlens_q=cu_seqlens_q,
+            cu_seqlens_k=cu_seqlens_k,
+            max_seqlen_q=max_seqlen,
+            max_seqlen_k=max(image_context_length, context.size(1)),
+            metadata=metadata)[0]
+        x = (x[:q.size(0)] + x[q.size(0):]).view(shape)
+        if metadata is not None:
+            x = metadata.unpack(x)
 
         # output
         x = x.flatten(2)
-        img_x = img_x.flatten(2)
-        x = x + img_x
         x = self.o(x)
         return x
 
+    def fused_kv(self, context, context_img, context_lens=None):
+        r"""
+        Keys and values of the image context of every sample followed by those
+        of the text context, packed for a single varlen attention call.
+
+        Returns:
+            Tuple[Tensor, Tensor, List[int]]: Keys and values of shape
+                [sum(L), num_heads, C / num_heads] and the 2 * B lengths of the packed sequences
+        """
+        b, n, d = context.size(0), self.num_heads, self.head_dim
+        k, v = self.project_kv(context)
+        k, v = self.norm_k(k).view(b, -1, n, d), v.view(b, -1, n, d)
+        k_img, v_img = self.project_kv_img(context_img)
+        k_img = self.norm_k_img(k_img).view(b, -1, n, d)
+        v_img = v_img.view(b, -1, n, d)
+        lens = [k_img.size(1)] * b + (
+            [k.size(1)] * b if context_lens is None else context_lens.tolist())
+        if context_lens is None:
+            k, v = k.flatten(0, 1), v.flatten(0, 1)
+        else:
+            k, v = (torch.cat([u[:l] for u, l in zip(t, lens[b:])])
+                    for t in (k, v))
+        k = torch.cat([k_img.flatten(0, 1), k])
+        v = torch.cat([v_img.flatten(0, 1), v])
+        return k, v, lens
+
 
 WAN_CROSSATTENTION_CLASSES = {
     't2v_cross_attn': WanT2VCrossAttention,
@@ -235,6 +629,75 @@ WAN_CROSSATTENTION_CLASSES = {
 }
 
 
+@functools.lru_cache(maxsize=8)
+def _merge_indices(grid_size, stride, device):
+    f, h, w = grid_size
+    axes = [torch.arange(g, device=device) for g in grid_size]
+    origin = [u % st == 0 for u, st in zip(axes, stride)]
+    origin = (origin[0].view(-1, 1, 1) & origin[1].view(1, -1, 1) &
+              origin[2].view(1, 1, -1)).flatten()
+    pos = torch.arange(f * h * w, device=device)
+    dst, src = pos[origin], pos[~origin]
+
+    # destination of the stride window of every token
+    window = [u // st * st for u, st in zip(axes, stride)]
+    window = ((window[0].view(-1, 1, 1) * h + window[1].view(1, -1, 1)) * w +
+              window[2].view(1, 1, -1)).flatten()
+    ordinal = torch.full_like(pos, -1)
+    ordinal[dst] = torch.arange(dst.numel(), device=device)
+    return dst, src, ordinal[window[src]]
+
+
+def bipartite_token_merge(x, grid_size, stride, r):
+    r"""
+    Bipartite soft matching of the tokens of x on their (F, H, W) grid. The
+    first token of every `stride` window is a destination, the other tokens
+    are sources matched to the destination of their window. The r sources
+    most similar to their destination are averaged into it.
+
+    Args:
+        x(Tensor): Shape [B, L, C], the tokens to match
+        grid_size(Tuple[int]): (F, H, W) with F * H * W == L
+        stride(Tuple[int]): (F, H, W) size of the windows
+        r(int): Number of tokens to merge away
+
+    Returns:
+        Tuple[callable, callable, Tensor]: `merge` mapping [B, L, C] to [B, L - r, C],
+            `unmerge` mapping back by copying each merged token from its destination,
+            and the indices [B, L - r] of the kept tokens
+    """
+    b, l = x.shape[:2]
+    dst, src, src_dst = _merge_indices(
+        tuple(grid_size), tuple(stride), x.device)
+    r = min(r, src.numel())
+    metric = x / x.norm(dim=-1, keepdim=True).clamp_min(1e-6)
+    score = (metric[:, src] * metric[:, dst[src_dst]]).sum(dim=-1)
+    order = score.argsort(dim=-1, descending=True)
+    merged_src, merged_dst = src[order[:, :r]], src_dst[order[:, :r]]
+    kept = torch.cat([dst.expand(b, -1), src[order[:, r:]]], dim=1)
+
+    def index(i, c):
+        return i.unsqueeze(-1).expand(-1, -1, c)
+
+    def merge(y):
+        c = y.size(-1)
+        out = y.gather(1, index(kept, c))
+        dst_tokens = out[:, :dst.numel()].scatter_reduce(
+            1, index(merged_dst, c), y.gather(1, index(merged_src, c)),
+            reduce='mean')
+        return torch.cat([dst_tokens, out[:, dst.numel():]], dim=1)
+
+    def unmerge(y):
+        c = y.size(-1)
+        out = y.new_empty(b, l, c)
+        out.scatter_(1, index(kept, c), y)
+        out.scatter_(1, index(merged_src, c), y.gather(1, index(merged_dst,
+                                                                c)))
+        return out
+
+    return merge, unmerge, kept
+
+
 class WanAttentionBlock(nn.Module):
 
     def __init__(self,
@@ -275,6 +738,17 @@ class WanAttentionBlock(nn.Module):
         # modulation
         self.modulation = nn.Parameter(torch.randn(1, 6, dim) / dim**0.5)
 
+        # token merging
+        self.merge_ratio = 0.
+        self.merge_stride = (1, 2, 2)
+        self.merge_t_range = None
+
+        # tokens per chunk of the FFN, None runs the whole sequence at once
+        self.ffn_chunk_size = None
+
+        # activation dtypes, see `WanModel.set_precision`
+        self.precision = PrecisionPolicy()
+
     def forward(
         self,
         x,
@@ -284,38 +758,138 @@ class WanAttentionBlock(nn.Module):
         freqs,
         context,
         context_lens,
+        cu_seqlens=None,
+        kv_cache=None,
+        time_modulation=None,
+        local_attn=None,
+        token_merge=None,
+        metadata=None,
     ):
         r"""
         Args:
-            x(Tensor): Shape [B, L, C]
-            e(Tensor): Shape [B, 6, C]
+            x(Tensor): Shape [B, L, C], or [1, sum(seq_lens), C] if packed
+            e(Tensor): Shape [B, 6, C], or per-token [1, L, 6, C] if packed
             seq_lens(Tensor): Shape [B], length of each sequence in batch
             grid_sizes(Tensor): Shape [B, 3], the second dimension contains (F, H, W)
-            freqs(Tensor): Rope freqs, shape [1024, C / num_heads / 2]
+            freqs(Tuple[Tensor, Tensor]): Rope (cos, sin) tables, each of shape [B or 1, L, 1, C / num_heads / 2]
+            cu_seqlens(Tensor, *optional*): Shape [B + 1], cumulative sequence lengths of packed samples
+            kv_cache(dict, *optional*): Cross-attention keys and values cached for `context`
+            time_modulation(dict, *optional*): Precomputed `modulation + e` per module, replaces `e`
+            local_attn(set, *optional*): Self-attention modules using 3D local-window attention
+            token_merge(set, *optional*): Blocks merging similar tokens before self-attention and FFN
+            metadata(AttentionMetadata, *optional*): Layout of x shared by all attention calls
         """
-        assert e.dtype == torch.float32
-        with amp.autocast(dtype=torch.float32):
-            e = (self.modulation + e).chunk(6, dim=1)
-        assert e[0].dtype == torch.float32
+        e = self.modulate(e, time_modulation)
+        max_seqlen = None if cu_seqlens is None else int(seq_lens.max())
+
+        # token merging
+        merge = unmerge = None
+        if token_merge is not None and self in token_merge and self.can_merge(
+                x, seq_lens, grid_sizes, cu_seqlens):
+            merge, unmerge, kept = bipartite_token_merge(
+                x, grid_sizes[0].tolist(), self.merge_stride,
+                int(x.size(1) * self.merge_ratio))
+            seq_lens = torch.full_like(seq_lens, kept.size(1))
+            batch = torch.arange(x.size(0), device=x.device).unsqueeze(1)
+            freqs = tuple(
+                u.expand(x.size(0), -1, -1, -1)[batch, kept] for u in freqs)
 
         # self-attention
+        y = self.self_attn_input(x, e[0], e[1])
         y = self.self_attn(
-            self.norm1(x).float() * (1 + e[1]) + e[0], seq_lens, grid_sizes,
-            freqs)
-        with amp.autocast(dtype=torch.float32):
-            x = x + y * e[2]
+            y if merge is None else merge(y),
+            seq_lens,
+            grid_sizes,
+            freqs,
+            cu_seqlens=cu_seqlens,
+            local_attn=local_attn,
+            metadata=metadata if merge is None else None)
+        x = self.residual(x, y if unmerge is None else unmerge(y), e[2])
 
         # cross-attention & ffn function
         def cross_attn_ffn(x, context, context_lens, e):
-            x = x + self.cross_attn(self.norm3(x), context, context_lens)
-            y = self.ffn(self.norm2(x).float() * (1 + e[4]) + e[3])
-            with amp.autocast(dtype=torch.float32):
-                x = x + y * e[5]
-            return x
+            x = x + self.cross_attn(
+                self.norm3(x),
+                context,
+                context_lens,
+                cu_seqlens=cu_seqlens,
+                max_seqlen=max_seqlen,
+                kv_cache=kv_cache,
+                metadata=metadata)
+            if merge is None:
+                if self.ffn_chunk_size is not None:
+                    return self.chunked_ffn(x, e[3:])
+                return self.ffn_residual(x, *e[3:])
+            y = self.ffn(
+                merge(
+                    layernorm_modulate(x, e[3], e[4], self.norm2.eps,
+                                       self.precision.adaln)))
+            return self.residual(x, unmerge(y), e[5])
 
         x = cross_attn_ffn(x, context, context_lens, e)
         return x
 
+    def modulate(self, e, time_modulation=None):
+        r"""
+        Shift, scale and gate of the self-attention and the FFN for the time
+        embedding e of shape [B, 6, C] or per-token [1, L, 6, C].
+        """
+        if time_modulation is not None:
+            return time_modulation[self].chunk(6, dim=1)
+        modulation = self.modulation.to(self.precision.modulation)
+        e = e.to(self.precision.modulation)
+        if e.dim() == 4:
+            return [
+                u.squeeze(2)
+                for u in (modulation.unsqueeze(0) + e).chunk(6, dim=2)
+            ]
+        return (modulation + e).chunk(6, dim=1)
+
+    # the elementwise chains below are the regions `WanModel.set_compile` fuses
+
+    def self_attn_input(self, x, shift, scale):
+        return layernorm_modulate(x, shift, scale, self.norm1.eps,
+                                  self.precision.adaln)
+
+    def residual(self, x, y, gate):
+        return gated_residual(x, y, gate, self.precision.residual)
+
+    def ffn_residual(self, x, shift, scale, gate):
+        y = self.ffn(
+            layernorm_modulate(x, shift, scale, self.norm2.eps,
+                               self.precision.adaln))
+        return gated_residual(x, y, gate, self.precision.residual)
+
+    def chunked_ffn(self, x, e):
+        r"""
+        Modulated FFN with residual over chunks of `ffn_chunk_size` tokens,
+        updating x in place. Only one chunk of the fp32 modulated input and of
+        the FFN hidden states is alive at a time.
+
+        Args:
+            x(Tensor): Shape [B, L, C], owned by the block
+            e(List[Tensor]): Shift, scale and gate, each of shape [B, 1, C] or per-token [1, L, C]
+        """
+        for start in range(0, x.size(1), self.ffn_chunk_size):
+            end = start + self.ffn_chunk_size
+            shift, scale, gate = (
+                u[:, start:end] if u.size(1) > 1 else u for u in e)
+            u = x[:, start:end]
+            u.copy_(self.ffn_residual(u, shift, scale, gate))
+        return x
+
+    def can_merge(self, x, seq_lens, grid_sizes, cu_seqlens=None):
+        r"""
+        Token merging needs unpadded, unpacked samples of one grid size and a
+        self-attention that does not depend on the token layout.
+        """
+        return (self.merge_ratio > 0 and cu_seqlens is None and
+                bool((seq_lens == x.size(1)).all()) and
+                bool((grid_sizes == grid_sizes[0]).all()) and
+                len(self.self_attn.window_size) == 2 and
+                self.self_attn.head_types is None and
+                self.self_attn.head_profile is None)
+
 
 class Head(nn.Module):
 
@@ -334,18 +908,36 @@ class Head(nn.Module):
         # modulation
         self.modulation = nn.Parameter(torch.randn(1, 2, dim) / dim**0.5)
 
-    def forward(self, x, e):
+        # activation dtypes, see `WanModel.set_precision`
+        self.precision = PrecisionPolicy()
+
+    def forward(self, x, e, time_modulation=None):
         r"""
         Args:
             x(Tensor): Shape [B, L1, C]
-            e(Tensor): Shape [B, C]
+            e(Tensor): Shape [B, C], or per-token [1, L1, C] if packed
+            time_modulation(dict, *optional*): Precomputed `modulation + e` per module, replaces `e`
         """
-        assert e.dtype == torch.float32
-        with amp.autocast(dtype=torch.float32):
-            e = (self.modulation + e.unsqueeze(1)).chunk(2, dim=1)
-            x = (self.head(self.norm(x) * (1 + e[1]) + e[0]))
+        dtype = self.precision.modulation
+        if time_modulation is not None:
+            e = time_modulation[self].chunk(2, dim=1)
+        elif e.dim() == 3:
+            e = [
+                u.squeeze(2) for u in (self.modulation.to(dtype).unsqueeze(0) +
+                                       e.to(dtype).unsqueeze(2)).chunk(2, dim=2)
+            ]
+        else:
+            e = (self.modulation.to(dtype) +
+                 e.to(dtype).unsqueeze(1)).chunk(2, dim=1)
+        with autocast(x.device, dtype):
+            x = self.project(x, e[0], e[1])
         return x
 
+    def project(self, x, shift, scale):
+        return self.head(
+            layernorm_modulate(x, shift, scale, self.norm.eps,
+                               self.precision.modulation))
+
 
 class MLPProj(torch.nn.Module):
 
@@ -476,13 +1068,11 @@ class WanModel(ModelMixin, ConfigMixin):
 
         # buffers (don't use register_buffer otherwise dtype will be changed in to())
         assert (dim % num_heads) == 0 and (dim // num_heads) % 2 == 0
-        d = dim // num_heads
-        self.freqs = torch.cat([
-            rope_params(1024, d - 4 * (d // 6)),
-            rope_params(1024, 2 * (d // 6)),
-            rope_params(1024, 2 * (d // 6))
-        ],
-                               dim=1)
+        self.rope = WanRotaryEmbedding(dim // num_heads, 1024)
+        self.head_sparsity = None
+        self.block_streamer = None
+        self.compile_bucket = None
+        self.precision = PrecisionPolicy()
 
         if model_type == 'i2v' or model_type == 'flf2v':
             self.img_emb = MLPProj(1280, dim, flf_pos_emb=model_type == 'flf2v')
@@ -498,6 +1088,13 @@ class WanModel(ModelMixin, ConfigMixin):
         seq_len,
         clip_fea=None,
         y=None,
+        packed=False,
+        context_cache=None,
+        time_embedding=None,
+        step_cache=None,
+        step=None,
+        t_host=None,
+        session=None,
     ):
         r"""
         Forward pass through the diffusion model
@@ -510,11 +1107,27 @@ class WanModel(ModelMixin, ConfigMixin):
             context (List[Tensor]):
                 List of text embeddings each with shape [L, C]
             seq_len (`int`):
-                Maximum sequence length for positional encoding
+                Maximum sequence length for positional encoding, ignored if packed
             clip_fea (Tensor, *optional*):
                 CLIP image features for image-to-video mode or first-last-frame-to-video mode
             y (List[Tensor], *optional*):
                 Conditional video inputs for image-to-video mode, same shape as x
+            packed (`bool`, *optional*, defaults to False):
+                Concatenate the tokens of all samples without padding and run the blocks in
+                varlen mode, so samples of different shapes share one forward
+            context_cache (WanContextCache, *optional*):
+                Per-generation cache of the embedded context and cross-attention keys/values
+            time_embedding (WanTimeEmbedding, *optional*):
+                Precomputed embeddings of this step from `precompute_time_embeddings`, replaces t
+            step_cache (StepCache, *optional*):
+                Per-generation cache of the blocks' residual, reused at steps its policy skips
+            step (`int`, *optional*):
+                Index of the sampling step, required with step_cache
+            t_host (`float`, *optional*):
+                Largest timestep of t on the host, so the per-step modes do not read t
+                back from the device
+            session (WanInferenceSession, *optional*):
+                Per-generation buffers of the padded tokens and output latents
 
         Returns:
             List[Tensor]:
@@ -524,33 +1137,377 @@ class WanModel(ModelMixin, ConfigMixin):
             assert clip_fea is not None and y is not None
         # params
         device = self.patch_embedding.weight.device
-        if self.freqs.device != device:
-            self.freqs = self.freqs.to(device)
 
         if y is not None:
             x = [torch.cat([u, v], dim=0) for u, v in zip(x, y)]
 
         # embeddings
-        x = [self.patch_embedding(u.unsqueeze(0)) for u in x]
-        grid_sizes = torch.stack(
-            [torch.tensor(u.shape[2:], dtype=torch.long) for u in x])
-        x = [u.flatten(2).transpose(1, 2) for u in x]
-        seq_lens = torch.tensor([u.size(1) for u in x], dtype=torch.long)
-        assert seq_lens.max() <= seq_len
-        x = torch.cat([
-            torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
-                      dim=1) for u in x
-        ])
+        if not packed:
+            seq_len = self.bucket_seq_len(seq_len)
+        if session is not None and not packed:
+            x, grid_sizes, seq_lens = self.patchify(x, seq_len, session)
+        else:
+            x = [self.patch_embedding(u.unsqueeze(0)) for u in x]
+            grid_sizes = torch.stack(
+                [torch.tensor(u.shape[2:], dtype=torch.long) for u in x])
+            x = [u.flatten(2).transpose(1, 2) for u in x]
+            seq_lens = torch.tensor([u.size(1) for u in x], dtype=torch.long)
+        padded_len = None if packed else seq_len
+        metadata = AttentionMetadata(
+            seq_lens, grid_sizes, device, padded_len=padded_len
+        ) if session is None else session.attention_metadata(
+            seq_lens, grid_sizes, device, padded_len=padded_len)
+        if packed:
+            x = torch.cat(x, dim=1)
+            cu_seqlens = metadata.cu_seqlens
+            freqs = self.rope.packed(grid_sizes, device)
+        else:
+            if session is None:
+                assert seq_lens.max() <= seq_len
+                x = torch.cat([
+                    torch.cat(
+                        [u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
+                        dim=1) for u in x
+                ])
+            cu_seqlens = None
+            freqs = self.rope(grid_sizes, seq_len, device)
 
         # time embeddings
-        with amp.autocast(dtype=torch.float32):
+        e, e0, time_modulation = self.embed_time(t, time_embedding)
+        if packed and e.size(0) > 1:
+            # per-token modulation for packed samples with their own timesteps
+            repeats = seq_lens.to(device, non_blocking=True)
+            e, e0 = (
+                u.repeat_interleave(repeats, dim=0,
+                                    output_size=x.size(1)).unsqueeze(0)
+                for u in (e, e0))
+        step_state, residual = (None, None) if step_cache is None else (
+            step_cache.lookup(context,
+                              self.step_signal(x, e0, time_modulation), step))
+
+        # context
+        context_lens = None
+        context, kv_cache = self.embed_context(context, clip_fea, context_cache)
+
+        t_modes = t if t_host is None else t_host
+        if self.head_sparsity is not None:
+            self.head_sparsity.step(self, t_modes)
+
+        # arguments
+        kwargs = dict(
+            e=e0,
+            seq_lens=seq_lens,
+            grid_sizes=grid_sizes,
+            freqs=freqs,
+            context=context,
+            context_lens=context_lens,
+            cu_seqlens=cu_seqlens,
+            kv_cache=kv_cache,
+            time_modulation=time_modulation,
+            local_attn=self.local_attention_at(t_modes),
+            token_merge=self.token_merging_at(t_modes),
+            metadata=metadata)
+
+        if residual is not None:
+            x = x + residual
+        else:
+            residual = x
+            for block in self.blocks:
+                x = block(x, **kwargs)
+            if step_state is not None:
+                step_cache.store(step_state, x - residual)
+
+        # head
+        x = self.head(x, e, time_modulation)
+        if packed:
+            x = x[0].split(seq_lens.tolist())
+
+        # unpatchify
+        x = self.unpatchify(x, grid_sizes, session)
+        return [u.float() for u in x]
+
+    def step_signal(self, x, e0, time_modulation=None):
+        r"""
+        Modulated input of the first attention block, the signal `StepCache`
+        compares between steps. Unlike the timestep embedding alone it follows
+        the content of the latent.
+        """
+        block = self.blocks[0]
+        shift, scale = block.modulate(e0, time_modulation)[:2]
+        return block.self_attn_input(x, shift, scale)
+
+    def _apply(self, fn, *args, **kwargs):
+        # weights streamed from host memory stay there, see `BlockStreamer`
+        streamer = self.__dict__.get('block_streamer')
+        if streamer is None:
+            return super()._apply(fn, *args, **kwargs)
+        with streamer.detached():
+            return super()._apply(fn, *args, **kwargs)
+
+    def set_local_attention(self,
+                            window_size,
+                            tile_size=(4, 8, 8),
+                            blocks=None,
+                            t_range=None):
+        r"""
+        Switches the self-attention of blocks to 3D local-window attention.
+
+        Args:
+            window_size (Tuple[`int`]):
+                (F, H, W) radius of the neighborhood in tokens, or None to restore
+                full attention
+            tile_size (Tuple[`int`], *optional*, defaults to (4, 8, 8)):
+                (F, H, W) tiles of the block-sparse kernel, the window is rounded
+                up to whole tiles
+            blocks (List[`int`], *optional*):
+                Indices into `self.blocks`, defaults to every attention block
+                including the VACE blocks
+            t_range (Tuple[`float`], *optional*):
+                Timestep range (low, high) using local attention, full attention
+                outside of it. Defaults to all timesteps
+        """
+        if blocks is None:
+            blocks = [
+                m for m in self.modules() if isinstance(m, WanAttentionBlock)
+            ]
+        else:
+            blocks = [self.blocks[i] for i in blocks]
+        for block in blocks:
+            attn = block.self_attn
+            attn.window_size = (-1, -1) if window_size is None else tuple(
+                window_size)
+            attn.tile_size = tuple(tile_size)
+            attn.local_t_range = t_range
+
+    def local_attention_at(self, t):
+        r"""
+        Self-attention modules using 3D local-window attention at timesteps t,
+        a tensor or the largest timestep as a float.
+        """
+        modules = [
+            m.self_attn
+            for m in self.modules()
+            if isinstance(m, WanAttentionBlock) and
+            len(m.self_attn.window_size) == 3
+        ]
+        if not modules:
+            return set()
+        t = t if isinstance(t, (int, float)) else float(t.max())
+        return {
+            m for m in modules if m.local_t_range is None or
+            m.local_t_range[0] <= t <= m.local_t_range[1]
+        }
+
+    def set_token_merging(self,
+                          ratio,
+                          stride=(1, 2, 2),
+                          blocks=None,
+                          t_range=None):
+        r"""
+        Merges similar tokens before the self-attention and FFN of blocks and
+        unmerges them afterwards.
+
+        Args:
+            ratio (`float`):
+                Share of the tokens merged away, 0 disables merging
+            stride (Tuple[`int`], *optional*, defaults to (1, 2, 2)):
+                (F, H, W) windows of one destination token each, tokens are only
+                merged into the destination of their window
+            blocks (List[`int`], *optional*):
+                Indices into `self.blocks`, defaults to every attention block
+                including the VACE blocks
+            t_range (Tuple[`float`], *optional*):
+                Timestep range (low, high) merging tokens. Defaults to all timesteps
+        """
+        assert 0 <= ratio < 1
+        if blocks is None:
+            blocks = [
+                m for m in self.modules() if isinstance(m, WanAttentionBlock)
+            ]
+        else:
+            blocks = [self.blocks[i] for i in blocks]
+        for block in blocks:
+            block.merge_ratio = ratio
+            block.merge_stride = tuple(stride)
+            block.merge_t_range = t_range
+
+    def token_merging_at(self, t):
+        r"""
+        Blocks merging tokens at timesteps t, a tensor or the largest timestep
+        as a float.
+        """
+        blocks = [
+            m for m in self.modules()
+            if isinstance(m, WanAttentionBlock) and m.merge_ratio > 0
+        ]
+        if not blocks:
+            return set()
+        t = t if isinstance(t, (int, float)) else float(t.max())
+        return {
+            m for m in blocks if m.merge_t_range is None or
+            m.merge_t_range[0] <= t <= m.merge_t_range[1]
+        }
+
+    def set_ffn_chunking(self, chunk_size, blocks=None):
+        r"""
+        Runs the adaLN modulation and FFN of blocks over sequence chunks to
+        lower the peak activation memory.
+
+        Args:
+            chunk_size (`int`):
+                Tokens per chunk, None runs the whole sequence at once
+            blocks (List[`int`], *optional*):
+                Indices into `self.blocks`, defaults to every attention block
+                including the VACE blocks
+        """
+        if blocks is None:
+            blocks = [
+                m for m in self.modules() if isinstance(m, WanAttentionBlock)
+            ]
+        else:
+            blocks = [self.blocks[i] for i in blocks]
+        for block in blocks:
+            block.ffn_chunk_size = chunk_size
+
+    def set_compile(self,
+                    enabled=True,
+                    bucket=None,
+                    cache_dir=None,
+                    backend='inductor',
+                    mode=None):
+        r"""
+        Compiles the elementwise regions of the attention blocks and the head
+        with `torch.compile`: the modulated norms, the FFN with its gated
+        residual and the residual adds. Attention stays eager. The parameters
+        are graph inputs, so identical blocks share one compiled graph.
+
+        Args:
+            enabled (`bool`, *optional*, defaults to True):
+                Compile the regions, False restores the eager methods
+            bucket (`int`, *optional*):
+                Round the padded sequence length up to a multiple of this many
+                tokens, so different video sizes reuse the compiled graphs.
+                The padding turns off token merging, which needs unpadded
+                samples
+            cache_dir (`str`, *optional*):
+                Directory of the inductor cache, compiled artifacts stored
+                there are reused by later processes
+            backend (`str`, *optional*, defaults to 'inductor'):
+                Backend of `torch.compile`, inductor also compiles for CPU
+            mode (`str`, *optional*):
+                Mode of `torch.compile`, e.g. 'max-autotune'
+        """
+        if enabled:
+            import torch._dynamo.config
+            import torch._inductor.config
+            torch._dynamo.config.inline_inbuilt_nn_modules = True
+            if cache_dir is not None:
+                os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(
+                    cache_dir)
+                torch._inductor.config.fx_graph_cache = True
+
+        regions = [(self.head, ('project',))] + [
+            (m, ('self_attn_input', 'residual', 'ffn_residual'))
+            for m in self.modules()
+            if isinstance(m, WanAttentionBlock)
+        ]
+        for module, names in regions:
+            for name in names:
+                module.__dict__.pop(name, None)
+                if enabled:
+                    module.__dict__[name] = torch.compile(
+                        getattr(module, name), backend=backend, mode=mode)
+        self.compile_bucket = bucket if enabled else None
+
+    def bucket_seq_len(self, seq_len, multiple=1):
+        r"""
+        Padded sequence length of the blocks, `seq_len` rounded up to a
+        multiple of `compile_bucket` and of `multiple`, e.g. the sequence
+        parallel size.
+        """
+        if self.compile_bucket is None:
+            return seq_len
+        bucket = math.lcm(self.compile_bucket, multiple)
+        return -(-seq_len // bucket) * bucket
+
+    def set_precision(self, policy):
+        r"""
+        Sets the dtypes the blocks and the head store their activations in.
+
+        Args:
+            policy (PrecisionPolicy or `str`):
+                Policy or the name of one of `PrecisionPolicy.PRESETS`
+        """
+        if isinstance(policy, str):
+            policy = PrecisionPolicy.preset(policy)
+        self.precision = policy
+        for m in self.modules():
+            if isinstance(m, (WanAttentionBlock, Head)):
+                m.precision = policy
+
+    def set_head_sparsity(self, profile):
+        r"""
+        Runs the self-attention heads with the sparsity pattern of a profile.
+
+        Args:
+            profile (HeadSparsityProfile):
+                Classification of the heads, calibrated during the first forwards
+                if its file does not exist yet. None restores dense attention
+        """
+        for m in self.modules():
+            if isinstance(m, WanAttentionBlock):
+                m.self_attn.head_types = None
+                m.self_attn.head_profile = None
+        self.head_sparsity = profile
+        if profile is not None:
+            profile.apply(self)
+
+    def embed_time(self, t, time_embedding=None):
+        r"""
+        Compute the time embeddings of timesteps t.
+
+        Args:
+            t (Tensor):
+                Diffusion timesteps tensor of shape [B]
+            time_embedding (WanTimeEmbedding, *optional*):
+                Precomputed embeddings of this step, returned instead of computing them
+
+        Returns:
+            Tuple[Tensor, Tensor, dict]:
+                Embedding e of shape [B, C], its projection e0 of shape [B, 6, C] and the
+                precomputed modulation per module, or None if computed on the fly
+        """
+        if time_embedding is not None:
+            return time_embedding.e, time_embedding.e0, time_embedding.modulation
+        with autocast(t.device, torch.float32):
             e = self.time_embedding(
                 sinusoidal_embedding_1d(self.freq_dim, t).float())
             e0 = self.time_projection(e).unflatten(1, (6, self.dim))
-            assert e.dtype == torch.float32 and e0.dtype == torch.float32
+        dtype = self.precision.modulation
+        return e.to(dtype), e0.to(dtype), None
+
+    def embed_context(self, context, clip_fea=None, context_cache=None):
+        r"""
+        Embed text context, prepended by the CLIP image context if given.
+
+        Args:
+            context (List[Tensor]):
+                List of text embeddings each with shape [L, C]
+            clip_fea (Tensor, *optional*):
+                CLIP image features for image-to-video mode or first-last-frame-to-video mode
+            context_cache (WanContextCache, *optional*):
+                Cache reusing the embedding and cross-attention keys/values across steps
+
+        Returns:
+            Tuple[Tensor, dict]:
+                Embedded context of shape [B, L, C] and the keys/values cache of the
+                cross-attention modules, or None without `context_cache`
+        """
+        if context_cache is not None:
+            entry = context_cache.lookup(context, clip_fea)
+            if entry['context'] is not None:
+                return entry['context'], entry['kv']
 
-        # context
-        context_lens = None
         context = self.text_embedding(
             torch.stack([
                 torch.cat(
@@ -560,28 +1517,57 @@ class WanModel(ModelMixin, ConfigMixin):
 
         if clip_fea is not None:
             context_clip = self.img_emb(clip_fea)  # bs x 257 (x2) x dim
+            context_clip = context_clip.expand(context.size(0), -1, -1)
             context = torch.concat([context_clip, context], dim=1)
 
-        # arguments
-        kwargs = dict(
-            e=e0,
-            seq_lens=seq_lens,
-            grid_sizes=grid_sizes,
-            freqs=self.freqs,
-            context=context,
-            context_lens=context_lens)
+        if context_cache is None:
+            return context, None
+        entry['context'] = context
+        return context, entry['kv']
 
-        for block in self.blocks:
-            x = block(x, **kwargs)
+    def patchify(self, x, seq_len, session):
+        r"""
+        Patch embedding written into the padded token buffer of a session. The
+        convolution runs as one matmul per sample over the small input patches,
+        so the large token tensor is written once and never copied.
 
-        # head
-        x = self.head(x, e)
+        Args:
+            x (List[Tensor]):
+                List of input video tensors, each with shape [C_in, F, H, W]
+            seq_len (`int`):
+                Padded sequence length
+            session (WanInferenceSession):
+                Owner of the token buffer
 
-        # unpatchify
-        x = self.unpatchify(x, grid_sizes)
-        return [u.float() for u in x]
+        Returns:
+            Tuple[Tensor, Tensor, Tensor]:
+                Tokens of shape [B, seq_len, C], grid_sizes of shape [B, 3] and
+                seq_lens of shape [B]
+        """
+        weight, bias = self.patch_embedding.weight, self.patch_embedding.bias
+        dtype = _autocast_dtype(weight.device) or weight.dtype
+        weight, bias = weight.to(dtype).flatten(1), bias.to(dtype)
+        pt, ph, pw = self.patch_size
+        grid_sizes = torch.tensor(
+            [[u.size(1) // pt, u.size(2) // ph, u.size(3) // pw] for u in x],
+            dtype=torch.long)
+        seq_lens = grid_sizes.prod(dim=1)
+        assert seq_lens.max() <= seq_len
 
-    def unpatchify(self, x, grid_sizes):
+        tokens = session.buffer('tokens', (len(x), seq_len, self.dim), dtype,
+                                weight.device)
+        for u, out, (f, h, w) in zip(x, tokens, grid_sizes.tolist()):
+            patches = u[:, :f * pt, :h * ph, :w * pw].to(dtype).reshape(
+                -1, f, pt, h, ph, w, pw).permute(1, 3, 5, 0, 2, 4, 6)
+            torch.addmm(
+                bias,
+                patches.reshape(f * h * w, -1),
+                weight.t(),
+                out=out[:f * h * w])
+            out[f * h * w:].zero_()
+        return tokens, grid_sizes, seq_lens
+
+    def unpatchify(self, x, grid_sizes, session=None):
         r"""
         Reconstruct video tensors from patch embeddings.
 
@@ -591,6 +1577,9 @@ class WanModel(ModelMixin, ConfigMixin):
             grid_sizes (Tensor):
                 Original spatial-temporal grid dimensions before patching,
                     shape [B, 3] (3 dimensions correspond to F_patches, H_patches, W_patches)
+            session (WanInferenceSession, *optional*):
+                Owner of float32 output buffers the patches are scattered into
+                with a single copy
 
         Returns:
             List[Tensor]:
@@ -599,11 +1588,21 @@ class WanModel(ModelMixin, ConfigMixin):
 
         c = self.out_dim
         out = []
-        for u, v in zip(x, grid_sizes.tolist()):
+        if session is not None:
+            session.turn ^= 1
+        for b, (u, v) in enumerate(zip(x, grid_sizes.tolist())):
             u = u[:math.prod(v)].view(*v, *self.patch_size, c)
-            u = torch.einsum('fhwpqrc->cfphqwr', u)
-            u = u.reshape(c, *[i * j for i, j in zip(v, self.patch_size)])
-            out.append(u)
+            shape = (c, *[i * j for i, j in zip(v, self.patch_size)])
+            if session is None:
+                u = torch.einsum('fhwpqrc->cfphqwr', u)
+                out.append(u.reshape(shape))
+                continue
+            latent = session.buffer(f'latent{session.turn}_{b}', shape,
+                                    torch.float32, u.device)
+            latent.view(c, v[0], self.patch_size[0], v[1], self.patch_size[1],
+                        v[2], self.patch_size[2]).copy_(
+                            u.permute(6, 0, 3, 1, 4, 2, 5))
+            out.append(latent)
         return out
 
     def init_weights(self):
@@ -629,3 +1628,58 @@ class WanModel(ModelMixin, ConfigMixin):
 
         # init output layer
         nn.init.zeros_(self.head.head.weight)
+
+
+class WanTimeEmbedding:
+    r"""
+    Time embeddings of one sampling step, see `precompute_time_embeddings`.
+
+    Attributes:
+        e (Tensor): Shape [1, C]
+        e0 (Tensor): Shape [1, 6, C]
+        modulation (dict): `module.modulation + e` of every `WanAttentionBlock`
+            (shape [1, 6, C]) and `Head` (shape [1, 2, C]) of the model
+    """
+
+    def __init__(self, e, e0, modulation):
+        self.e = e
+        self.e0 = e0
+        self.modulation = modulation
+
+
+@torch.no_grad()
+def precompute_time_embeddings(model, timesteps):
+    r"""
+    Compute the time embeddings and the per-block modulation of every step of
+    a sampling schedule in one batched pass.
+
+    Args:
+        model (WanModel):
+            DiT model, including subclasses such as VaceWanModel
+        timesteps (Tensor):
+            Scheduled timesteps of shape [S]
+
+    Returns:
+        List[WanTimeEmbedding]:
+            Embeddings of each step, to be passed as `time_embedding` to the forward.
+            FSDP-sharded models only gather their parameters inside forward, so they
+            get None for every step and compute the embeddings on the fly, as do
+            exported models, which embed the timestep inside their graph.
+    """
+    if not isinstance(model, WanModel):
+        return [None] * len(timesteps)
+
+    device = model.patch_embedding.weight.device
+    e, e0, _ = model.embed_time(timesteps.to(device))
+    modulation = {}
+    for m in model.modules():
+        if isinstance(m, WanAttentionBlock):
+            modulation[m] = m.modulation.to(m.precision.modulation) + e0
+        elif isinstance(m, Head):
+            modulation[m] = m.modulation.to(
+                m.precision.modulation) + e.unsqueeze(1)
+    return [
+        WanTimeEmbedding(e[i:i + 1], e0[i:i + 1],
+                         {m: u[i:i + 1] for m, u in modulation.items()})
+        for i in range(len(timesteps))
+    ]
@@ -0,0 +1,50 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import torch
+
+__all__ = ['PrecisionPolicy']
+
+
+class PrecisionPolicy:
+    r"""
+    Dtypes the DiT stores its activations in between ops. Norms, softmax and
+    matmuls accumulate in float32 inside their kernels regardless, and the
+    matmuls themselves run in the dtype of the surrounding autocast.
+
+    Args:
+        modulation (torch.dtype, *optional*, defaults to torch.float32):
+            Time embeddings, modulation tables and the head projection
+        residual (torch.dtype, *optional*, defaults to torch.float32):
+            Residual stream between and inside the blocks
+        adaln (torch.dtype, *optional*, defaults to torch.float32):
+            Output of the modulated norms feeding the attention and the FFN.
+            Under a bfloat16 autocast, bfloat16 gives the same results as
+            float32 with half the traffic, since the linears cast it anyway.
+    """
+
+    PRESETS = {
+        # the numerics of the original implementation
+        'fp32': dict(),
+        'bf16_adaln': dict(adaln=torch.bfloat16),
+        'bf16_residual': dict(residual=torch.bfloat16, adaln=torch.bfloat16),
+        'bf16': dict(
+            modulation=torch.bfloat16,
+            residual=torch.bfloat16,
+            adaln=torch.bfloat16),
+    }
+
+    def __init__(self,
+                 modulation=torch.float32,
+                 residual=torch.float32,
+                 adaln=torch.float32):
+        self.modulation = modulation
+        self.residual = residual
+        self.adaln = adaln
+
+    @classmethod
+    def preset(cls, name):
+        assert name in cls.PRESETS, f'Unsupported precision policy: {name}'
+        return cls(**cls.PRESETS[name])
+
+    def __repr__(self):
+        return (f'PrecisionPolicy(modulation={self.modulation}, '
+                f'residual={self.residual}, adaln={self.adaln})')
@@ -0,0 +1,482 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import functools
+import hashlib
+import json
+import logging
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .model import WanAttentionBlock
+from .t5 import T5FeedForward, T5SelfAttention
+
+__all__ = [
+    'QuantLinear',
+    'quantize_model',
+    'save_quantized',
+    'load_quantized',
+    'quantize_pipeline',
+    'W8A8Calibration',
+]
+
+QUANT_MODES = ('int8', 'int4', 'fp8', 'w8a8')
+
+# largest magnitude of each storage format
+_QMAX = {'int8': 127., 'int4': 7., 'fp8': 448., 'w8a8': 127.}
+
+
+def _quantize(weight, mode, group_size):
+    r"""
+    Symmetric quantization of weight [out, in] with one scale per output
+    channel and group of `group_size` input channels.
+    """
+    out_features, in_features = weight.shape
+    w = weight.float().view(out_features, -1, group_size)
+    scale = w.abs().amax(dim=-1, keepdim=True).clamp_min(1e-8) / _QMAX[mode]
+    w = w / scale
+    if mode == 'fp8':
+        q = w.to(torch.float8_e4m3fn)
+    else:
+        q = w.round().clamp(-_QMAX[mode] - 1, _QMAX[mode]).to(torch.int8)
+    q = q.view(out_features, in_features)
+    if mode == 'int4':
+        # two values per byte, the even input channel in the low nibble
+        q = (q + 8).to(torch.uint8)
+        q = q[:, 0::2] | (q[:, 1::2] << 4)
+    return q, scale.squeeze(-1)
+
+
+def _quantize_tokens(x):
+    r"""
+    Symmetric int8 quantization of x [L, C] with one scale per token.
+    """
+    scale = x.abs().amax(dim=-1, keepdim=True).clamp_min(1e-8) / 127.
+    return (x / scale).round().clamp(-128, 127).to(torch.int8), scale
+
+
+def _int8_matmul(a, b):
+    r"""
+    a [M, K] @ b[N, K].T of int8 matrices, accumulated exactly in int32 by
+    `torch._int_mm` where the device supports the shapes.
+    """
+    if a.device.type == 'cpu' or (a.size(0) > 16 and a.size(1) % 8 == 0 and
+                                  b.size(0) % 8 == 0):
+        return torch._int_mm(a, b.t())
+    return torch.matmul(a.float(), b.float().t())
+
+
+class QuantLinear(nn.Module):
+    r"""
+    Linear layer with weight-only quantized storage. The weight is dequantized
+    to `dtype` on the fly, which makes the forward a plain PyTorch reference
+    kernel that runs on any device.
+
+    In 'w8a8' mode the activations are quantized to int8 as well, with one
+    dynamic scale per token, and the product runs as an int8 matmul with
+    int32 accumulation. This is the fast path on CPU, where bf16 matmuls are
+    compute bound.
+
+    Args:
+        in_features (`int`):
+            Input channels
+        out_features (`int`):
+            Output channels
+        bias (`bool`, *optional*, defaults to True):
+            Whether the layer has a bias
+        mode (`str`, *optional*, defaults to 'int8'):
+            Storage format, 'int8', 'int4', 'fp8' (e4m3) or 'w8a8'
+        group_size (`int`, *optional*):
+            Input channels sharing one scale, defaults to one scale per output
+            channel. Not supported by 'w8a8'.
+        dtype (torch.dtype, *optional*, defaults to torch.bfloat16):
+            Dtype of the dequantized weight and of the bias
+    """
+
+    def __init__(self,
+                 in_features,
+                 out_features,
+                 bias=True,
+                 mode='int8',
+                 group_size=None,
+                 dtype=torch.bfloat16):
+        assert mode in QUANT_MODES, f'Unsupported quantization mode: {mode}'
+        group_size = group_size or in_features
+        assert in_features % group_size == 0
+        assert mode != 'w8a8' or group_size == in_features
+        assert mode != 'int4' or in_features % 2 == 0
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.mode = mode
+        self.group_size = group_size
+        self.dtype = dtype
+
+        storage = {
+            'int8': (torch.int8, in_features),
+            'w8a8': (torch.int8, in_features),
+            'int4': (torch.uint8, in_features // 2),
+            'fp8': (torch.float8_e4m3fn, in_features)
+        }[mode]
+        self.register_buffer(
+            'qweight', torch.empty(out_features, storage[1], dtype=storage[0]))
+        self.register_buffer(
+            'scale',
+            torch.empty(
+                out_features, in_features // group_size, dtype=torch.float32))
+        self.bias = nn.Parameter(
+            torch.zeros(out_features, dtype=dtype),
+            requires_grad=False) if bias else None
+
+    @classmethod
+    def from_linear(cls, linear, mode='int8', group_size=None):
+        layer = cls(
+            linear.in_features,
+            linear.out_features,
+            linear.bias is not None,
+            mode,
+            group_size,
+            dtype=linear.weight.dtype).to(linear.weight.device)
+        layer.qweight, layer.scale = _quantize(linear.weight.data, mode,
+                                               layer.group_size)
+        if linear.bias is not None:
+            layer.bias.data.copy_(linear.bias.data)
+        return layer
+
+    def dequantize(self, dtype=None):
+        r"""
+        The weight of shape [out_features, in_features] in dtype.
+        """
+        dtype = dtype or self.dtype
+        q = self.qweight
+        if self.mode == 'int4':
+            q = torch.stack([q & 15, q >> 4], dim=-1).flatten(1).to(
+                torch.int8) - 8
+        w = q.to(dtype).view(self.out_features, -1, self.group_size)
+        return (w * self.scale.to(dtype).unsqueeze(-1)).flatten(1)
+
+    def forward(self, x):
+        if self.mode == 'w8a8':
+            return self.forward_w8a8(x)
+        return F.linear(x, self.dequantize(), self.bias)
+
+    def forward_w8a8(self, x):
+        xq, scale = _quantize_tokens(x.reshape(-1, self.in_features).float())
+        y = _int8_matmul(xq, self.qweight).float() * scale * self.scale.t()
+        if self.bias is not None:
+            y = y + self.bias.float()
+        return y.to(x.dtype).view(*x.shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        return (f'in_features={self.in_features}, '
+                f'out_features={self.out_features}, '
+                f'bias={self.bias is not None}, mode={self.mode}, '
+                f'group_size={self.group_size}')
+
+
+def _quantizable(model, mode='int8'):
+    r"""
+    (name, parent, attribute, linear) of every nn.Linear inside the DiT blocks,
+    including the VACE blocks, and inside the T5 encoder blocks. For 'w8a8'
+    only the T5 feed forward layers are candidates on the T5 side.
+    """
+    types = (WanAttentionBlock,
+             T5FeedForward if mode == 'w8a8' else T5SelfAttention)
+    seen = set()
+    for block_name, block in model.named_modules():
+        if not isinstance(block, types):
+            continue
+        for parent_name, parent in block.named_modules():
+            for attr, child in parent.named_children():
+                if isinstance(child, nn.Linear) and child not in seen:
+                    seen.add(child)
+                    name = '.'.join(
+                        n for n in (block_name, parent_name, attr) if n)
+                    yield name, parent, attr, child
+
+
+def quantize_model(model,
+                   mode='int8',
+                   group_size=None,
+                   quantize=True,
+                   layers=None):
+    r"""
+    Replaces the linears of the DiT and T5 encoder blocks of model by
+    `QuantLinear` layers.
+
+    Args:
+        model (nn.Module):
+            WanModel, VaceWanModel or T5Encoder
+        mode (`str`, *optional*, defaults to 'int8'):
+            Storage format, 'int8', 'int4', 'fp8' or 'w8a8'
+        group_size (`int`, *optional*):
+            Input channels sharing one scale, defaults to per output channel
+        quantize (`bool`, *optional*, defaults to True):
+            Quantize the current weights. If False, the layers are only replaced
+            by empty ones, e.g. to load a quantized state dict into
+        layers (List[`str`], *optional*):
+            Names of the linears to replace, defaults to all candidates
+
+    Returns:
+        dict:
+            Number of layers, their weight bytes before and after quantization and
+            the mean and max relative L2 error of the dequantized weights
+    """
+    layers = None if layers is None else set(layers)
+    report = dict(
+        layers=0, bytes_before=0, bytes_after=0, mean_error=0., max_error=0.)
+    for name, parent, attr, linear in list(_quantizable(model, mode)):
+        if layers is not None and name not in layers:
+            continue
+        if quantize:
+            layer = QuantLinear.from_linear(linear, mode, group_size)
+            w = linear.weight.float()
+            error = float((layer.dequantize(torch.float32) - w).norm() /
+                          w.norm().clamp_min(1e-12))
+            report['mean_error'] += error
+            report['max_error'] = max(report['max_error'], error)
+        else:
+            layer = QuantLinear(
+                linear.in_features,
+                linear.out_features,
+                linear.bias is not None,
+                mode,
+                group_size,
+                dtype=linear.weight.dtype).to(linear.weight.device)
+        report['layers'] += 1
+        report['bytes_before'] += sum(
+            p.numel() * p.element_size() for p in linear.parameters())
+        report['bytes_after'] += sum(
+            u.numel() * u.element_size()
+            for u in (layer.qweight, layer.scale, layer.bias)
+            if u is not None)
+        setattr(parent, attr, layer)
+    if report['layers']:
+        report['mean_error'] /= report['layers']
+    logging.info(
+        f"Quantized {report['layers']} linears of {type(model).__name__} to "
+        f"{mode}: {report['bytes_before'] / 2**30:.2f} GiB -> "
+        f"{report['bytes_after'] / 2**30:.2f} GiB" +
+        (f", relative weight error mean {report['mean_error']:.2e} max "
+         f"{report['max_error']:.2e}." if quantize else "."))
+    return report
+
+
+def save_quantized(model, path, source=None):
+    r"""
+    Saves the state dict of a quantized model together with its mode, group
+    size, quantized layers and the checkpoint it was quantized from.
+    """
+    names = [
+        name for name, m in model.named_modules() if isinstance(m, QuantLinear)
+    ]
+    layer = model.get_submodule(names[0])
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    torch.save(
+        dict(
+            mode=layer.mode,
+            group_size=layer.group_size
+            if layer.group_size != layer.in_features else None,
+            layers=names,
+            source=source,
+            state_dict=model.state_dict()), path)
+
+
+def load_quantized(model, path, source=None):
+    r"""
+    Replaces the linears of model like `quantize_model` and loads a checkpoint
+    written by `save_quantized` into it. If source is given, the checkpoint
+    has to be quantized from it, models of the same architecture would load
+    each other's weights without an error otherwise.
+    """
+    checkpoint = torch.load(path, map_location='cpu')
+    assert source is None or checkpoint.get('source') == source, \
+        f'{path} was quantized from {checkpoint.get("source")}, not {source}.'
+    quantize_model(
+        model,
+        checkpoint['mode'],
+        checkpoint['group_size'],
+        quantize=False,
+        layers=checkpoint['layers'])
+    model.load_state_dict(checkpoint['state_dict'])
+    return model
+
+
+def quantize_pipeline(pipeline,
+                      mode='int8',
+                      group_size=None,
+                      cache_dir=None,
+                      calibration=None,
+                      checkpoint_dir=None):
+    r"""
+    Quantizes the DiT and the T5 encoder of a generation pipeline.
+
+    Args:
+        pipeline (WanT2V, WanI2V, WanFLF2V or WanVace):
+            Pipeline whose `model` is not moved to the device or sharded yet
+        mode (`str`, *optional*, defaults to 'int8'):
+            Storage format, 'int8', 'int4', 'fp8' or 'w8a8'
+        group_size (`int`, *optional*):
+            Input channels sharing one scale, defaults to per output channel
+        cache_dir (`str`, *optional*):
+            Directory of quantized checkpoints, loaded if present and written otherwise
+        calibration (W8A8Calibration, *optional*):
+            Selects the layers quantized in 'w8a8' mode, defaults to all candidates
+        checkpoint_dir (`str`, *optional*):
+            Directory the DiT was loaded from, required with cache_dir. The cached
+            checkpoints are keyed on it and on the T5 checkpoint
+    """
+    assert calibration is None or mode == 'w8a8'
+    assert cache_dir is None or checkpoint_dir is not None, \
+        'The quantized checkpoint cache is keyed on checkpoint_dir.'
+    suffix = mode if group_size is None else f'{mode}_g{group_size}'
+    for name, model, source in (
+        ('dit', pipeline.model, checkpoint_dir),
+        ('t5', pipeline.text_encoder.model,
+         pipeline.text_encoder.checkpoint_path),
+    ):
+        if calibration is not None:
+            calibration.apply(name, model)
+            continue
+        path = None
+        if cache_dir is not None:
+            source = os.path.abspath(source)
+            digest = hashlib.sha1(source.encode()).hexdigest()[:12]
+            path = os.path.join(cache_dir, f'{name}_{suffix}_{digest}.pth')
+        if path is not None and os.path.exists(path):
+            logging.info(f'Loading quantized {name} from {path}')
+            load_quantized(model, path, source)
+            continue
+        quantize_model(model, mode, group_size)
+        if path is not None and pipeline.rank == 0:
+            save_quantized(model, path, source)
+
+
+class W8A8Calibration:
+    r"""
+    Selects the linears that are safe to run in 'w8a8' mode and stores the
+    selection per checkpoint.
+
+    Without an existing selection file, each model runs unquantized while the
+    output of every candidate linear is compared with its simulated W8A8
+    output. For the DiT, whose forwards get the sampling step, the errors are
+    taken at `steps` steps `stride` apart, so that the selection covers early
+    and late noise levels, and the selected linears are quantized from the
+    step after the last observed one. Models called without a step, such as
+    the T5 encoder, are calibrated on their first forward. The file is
+    written once all models are calibrated.
+
+    Args:
+        path (`str`):
+            JSON selection of the checkpoint, loaded if it exists
+        threshold (`float`, *optional*, defaults to 0.02):
+            Largest relative L2 error of the output of a quantized linear
+        steps (`int`, *optional*, defaults to 4):
+            Sampling steps the DiT errors are taken at
+        stride (`int`, *optional*, defaults to 8):
+            Sampling steps between two observed steps
+    """
+
+    def __init__(self, path, threshold=0.02, steps=4, stride=8):
+        assert steps > 0 and stride > 0
+        self.path = path
+        self.threshold = threshold
+        self.steps = steps
+        self.stride = stride
+        self.layers = {}
+        self.errors = {}
+        self.active = {}
+        self.pending = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.layers = json.load(f)['layers']
+            logging.info(f'Loaded W8A8 layer selection {path}.')
+
+    def apply(self, name, model):
+        r"""
+        Quantizes the selected linears of model, or calibrates them during its
+        next forwards if no selection is stored under name.
+        """
+        if name in self.layers:
+            quantize_model(model, 'w8a8', layers=self.layers[name])
+            return
+        self.errors[name] = {}
+        handles = [
+            linear.register_forward_hook(
+                functools.partial(self.observe, name, layer))
+            for layer, _, _, linear in _quantizable(model, 'w8a8')
+        ]
+        handles += [
+            model.register_forward_pre_hook(
+                functools.partial(self.step, name), with_kwargs=True),
+            model.register_forward_hook(
+                functools.partial(self.forwarded, name), with_kwargs=True),
+        ]
+        self.pending[name] = (model, handles)
+
+    def step(self, name, model, args, kwargs):
+        step = kwargs.get('step')
+        if step is not None and step > (self.steps - 1) * self.stride:
+            self.finish(name)
+        else:
+            self.active[name] = step is None or step % self.stride == 0
+
+    def forwarded(self, name, model, args, kwargs, output):
+        if kwargs.get('step') is None:
+            self.finish(name)
+
+    @torch.no_grad()
+    def observe(self, name, layer, linear, args, output):
+        if not self.active[name]:
+            return
+        x = args[0].reshape(-1, linear.in_features).float()
+        xq, scale = _quantize_tokens(x)
+        wq, wscale = _quantize(linear.weight, 'w8a8', linear.in_features)
+        y = torch.matmul(xq.float() * scale, (wq.float() * wscale).t())
+        if linear.bias is not None:
+            y += linear.bias.float()
+        ref = output.reshape(-1, linear.out_features).float()
+        error = float((y - ref).norm() / ref.norm().clamp_min(1e-12))
+        errors = self.errors[name]
+        errors[layer] = max(errors.get(layer, 0.), error)
+
+    def finish(self, name):
+        r"""
+        Selects and quantizes the linears of the model calibrated under name
+        from the errors observed so far.
+        """
+        model, handles = self.pending.pop(name)
+        for handle in handles:
+            handle.remove()
+        errors = self.errors.pop(name)
+        self.active.pop(name, None)
+        self.layers[name] = sorted(
+            layer for layer, error in errors.items()
+            if error <= self.threshold)
+        logging.info(
+            f'W8A8 calibration of {name}: {len(self.layers[name])} of '
+            f'{len(errors)} linears within a relative error of '
+            f'{self.threshold}.')
+        quantize_model(model, 'w8a8', layers=self.layers[name])
+        if not self.pending:
+            self.save()
+
+    def close(self):
+        r"""
+        Finishes the models whose schedule ended before their last observed
+        step, to be called after the generation.
+        """
+        for name in list(self.pending):
+            self.finish(name)
+
+    def save(self):
+        if dist.is_initialized() and dist.get_rank() != 0:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(
+                dict(threshold=self.threshold, layers=self.layers), f, indent=2)
+        os.replace(tmp, self.path)
@@ -0,0 +1,153 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import itertools
+import logging
+from contextlib import contextmanager
+
+import torch
+from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+
+from .model import WanAttentionBlock
+
+__all__ = ['BlockStreamer']
+
+
+class BlockStreamer:
+    r"""
+    Runs the attention blocks of a model from pinned host memory.
+
+    The weights of a streamed block are copied to the device on a side stream
+    while the previous block computes, and dropped again after its forward.
+    The order of the blocks is learned from the first forward, so from the
+    second forward on every copy overlaps with the computation of the block
+    before. Blocks that fit into the VRAM budget next to the two streaming
+    slots stay resident. The small per-block modulation tables always stay on
+    the device.
+
+    The streamed weights are skipped by `model.to()` and `model.cpu()`, so
+    pipelines can keep offloading the rest of the model as before. Build the
+    streamer while the model is still in host memory and move it to the
+    device afterwards, so the full set of blocks never has to fit into VRAM.
+
+    Args:
+        model (WanModel):
+            DiT model, including subclasses such as VaceWanModel
+        device (torch.device):
+            CUDA device the model runs on
+        budget (`int`, *optional*):
+            VRAM in bytes for the block weights, defaults to streaming every block
+    """
+
+    def __init__(self, model, device, budget=None):
+        assert not isinstance(model, FSDP), \
+            'Block streaming is not supported with FSDP.'
+        self.device = torch.device(device)
+        assert self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device)
+
+        blocks = [
+            m for m in model.modules() if isinstance(m, WanAttentionBlock)
+        ]
+        sizes = [
+            sum(p.numel() * p.element_size()
+                for p in itertools.chain(block.parameters(), block.buffers()))
+            for block in blocks
+        ]
+        resident = 0
+        if budget is not None:
+            budget -= 2 * max(sizes)
+            while resident < len(blocks) and budget >= sizes[resident]:
+                budget -= sizes[resident]
+                resident += 1
+        for block in blocks[:resident]:
+            block.to(self.device)
+
+        self.blocks = blocks[resident:]
+        self.weights = {}
+        self.loaded = {}
+        self.next = {}
+        self.last = None
+        self.handles = []
+        for block in self.blocks:
+            block.modulation.data = block.modulation.data.to(self.device)
+            self.weights[block] = []
+            for module in block.children():
+                for p in itertools.chain(module.parameters(),
+                                         module.buffers()):
+                    p.data = p.data.cpu().pin_memory()
+                    self.weights[block].append((p, p.data))
+            self.handles.append(
+                block.register_forward_pre_hook(self.before_forward))
+            self.handles.append(
+                block.register_forward_hook(self.after_forward))
+        torch.cuda.empty_cache()
+        model.block_streamer = self
+        self.model = model
+        logging.info(
+            f'Streaming {len(self.blocks)} of {len(blocks)} attention blocks '
+            f'from pinned memory, {resident} stay resident.')
+
+    @contextmanager
+    def detached(self):
+        r"""
+        Hides the streamed submodules of the blocks, so module-wide `_apply`
+        calls like `to()` leave their weights in host memory.
+        """
+        children = [(block, name, module)
+                    for block in self.blocks
+                    for name, module in block.named_children()]
+        for block, name, _ in children:
+            block._modules[name] = None
+        try:
+            yield
+        finally:
+            for block, name, module in children:
+                block._modules[name] = module
+
+    def load(self, block):
+        r"""
+        Starts copying the weights of block to the device on the side stream.
+        """
+        if block in self.loaded:
+            return
+        with torch.cuda.stream(self.stream):
+            weights = [
+                host.to(self.device, non_blocking=True)
+                for _, host in self.weights[block]
+            ]
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.loaded[block] = (weights, event)
+
+    def before_forward(self, block, args):
+        if self.last is not None:
+            self.next[self.last] = block
+        self.last = block
+
+        self.load(block)
+        weights, event = self.loaded[block]
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(event)
+        for (p, _), weight in zip(self.weights[block], weights):
+            # the copies were allocated on the side stream
+            weight.record_stream(stream)
+            p.data = weight
+
+        if block in self.next:
+            self.load(self.next[block])
+
+    def after_forward(self, block, args, output):
+        for p, host in self.weights[block]:
+            p.data = host
+        del self.loaded[block]
+
+    def remove(self):
+        r"""
+        Stops streaming, the blocks stay in host memory.
+        """
+        for handle in self.handles:
+            handle.remove()
+        for block in self.blocks:
+            for p, host in self.weights[block]:
+                p.data = host
+        self.loaded.clear()
+        self.model.block_streamer = None
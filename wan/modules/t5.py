@@ -7,6 +7,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .attention import attention
 from .tokenizers import HuggingfaceTokenizer
 
 __all__ = [
@@ -83,6 +84,9 @@ class T5Attention(nn.Module):
         self.o = nn.Linear(dim_attn, dim, bias=False)
         self.dropout = nn.Dropout(dropout)
 
+        # concatenated q/k/v of self-attention, see `fuse_projections`
+        self.qkv = None
+
     def forward(self, x, context=None, mask=None, pos_bias=None):
         """
         x:          [B, L1, C].
@@ -94,9 +98,14 @@ class T5Attention(nn.Module):
         b, n, c = x.size(0), self.num_heads, self.head_dim
 
         # compute query, key, value
-        q = self.q(x).view(b, -1, n, c)
-        k = self.k(context).view(b, -1, n, c)
-        v = self.v(context).view(b, -1, n, c)
+        if self.qkv is not None:
+            assert context is x
+            q, k, v = (
+                u.view(b, -1, n, c) for u in self.qkv(x).chunk(3, dim=-1))
+        else:
+            q = self.q(x).view(b, -1, n, c)
+            k = self.k(context).view(b, -1, n, c)
+            v = self.v(context).view(b, -1, n, c)
 
         # attention bias
         attn_bias = x.new_zeros(b, n, q.size(1), k.size(1))
@@ -109,9 +118,7 @@ class T5Attention(nn.Module):
             attn_bias.masked_fill_(mask == 0, torch.finfo(x.dtype).min)
 
         # compute attention (T5 does not use scaling)
-        attn = torch.einsum('binc,bjnc->bnij', q, k) + attn_bias
-        attn = F.softmax(attn.float(), dim=-1).type_as(attn)
-        x = torch.einsum('bnij,bjnc->binc', attn, v)
+        x = attention(q, k, v, softmax_scale=1.0, attn_bias=attn_bias)
 
         # output
         x = x.reshape(b, -1, n * c)
@@ -475,7 +482,7 @@ class T5EncoderModel:
         self,
         text_len,
         dtype=torch.bfloat16,
-        device=torch.cuda.current_device(),
+        device="cuda",
         checkpoint_path=None,
         tokenizer_path=None,
         shard_fn=None,
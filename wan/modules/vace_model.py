@@ -1,10 +1,10 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import torch
-import torch.cuda.amp as amp
 import torch.nn as nn
 from diffusers.configuration_utils import register_to_config
 
-from .model import WanAttentionBlock, WanModel, sinusoidal_embedding_1d
+from .attention import AttentionMetadata
+from .model import WanAttentionBlock, WanModel
 
 
 class VaceWanAttentionBlock(WanAttentionBlock):
@@ -162,6 +162,12 @@ class VaceWanModel(WanModel):
         vace_context_scale=1.0,
         clip_fea=None,
         y=None,
+        context_cache=None,
+        time_embedding=None,
+        step_cache=None,
+        step=None,
+        t_host=None,
+        session=None,
     ):
         r"""
         Forward pass through the diffusion model
@@ -179,6 +185,19 @@ class VaceWanModel(WanModel):
                 CLIP image features for image-to-video mode
             y (List[Tensor], *optional*):
                 Conditional video inputs for image-to-video mode, same shape as x
+            context_cache (WanContextCache, *optional*):
+                Per-generation cache of the embedded context and cross-attention keys/values
+            time_embedding (WanTimeEmbedding, *optional*):
+                Precomputed embeddings of this step from `precompute_time_embeddings`, replaces t
+            step_cache (StepCache, *optional*):
+                Per-generation cache of the blocks' residual, reused at steps its policy skips
+            step (`int`, *optional*):
+                Index of the sampling step, required with step_cache
+            t_host (`float`, *optional*):
+                Largest timestep of t on the host, so the per-step modes do not read t
+                back from the device
+            session (WanInferenceSession, *optional*):
+                Per-generation buffers of the padded tokens and output latents
 
         Returns:
             List[Tensor]:
@@ -188,63 +207,74 @@ class VaceWanModel(WanModel):
         #     assert clip_fea is not None and y is not None
         # params
         device = self.patch_embedding.weight.device
-        if self.freqs.device != device:
-            self.freqs = self.freqs.to(device)
 
         # if y is not None:
         #     x = [torch.cat([u, v], dim=0) for u, v in zip(x, y)]
 
         # embeddings
-        x = [self.patch_embedding(u.unsqueeze(0)) for u in x]
-        grid_sizes = torch.stack(
-            [torch.tensor(u.shape[2:], dtype=torch.long) for u in x])
-        x = [u.flatten(2).transpose(1, 2) for u in x]
-        seq_lens = torch.tensor([u.size(1) for u in x], dtype=torch.long)
-        assert seq_lens.max() <= seq_len
-        x = torch.cat([
-            torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
-                      dim=1) for u in x
-        ])
+        seq_len = self.bucket_seq_len(seq_len)
+        if session is not None:
+            x, grid_sizes, seq_lens = self.patchify(x, seq_len, session)
+        else:
+            x = [self.patch_embedding(u.unsqueeze(0)) for u in x]
+            grid_sizes = torch.stack(
+                [torch.tensor(u.shape[2:], dtype=torch.long) for u in x])
+            x = [u.flatten(2).transpose(1, 2) for u in x]
+            seq_lens = torch.tensor([u.size(1) for u in x], dtype=torch.long)
+            assert seq_lens.max() <= seq_len
+            x = torch.cat([
+                torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
+                          dim=1) for u in x
+            ])
 
         # time embeddings
-        with amp.autocast(dtype=torch.float32):
-            e = self.time_embedding(
-                sinusoidal_embedding_1d(self.freq_dim, t).float())
-            e0 = self.time_projection(e).unflatten(1, (6, self.dim))
-            assert e.dtype == torch.float32 and e0.dtype == torch.float32
+        e, e0, time_modulation = self.embed_time(t, time_embedding)
+        step_state, residual = (None, None) if step_cache is None else (
+            step_cache.lookup(context,
+                              self.step_signal(x, e0, time_modulation), step))
 
         # context
         context_lens = None
-        context = self.text_embedding(
-            torch.stack([
-                torch.cat(
-                    [u, u.new_zeros(self.text_len - u.size(0), u.size(1))])
-                for u in context
-            ]))
+        context, kv_cache = self.embed_context(
+            context, context_cache=context_cache)
 
-        # if clip_fea is not None:
-        #     context_clip = self.img_emb(clip_fea)  # bs x 257 x dim
-        #     context = torch.concat([context_clip, context], dim=1)
+        t_modes = t if t_host is None else t_host
+        if self.head_sparsity is not None:
+            self.head_sparsity.step(self, t_modes)
 
         # arguments
         kwargs = dict(
             e=e0,
             seq_lens=seq_lens,
             grid_sizes=grid_sizes,
-            freqs=self.freqs,
+            freqs=self.rope(grid_sizes, seq_len, device),
             context=context,
-            context_lens=context_lens)
-
-        hints = self.forward_vace(x, vace_context, seq_len, kwargs)
-        kwargs['hints'] = hints
-        kwargs['context_scale'] = vace_context_scale
-
-        for block in self.blocks:
-            x = block(x, **kwargs)
+            context_lens=context_lens,
+            kv_cache=kv_cache,
+            time_modulation=time_modulation,
+            local_attn=self.local_attention_at(t_modes),
+            token_merge=self.token_merging_at(t_modes),
+            metadata=AttentionMetadata(
+                seq_lens, grid_sizes, device, padded_len=seq_len)
+            if session is None else session.attention_metadata(
+                seq_lens, grid_sizes, device, padded_len=seq_len))
+
+        if residual is not None:
+            x = x + residual
+        else:
+            hints = self.forward_vace(x, vace_context, seq_len, kwargs)
+            kwargs['hints'] = hints
+            kwargs['context_scale'] = vace_context_scale
+
+            residual = x
+            for block in self.blocks:
+                x = block(x, **kwargs)
+            if step_state is not None:
+                step_cache.store(step_state, x - residual)
 
         # head
-        x = self.head(x, e)
+        x = self.head(x, e, time_modulation)
 
         # unpatchify
-        x = self.unpatchify(x, grid_sizes)
+        x = self.unpatchify(x, grid_sizes, session)
         return [u.float() for u in x]
@@ -10,12 +10,20 @@ from contextlib import contextmanager
 from functools import partial
 
 import torch
-import torch.cuda.amp as amp
 import torch.distributed as dist
 from tqdm import tqdm
 
 from .distributed.fsdp import shard_model
-from .modules.model import WanModel
+from .modules.device import autocast, empty_cache, get_device, synchronize
+from .modules.fusion import fuse_projections
+from .modules.model import (
+    WanContextCache,
+    WanInferenceSession,
+    WanModel,
+    precompute_time_embeddings,
+)
+from .modules.quant import quantize_pipeline
+from .modules.streaming import BlockStreamer
 from .modules.t5 import T5EncoderModel
 from .modules.vae import WanVAE
 from .utils.fm_solvers import (
@@ -24,6 +32,8 @@ from .utils.fm_solvers import (
     retrieve_timesteps,
 )
 from .utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .utils.guidance import GuidanceSchedule, cfg_batch_fits, cfg_forward
+from .utils.step_cache import StepCache
 
 
 class WanT2V:
@@ -38,6 +48,9 @@ class WanT2V:
         dit_fsdp=False,
         use_usp=False,
         t5_cpu=False,
+        quantization=None,
+        fuse=False,
+        stream_blocks=None,
     ):
         r"""
         Initializes the Wan text-to-video generation model components.
@@ -47,8 +60,8 @@ class WanT2V:
                 Object containing model parameters initialized from config.py
             checkpoint_dir (`str`):
                 Path to directory containing model checkpoints
-            device_id (`int`,  *optional*, defaults to 0):
-                Id of target GPU device
+            device_id (`int` or `str`,  *optional*, defaults to 0):
+                Id of target GPU device, or 'cpu' to run the pipeline on CPU
             rank (`int`,  *optional*, defaults to 0):
                 Process rank for distributed training
             t5_fsdp (`bool`, *optional*, defaults to False):
@@ -59,8 +72,15 @@ class WanT2V:
                 Enable distribution strategy of USP.
             t5_cpu (`bool`, *optional*, defaults to False):
                 Whether to place T5 model on CPU. Only works without t5_fsdp.
+            quantization (`dict`, *optional*):
+                Arguments of `quantize_pipeline` to quantize the DiT and T5 weights
+            fuse (`bool`, *optional*, defaults to False):
+                Fuse the q/k/v and k/v projections of the DiT and T5 with `fuse_projections`
+            stream_blocks (`int`, *optional*):
+                VRAM budget in bytes of the DiT blocks, the others are streamed from pinned
+                host memory by `BlockStreamer`. 0 streams every block
         """
-        self.device = torch.device(f"cuda:{device_id}")
+        self.device = get_device(device_id)
         self.config = config
         self.rank = rank
         self.t5_cpu = t5_cpu
@@ -86,6 +106,12 @@ class WanT2V:
         logging.info(f"Creating WanModel from {checkpoint_dir}")
         self.model = WanModel.from_pretrained(checkpoint_dir)
         self.model.eval().requires_grad_(False)
+        if quantization is not None:
+            quantize_pipeline(
+                self, checkpoint_dir=checkpoint_dir, **quantization)
+        if fuse:
+            fuse_projections(self.model)
+            fuse_projections(self.text_encoder.model)
 
         if use_usp:
             from xfuser.core.distributed import get_sequence_parallel_world_size
@@ -107,6 +133,9 @@ class WanT2V:
         if dit_fsdp:
             self.model = shard_fn(self.model)
         else:
+            if stream_blocks is not None:
+                # the blocks leave for pinned memory before the rest is moved
+                BlockStreamer(self.model, self.device, stream_blocks or None)
             self.model.to(self.device)
 
         self.sample_neg_prompt = config.sample_neg_prompt
@@ -121,7 +150,12 @@ class WanT2V:
                  guide_scale=5.0,
                  n_prompt="",
                  seed=-1,
-                 offload_model=True):
+                 offload_model=True,
+                 batch_cfg=False,
+                 cache_context=True,
+                 cache_policy=None,
+                 guide_interval=None,
+                 uncond_interval=1):
         r"""
         Generates video frames from text prompt using diffusion process.
 
@@ -146,6 +180,21 @@ class WanT2V:
                 Random seed for noise generation. If -1, use random seed.
             offload_model (`bool`, *optional*, defaults to True):
                 If True, offloads models to CPU during generation to save VRAM
+            batch_cfg (`bool`, *optional*, defaults to False):
+                If True, runs the conditional and unconditional branches as one batch-2 forward,
+                falling back to sequential forwards when the batch does not fit into memory
+            cache_context (`bool`, *optional*, defaults to True):
+                If True, embeds the context and projects the cross-attention keys/values once
+                per generation instead of at every step
+            cache_policy (CachePolicy, *optional*, defaults to None):
+                If given, reuses the residual of the DiT blocks at the steps this policy skips,
+                e.g. `ThresholdPolicy`, `IntervalPolicy` or `ForecastPolicy`
+            guide_interval (tuple[`float`], *optional*, defaults to None):
+                Timestep range (low, high) in which classifier-free guidance is applied, outside
+                of it only the conditional branch runs
+            uncond_interval (`int`, *optional*, defaults to 1):
+                Recomputes the unconditional prediction every N guided steps and reuses the
+                last uncond-cond delta in between
 
         Returns:
             torch.Tensor:
@@ -201,7 +250,7 @@ class WanT2V:
         no_sync = getattr(self.model, 'no_sync', noop_no_sync)
 
         # evaluation mode
-        with amp.autocast(dtype=self.param_dtype), torch.no_grad(), no_sync():
+        with autocast(self.device, self.param_dtype), torch.no_grad(), no_sync():
 
             if sample_solver == 'unipc':
                 sample_scheduler = FlowUniPCMultistepScheduler(
@@ -230,17 +279,42 @@ class WanT2V:
             arg_c = {'context': context, 'seq_len': seq_len}
             arg_null = {'context': context_null, 'seq_len': seq_len}
 
-            for _, t in enumerate(tqdm(timesteps)):
+            self.model.to(self.device)
+            if batch_cfg and not cfg_batch_fits(self.model, seq_len,
+                                                self.device):
+                logging.info(
+                    'Not enough memory for batched CFG, use sequential forwards.'
+                )
+                batch_cfg = False
+            context_cache = WanContextCache() if cache_context else None
+            session = WanInferenceSession()
+            time_embeddings = precompute_time_embeddings(
+                self.model, timesteps)
+            host_timesteps = timesteps.tolist()
+            step_cache = None if cache_policy is None else StepCache(
+                cache_policy, len(timesteps))
+            guidance = GuidanceSchedule(guide_interval, uncond_interval)
+
+            for i, t in enumerate(tqdm(timesteps)):
                 latent_model_input = latents
                 timestep = [t]
 
                 timestep = torch.stack(timestep)
 
-                self.model.to(self.device)
-                noise_pred_cond = self.model(
-                    latent_model_input, t=timestep, **arg_c)[0]
-                noise_pred_uncond = self.model(
-                    latent_model_input, t=timestep, **arg_null)[0]
+                noise_pred_cond, noise_pred_uncond, batch_cfg = cfg_forward(
+                    self.model,
+                    latent_model_input,
+                    timestep,
+                    arg_c,
+                    arg_null,
+                    batched=batch_cfg,
+                    guidance=guidance,
+                    context_cache=context_cache,
+                    time_embedding=time_embeddings[i],
+                    step_cache=step_cache,
+                    step=i,
+                    t_host=host_timesteps[i],
+                    session=session)
 
                 noise_pred = noise_pred_uncond + guide_scale * (
                     noise_pred_cond - noise_pred_uncond)
@@ -253,10 +327,26 @@ class WanT2V:
                     generator=seed_g)[0]
                 latents = [temp_x0.squeeze(0)]
 
+            if context_cache is not None:
+                logging.info(
+                    f"Context cache held {context_cache.nbytes / 2**20:.1f} MiB."
+                )
+                context_cache.clear()
+            if step_cache is not None:
+                logging.info(
+                    f"Step cache skipped the blocks in {step_cache.skipped} of "
+                    f"{step_cache.skipped + step_cache.computed} forwards.")
+                step_cache.clear()
+            session.clear()
+            if guidance.saved:
+                logging.info(
+                    f"Guidance schedule saved {guidance.saved} of {guidance.steps} "
+                    f"unconditional forwards.")
+
             x0 = latents
             if offload_model:
                 self.model.cpu()
-                torch.cuda.empty_cache()
+                empty_cache(self.device)
             if self.rank == 0:
                 videos = self.vae.decode(x0)
 
@@ -264,7 +354,7 @@ class WanT2V:
         del sample_scheduler
         if offload_model:
             gc.collect()
-            torch.cuda.synchronize()
+            synchronize(self.device)
         if dist.is_initialized():
             dist.barrier()
 
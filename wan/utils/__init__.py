@@ -4,10 +4,20 @@ from .fm_solvers import (
     retrieve_timesteps,
 )
 from .fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .guidance import GuidanceSchedule, cfg_batch_fits, cfg_forward
+from .step_cache import (
+    CachePolicy,
+    ForecastPolicy,
+    IntervalPolicy,
+    StepCache,
+    ThresholdPolicy,
+)
 from .vace_processor import VaceVideoProcessor
 
 __all__ = [
     'HuggingfaceTokenizer', 'get_sampling_sigmas', 'retrieve_timesteps',
     'FlowDPMSolverMultistepScheduler', 'FlowUniPCMultistepScheduler',
-    'VaceVideoProcessor'
+    'VaceVideoProcessor', 'GuidanceSchedule', 'cfg_batch_fits', 'cfg_forward',
+    'CachePolicy', 'ThresholdPolicy', 'IntervalPolicy', 'ForecastPolicy',
+    'StepCache'
 ]
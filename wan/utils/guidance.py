@@ -0,0 +1,170 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+
+import torch
+
+__all__ = ['GuidanceSchedule', 'cfg_batch_fits', 'cfg_forward']
+
+
+class GuidanceSchedule:
+    r"""
+    Decides per step whether the unconditional forward of classifier free
+    guidance runs, and counts the forwards it saves.
+
+    Args:
+        interval (Tuple[`float`, `float`], *optional*):
+            Timestep range (low, high) in which guidance is applied, the cond
+            prediction alone is used outside of it
+        uncond_interval (`int`, *optional*, defaults to 1):
+            Recompute the uncond prediction every `uncond_interval` guided steps
+            and reuse the last uncond - cond delta in between
+    """
+
+    def __init__(self, interval=None, uncond_interval=1):
+        self.interval = interval
+        self.uncond_interval = uncond_interval
+        self.delta = None
+        self.guided = 0
+        self.steps = 0
+        self.saved = 0
+
+    def mode(self, t):
+        r"""
+        Returns 'cond' to skip guidance at timestep t, 'reuse' to add the last
+        delta to the cond prediction, or 'full' to run both branches. t is a
+        tensor or the largest timestep as a float.
+        """
+        self.steps += 1
+        if self.interval is not None:
+            t = t if isinstance(t, (int, float)) else float(t.max())
+            if not self.interval[0] <= t <= self.interval[1]:
+                self.saved += 1
+                return 'cond'
+        step = self.guided
+        self.guided += 1
+        if self.delta is not None and step % self.uncond_interval != 0:
+            self.saved += 1
+            return 'reuse'
+        return 'full'
+
+
+def cfg_batch_fits(model, seq_len, device, margin=1.5):
+    r"""
+    Estimates whether the activations of one more sample fit into the free
+    memory of `device`, i.e. whether cond and uncond can share one forward.
+
+    Args:
+        model (WanModel):
+            DiT model, possibly wrapped by FSDP
+        seq_len (`int`):
+            Padded token sequence length of one sample
+        device (torch.device):
+            Device the model runs on
+        margin (`float`, *optional*, defaults to 1.5):
+            Safety factor applied to the estimate
+    """
+    device = torch.device(device)
+    if device.type != 'cuda' or not hasattr(model, 'blocks'):
+        # exported models run on the host
+        return True
+    free, _ = torch.cuda.mem_get_info(device)
+
+    # bf16 FFN hidden states plus the modulated copies of one block
+    block = model.blocks[0]
+    ffn_tokens = min(seq_len, block.ffn_chunk_size or seq_len)
+    need = ffn_tokens * 2 * model.ffn_dim + (
+        seq_len * 4 * block.precision.adaln.itemsize * model.dim)
+    return free > margin * need
+
+
+def cfg_forward(model,
+                x,
+                t,
+                arg_c,
+                arg_null,
+                batched=False,
+                offload=False,
+                guidance=None,
+                step=None,
+                **kwargs):
+    r"""
+    Runs the conditional and unconditional DiT forwards of one denoising step.
+
+    Args:
+        model (WanModel):
+            DiT model
+        x (List[Tensor]):
+            Latent of a single video with shape [C_in, F, H, W]
+        t (Tensor):
+            Timestep of shape [1]
+        arg_c (dict):
+            Conditional arguments, e.g. `context`, `seq_len`, `clip_fea`, `y`
+        arg_null (dict):
+            Unconditional arguments with the same keys as `arg_c`
+        batched (`bool`, *optional*, defaults to False):
+            Stack cond and uncond into one batch-2 forward. Context is given
+            per sample, `y`/`clip_fea`/`vace_context` are shared.
+        offload (`bool`, *optional*, defaults to False):
+            Move the predictions to CPU and empty the CUDA cache after each
+            forward to save VRAM
+        guidance (GuidanceSchedule, *optional*):
+            Skips or reuses the uncond forward at the steps it selects
+        step (`int`, *optional*):
+            Index of the sampling step, passed to the model for its step cache
+        kwargs:
+            Arguments shared by both branches, e.g. `vace_context`
+
+    Returns:
+        Tuple[Tensor, Tensor, bool]:
+            Cond and uncond predictions, and whether they were computed in one
+            batch. Batching is switched off when the batch-2 forward runs out
+            of memory, callers should pass the flag back on the next step.
+    """
+
+    def release(u):
+        if offload:
+            u = u.cpu()
+            torch.cuda.empty_cache()
+        return u
+
+    if step is not None:
+        kwargs['step'] = step
+    t_host = kwargs.get('t_host')
+    mode = 'full' if guidance is None else guidance.mode(
+        t if t_host is None else t_host)
+    if mode != 'full':
+        noise_pred_cond = release(model(x, t=t, **arg_c, **kwargs)[0])
+        if mode == 'cond':
+            return noise_pred_cond, noise_pred_cond, batched
+        return noise_pred_cond, noise_pred_cond + guidance.delta, batched
+
+    noise_pred_cond, noise_pred_uncond, batched = _cfg_forward(
+        model, x, t, arg_c, arg_null, batched, release, **kwargs)
+    if guidance is not None and guidance.uncond_interval > 1:
+        guidance.delta = noise_pred_uncond - noise_pred_cond
+    return noise_pred_cond, noise_pred_uncond, batched
+
+
+def _cfg_forward(model, x, t, arg_c, arg_null, batched, release, **kwargs):
+    if batched:
+        args = {}
+        for key, value in arg_c.items():
+            if key in ('context', 'y'):
+                args[key] = value + arg_null[key]
+            elif key == 'clip_fea' and value is not arg_null[key]:
+                args[key] = torch.cat([value, arg_null[key]])
+            else:
+                args[key] = value
+        try:
+            noise_pred_cond, noise_pred_uncond = model(
+                x * 2, t=t, **args, **kwargs)
+            return release(noise_pred_cond), release(noise_pred_uncond), True
+        except torch.cuda.OutOfMemoryError:
+            logging.warning(
+                'Batched CFG ran out of memory, falling back to sequential cond/uncond forwards.'
+            )
+            torch.cuda.empty_cache()
+
+    noise_pred_cond = release(model(x, t=t, **arg_c, **kwargs)[0])
+    noise_pred_uncond = release(model(x, t=t, **arg_null, **kwargs)[0])
+    return noise_pred_cond, noise_pred_uncond, False
@@ -0,0 +1,197 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import abc
+import math
+
+__all__ = [
+    'CachePolicy', 'ThresholdPolicy', 'IntervalPolicy', 'ForecastPolicy',
+    'StepCache'
+]
+
+
+class CachePolicy(abc.ABC):
+    r"""
+    Decides at which sampling steps the residual of the DiT blocks is reused
+    instead of recomputed.
+
+    Args:
+        warmup (`int`, *optional*, defaults to 1):
+            Number of leading steps that always run the blocks
+    """
+
+    history_size = 1
+
+    def __init__(self, warmup=1):
+        self.warmup = warmup
+
+    @abc.abstractmethod
+    def skip(self, state, step, change):
+        r"""
+        Args:
+            state (dict):
+                Per-branch state, `accumulated` holds the summed change since
+                the blocks last ran
+            step (`int`):
+                Index of the current step
+            change (Tensor):
+                Relative L1 change of the modulated input of the first block
+                since the previous step as a scalar on the device, policies
+                that compare it read it back, the others leave it there
+        """
+
+    def residual(self, history, step):
+        r"""
+        Residual to add at a skipped step, given the list of (step, residual)
+        pairs of the latest computed steps.
+        """
+        return history[-1][1]
+
+
+class ThresholdPolicy(CachePolicy):
+    r"""
+    Reuses the residual until the accumulated change of the modulated input of
+    the first block exceeds `threshold`.
+
+    Args:
+        threshold (`float`, *optional*, defaults to 0.1):
+            Accumulated relative L1 change that triggers a recompute
+        coefficients (List[float], *optional*):
+            Polynomial rescaling of the raw change, highest degree first
+        warmup (`int`, *optional*, defaults to 1):
+            Number of leading steps that always run the blocks
+    """
+
+    def __init__(self, threshold=0.1, coefficients=None, warmup=1):
+        super().__init__(warmup)
+        self.threshold = threshold
+        self.coefficients = coefficients
+
+    def skip(self, state, step, change):
+        change = change.item()
+        if self.coefficients is not None:
+            change = abs(
+                sum(c * change**i
+                    for i, c in enumerate(reversed(self.coefficients))))
+        state['accumulated'] += change
+        return state['accumulated'] < self.threshold
+
+
+class IntervalPolicy(CachePolicy):
+    r"""
+    Runs the blocks every `interval` steps and reuses the residual in between.
+
+    Args:
+        interval (`int`, *optional*, defaults to 2):
+            Distance between computed steps
+        warmup (`int`, *optional*, defaults to 1):
+            Number of leading steps that always run the blocks
+    """
+
+    def __init__(self, interval=2, warmup=1):
+        super().__init__(warmup)
+        self.interval = interval
+
+    def skip(self, state, step, change):
+        return (step - self.warmup) % self.interval != 0
+
+
+class ForecastPolicy(IntervalPolicy):
+    r"""
+    Runs the blocks every `interval` steps and extrapolates the residual in
+    between with a polynomial through the latest `order + 1` computed steps.
+
+    Args:
+        interval (`int`, *optional*, defaults to 3):
+            Distance between computed steps
+        order (`int`, *optional*, defaults to 1):
+            Degree of the extrapolating polynomial
+        warmup (`int`, *optional*, defaults to 1):
+            Number of leading steps that always run the blocks
+    """
+
+    def __init__(self, interval=3, order=1, warmup=1):
+        super().__init__(interval, warmup)
+        self.history_size = order + 1
+
+    def residual(self, history, step):
+        # Lagrange weights of the computed steps evaluated at `step`
+        out = 0
+        for i, (s_i, r_i) in enumerate(history):
+            w = math.prod((step - s_j) / (s_i - s_j)
+                          for j, (s_j, _) in enumerate(history)
+                          if j != i)
+            out = out + w * r_i
+        return out
+
+
+class StepCache:
+    r"""
+    Per-generation cache of the residual the DiT blocks add to their input,
+    reused at steps the policy considers close to the last computed one.
+
+    Every branch (e.g. cond and uncond of classifier free guidance) has its own
+    state, keyed on its input context like `WanContextCache`. Steps are the
+    sampling step indices passed by the caller, not per-branch call counts, so
+    a branch whose forwards the guidance schedule skips still sees the real
+    step. The decision only depends on the step and on the modulated input of
+    the first block, computed before the sequence is split, so all sequence
+    parallel ranks skip the same steps.
+
+    Args:
+        policy (CachePolicy):
+            Decides which steps are skipped
+        num_steps (`int`):
+            Number of sampling steps, the last one always runs the blocks
+    """
+
+    def __init__(self, policy, num_steps):
+        self.policy = policy
+        self.num_steps = num_steps
+        self.branches = {}
+        self.computed = 0
+        self.skipped = 0
+
+    def lookup(self, context, signal, step):
+        r"""
+        Returns the branch state of `context` and the residual to reuse at the
+        current step, or None if the blocks have to run.
+
+        Args:
+            context (List[Tensor]):
+                Input text embeddings of the forward
+            signal (Tensor):
+                Modulated input of the first block at the current step
+            step (`int`):
+                Index of the current sampling step
+        """
+        assert step is not None, \
+            'StepCache needs the index of the sampling step.'
+        key = tuple(id(u) for u in context)
+        if key not in self.branches:
+            self.branches[key] = dict(
+                step=None, signal=None, accumulated=0.0, history=[])
+        state = self.branches[key]
+        state['step'] = step
+
+        change = None
+        if state['signal'] is not None:
+            prev = state['signal']
+            change = (signal - prev).abs().mean() / prev.abs().mean()
+        state['signal'] = signal
+
+        if (step >= self.policy.warmup and step < self.num_steps - 1 and
+                state['history'] and self.policy.skip(state, step, change)):
+            self.skipped += 1
+            return state, self.policy.residual(state['history'], step)
+        state['accumulated'] = 0.0
+        self.computed += 1
+        return state, None
+
+    def store(self, state, residual):
+        r"""
+        Records the residual of a step at which the blocks ran.
+        """
+        state['history'].append((state['step'], residual))
+        del state['history'][:-self.policy.history_size]
+
+    def clear(self):
+        self.branches.clear()